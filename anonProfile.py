@@ -0,0 +1,217 @@
+"""
+Anonymization profiles: which attributes of the original dicom make it into the anonymized header, and how.
+
+A profile is a list of [attribute, action] or [attribute, action, argument] entries, where attribute is a dicom keyword
+(e.g. PatientSex) or an 8 hex digit tag (e.g. 00100040), and action is one of:
+- keep: copy the original attribute, or an empty value if the original has none,
+- blank: an empty value,
+- replace: the constant value given as argument,
+- derive: a value computed by the derivation given as argument, among DERIVATIONS
+(mrn, accession, studyID, seriesID, sopID: the anonymized identifier, age: the patient's age at the time of the study).
+Attributes not listed in the profile are not written. DEFAULT_PROFILE is the program's standard header.
+
+Identifiers derived into UID elements (VR UI) are written under the plan's UID root, e.g. as 2.25.<identifier> for
+keyed identifiers (see keyedIds.py), and as the bare identifier otherwise.
+
+Values are written with the type of the attribute's value representation: replacement values of binary numeric
+elements (US, SS, UL, FL...) are converted to int or float, a list or backslash-separated string giving several values,
+and blanked numeric elements are written empty rather than as an empty string.
+
+Custom profiles are json files holding such a list, passed with --anon_profile. A profile is compiled once into a
+TagPlan, which resolves keywords to tags and value representations up front, and then copies the kept attributes by
+tag, as the original (possibly still unparsed) data elements.
+"""
+
+import re
+
+from pydicom.datadict import dictionary_VR, keyword_for_tag, tag_for_keyword
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
+from pydicom.uid import SecondaryCaptureImageStorage
+
+import utils
+
+ACTIONS = ('keep', 'blank', 'replace', 'derive')
+HEX_TAG = re.compile(r'^[0-9A-Fa-f]{8}$')
+# Binary numeric value representations, including the ambiguous ones of the dicom dictionary, and the type of their values.
+NUMERIC_VRS = {'US': int, 'SS': int, 'UL': int, 'SL': int, 'UV': int, 'SV': int, 'FL': float, 'FD': float,
+               'US or SS': int, 'US or SS or OW': int}
+
+DEFAULT_PROFILE = [
+    ['StudyInstanceUID', 'derive', 'studyID'],
+    ['SeriesInstanceUID', 'derive', 'seriesID'],
+    ['SOPInstanceUID', 'derive', 'sopID'],
+    ['SOPClassUID', 'replace', str(SecondaryCaptureImageStorage)],
+    ['AccessionNumber', 'derive', 'accession'],
+    ['PatientID', 'derive', 'mrn'],
+    ['StudyID', 'derive', 'studyID'],
+
+    ['PatientName', 'derive', 'mrn'],
+    ['ReferringPhysicianName', 'blank'],
+    ['StudyDate', 'blank'],
+    ['StudyTime', 'blank'],
+    ['PatientBirthTime', 'blank'],
+    ['PatientBirthDate', 'blank'],
+    ['PatientAge', 'derive', 'age'],
+    ['PatientSex', 'keep'],
+
+    ['StudyDescription', 'keep'],
+    ['SeriesDescription', 'keep'],
+    ['Modality', 'keep'],
+    ['SeriesNumber', 'keep'],
+    ['InstanceNumber', 'keep'],
+
+    ['PlanarConfiguration', 'keep'],
+    ['ViewPosition', 'keep'],
+    ['PatientOrientation', 'keep'],
+
+    ['SamplesPerPixel', 'keep'],
+    ['PhotometricInterpretation', 'keep'],
+    ['PixelRepresentation', 'keep'],
+    ['ImagerPixelSpacing', 'keep'],
+    ['HighBit', 'keep'],
+    ['BitsStored', 'keep'],
+    ['BitsAllocated', 'keep'],
+    ['Columns', 'keep'],
+    ['Rows', 'keep'],
+
+    ['SpecificCharacterSet', 'keep'],
+    ['PresentationLUTShape', 'keep'],
+    ['KVP', 'keep'],
+    ['XRayTubeCurrent', 'keep'],
+    ['ExposureTime', 'keep'],
+    ['Exposure', 'keep'],
+    ['ExposureControlMode', 'keep'],
+    ['RelativeXRayExposure', 'keep'],
+    ['FocalSpots', 'keep'],
+    ['AnodeTargetMaterial', 'keep'],
+    ['BodyPartThickness', 'keep'],
+    ['CompressionForce', 'keep'],
+    ['PaddleDescription', 'keep'],
+    ['BurnedInAnnotation', 'blank'],
+    ['DistanceSourceToDetector', 'keep'],
+    ['DistanceSourceToPatient', 'keep'],
+    ['PositionerPrimaryAngle', 'keep'],
+    ['PositionerPrimaryAngleDirection', 'keep'],
+    ['PositionerSecondaryAngle', 'keep'],
+    ['ImageLaterality', 'keep'],
+    ['BreastImplantPresent', 'keep'],
+    ['Manufacturer', 'keep'],
+    ['ManufacturerModelName', 'keep'],
+    ['EstimatedRadiographicMagnificationFactor', 'keep'],
+    ['DateOfLastDetectorCalibration', 'keep'],
+]
+
+
+def derive_age(ods, anon_values):
+    return utils.calculate_age(ods.StudyDate, ods.PatientBirthDate) if ("StudyDate" in ods and "PatientBirthDate" in ods) else ""
+
+
+def derive_identifier(identifier):
+    def derive(ods, anon_values):
+        return str(anon_values[identifier])
+    return derive
+
+
+def element_value(vr, value):
+    """
+    <value> as the value of an element of value representation <vr>: binary numeric values are converted to int or float,
+    and are empty (None) rather than an empty string.
+    """
+    value_type = NUMERIC_VRS.get(vr)
+    if value_type is None:
+        return value
+    if value is None or value == '' or value == []:
+        return None
+    if isinstance(value, str):
+        value = value.split('\\') if '\\' in value else value
+    if isinstance(value, (list, tuple)):
+        return [value_type(item) for item in value]
+    return value_type(value)
+
+
+DERIVATIONS = {'mrn': derive_identifier('mrn'),
+               'accession': derive_identifier('accession'),
+               'studyID': derive_identifier('studyID'),
+               'seriesID': derive_identifier('seriesID'),
+               'sopID': derive_identifier('sopID'),
+               'age': derive_age}
+
+
+class TagPlan(object):
+    """
+    A compiled profile: the tags to copy, and the tags to set to a constant or derived value, with their value
+    representations. Holds only tags, strings and derivation names, so that it can be sent to worker processes.
+    """
+    def __init__(self, keep, constants, derived, uid_root=''):
+        self.keep = keep
+        self.constants = constants
+        self.derived = derived
+        self.uid_root = uid_root
+
+    def apply(self, ods, ds, anon_values):
+        """
+        Sets the attributes of the profile in <ds>, from the original dicom <ods> and its anonymized identifiers.
+        """
+        for tag, vr in self.keep:
+            elem = ods.get_item(tag)
+            ds[tag] = elem if elem is not None else DataElement(tag, vr, element_value(vr, ""))
+        for tag, vr, value in self.constants:
+            ds[tag] = DataElement(tag, vr, value)
+        for tag, vr, derivation in self.derived:
+            value = DERIVATIONS[derivation](ods, anon_values)
+            ds[tag] = DataElement(tag, vr, self.uid_root + value if vr == 'UI' else element_value(vr, value))
+
+
+def resolve_tag(attribute):
+    if HEX_TAG.match(attribute):
+        tag = Tag(int(attribute, 16))
+        if keyword_for_tag(tag) == '':
+            raise ValueError('tag {} is not in the dicom dictionary'.format(attribute))
+        return tag
+    tag = tag_for_keyword(attribute)
+    if tag is None:
+        raise ValueError('unknown dicom keyword {}'.format(attribute))
+    return Tag(tag)
+
+
+def compile_profile(profile, uid_root=''):
+    """
+    Compiles a profile into a TagPlan, deriving UIDs under <uid_root>. Raises ValueError for unknown attributes, actions or derivations, so that
+    a profile can be validated once at startup.
+    """
+    keep, constants, derived = [], [], []
+    for entry in profile:
+        attribute, action, argument = (list(entry) + [None])[:3]
+        tag = resolve_tag(attribute)
+        vr = dictionary_VR(tag)
+        if action == 'keep':
+            keep.append((tag, vr))
+        elif action == 'blank':
+            constants.append((tag, vr, element_value(vr, "")))
+        elif action == 'replace':
+            if argument is None:
+                raise ValueError('replace action of {} requires a value'.format(attribute))
+            try:
+                constants.append((tag, vr, element_value(vr, argument)))
+            except (TypeError, ValueError):
+                raise ValueError('replace value {} of {} is not valid for its value representation {}'.format(argument, attribute, vr))
+        elif action == 'derive':
+            if argument not in DERIVATIONS:
+                raise ValueError('unknown derivation {} for {}, expected one of {}'.format(argument, attribute, ', '.join(DERIVATIONS)))
+            derived.append((tag, vr, argument))
+        else:
+            raise ValueError('unknown action {} for {}, expected one of {}'.format(action, attribute, ', '.join(ACTIONS)))
+    return TagPlan(keep, constants, derived, uid_root)
+
+
+def load_plan(file_name=None, uid_root=''):
+    """
+    Compiles the profile of json file <file_name>, or the default profile, deriving UIDs under <uid_root>.
+    """
+    if file_name is None:
+        return compile_profile(DEFAULT_PROFILE, uid_root)
+    profile = utils.load_json(file_name)
+    if profile is None:
+        raise ValueError('anonymization profile {} does not exist'.format(file_name))
+    return compile_profile(profile, uid_root)
@@ -0,0 +1,223 @@
+"""
+Library interface, for services anonymizing dicoms in process rather than by running the programs on directories.
+
+An Anonymizer owns the link logs of a linking log directory, as a run of the programs does, and anonymizes batches of
+dicoms given as file paths, bytes or pydicom datasets, entirely in memory:
+
+    import anonymizer
+    with anonymizer.Anonymizer('./linklog') as anon:
+        for result in anon.anonymize_many(['./data/a.dcm', dicom_bytes, dataset]):
+            if result.status == anonymizer.ANONYMIZED:
+                store(result.filename, result.header, result.pixels, result.anon_values)
+
+Each result holds the anonymized identifiers and the anonymized header as a pydicom dataset, along with either the bytes
+of the .dcm and .hdf5 files the programs would write (buffers=True), or the pixel array (buffers=False). A dicom already
+anonymized according to the link logs is reported as a duplicate and not anonymized again, as by the programs.
+A dicom is recorded in the link logs as anonymized as soon as its result is built, storing it is up to the caller.
+
+With a site secret, identifiers are keyed (see keyedIds.py): derived from the original values, so that separate
+Anonymizers holding the same secret agree on them without sharing link logs, which can then be left unrecorded
+(link_log_backend='none').
+
+The link logs are committed at the end of each batch, and saved in full by close(). Nothing else is written to disk,
+and stdout is left alone.
+"""
+
+import os
+import logging
+from io import BytesIO
+
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian, ExplicitVRBigEndian
+
+import anonProfile
+import archiveReader
+import constructDicom
+import fingerprint
+import keyedIds
+import pixelExport
+import runMetrics
+import utils
+from idAllocator import open_allocator, DICOM_FIELDS
+
+# Status of a result.
+ANONYMIZED = 'anonymized'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+ERROR = 'error'
+
+# Transfer syntax of a dataset without file meta information, by its (implicit VR, little endian) encoding.
+ENCODING_TRANSFER_SYNTAXES = {(True, True): ImplicitVRLittleEndian,
+                              (False, True): ExplicitVRLittleEndian,
+                              (False, False): ExplicitVRBigEndian}
+
+logger = logging.getLogger(__name__)
+
+
+class AnonymizedDicom(object):
+    """
+    Result of anonymizing <source>: its status, and if anonymized, its anonymized identifiers (anon_values), header
+    (dataset, with an empty PixelData) and output file name, with either the bytes of its .dcm and .hdf5 files
+    (header and pixels) or its pixel array. pixels and pixel_array are None for dicoms without pixel data.
+    error holds the reason a dicom is invalid, or the exception it could not be anonymized for.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.status = None
+        self.anon_values = None
+        self.dataset = None
+        self.filename = None
+        self.header = None
+        self.pixels = None
+        self.pixel_array = None
+        self.error = None
+
+
+class Anonymizer(object):
+    """
+    Anonymizes dicoms against the link logs of <link_log_dir>. See make_export_options (pixelExport.py) for
+    <export_options>, and the programs' --link_log_backend and --fingerprint options for the other arguments.
+    Identifiers are keyed under <secret> (bytes) if given, in which case the tag plan of <export_options> should
+    derive UIDs under keyedIds.UID_ROOT, as the default one then does.
+    """
+    def __init__(self, link_log_dir, link_log_backend='json', export_options=None, fingerprint_mode='none', node=None,
+                 secret=None):
+        utils.make_dirs(link_log_dir)
+        if export_options is None:
+            uid_root = keyedIds.uid_root('hmac' if secret is not None else 'sequential')
+            export_options = pixelExport.make_export_options(tag_plan=anonProfile.load_plan(uid_root=uid_root))
+        self.export_options = export_options
+        self.allocator = open_allocator(link_log_dir, link_log_backend, fingerprint_mode, node, secret)
+        self.fingerprints = fingerprint.FingerprintIndex(self.allocator)
+        self.run_metrics = runMetrics.RunMetrics()
+
+    def read(self, source):
+        """
+        Parses <source>, a file path, bytes or a pydicom dataset. Returns the dataset, and the file to fingerprint,
+        as (file name, file or BytesIO, size), or None for datasets. Returns None for files which are not dicoms.
+        Archive member paths (see archiveReader.py) are read like bytes. Paths which cannot be read raise OSError.
+        """
+        if isinstance(source, Dataset):
+            if not isinstance(source, FileDataset):
+                # A dataset built in memory rather than read from a file: its pixel data is decoded according to its
+                # transfer syntax, if any, else the encoding it was read with, if any, or as explicit VR little endian.
+                file_meta = getattr(source, 'file_meta', None)
+                file_meta = FileMetaDataset(file_meta) if file_meta is not None else FileMetaDataset()
+                if 'TransferSyntaxUID' not in file_meta:
+                    encoding = tuple(getattr(source, 'original_encoding', (None, None)))
+                    file_meta.TransferSyntaxUID = ENCODING_TRANSFER_SYNTAXES.get(encoding, ExplicitVRLittleEndian)
+                source = FileDataset('', source, file_meta=file_meta, preamble=getattr(source, 'preamble', None))
+            return source, None
+        if isinstance(source, (str, os.PathLike)) and archiveReader.is_member(os.fspath(source)):
+            source = archiveReader.read_member(os.fspath(source))
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            data = BytesIO(source)
+            force = bytes(source[utils.DICOM_PREAMBLE_LENGTH:utils.DICOM_PREAMBLE_LENGTH + len(utils.DICOM_PREFIX)]) != utils.DICOM_PREFIX
+            with self.run_metrics.stage('parse'):
+                ods = constructDicom.read_dicom(data, force=force)
+            return ods, ('<bytes>', data, len(data.getbuffer()))
+        file_name = os.fspath(source)
+        with open(file_name, 'rb') as f:
+            kind = utils.sniff_header(f.read(utils.DICOM_PREAMBLE_LENGTH + len(utils.DICOM_PREFIX)))
+        if kind is None:
+            return None, None
+        with self.run_metrics.stage('parse'):
+            ods = constructDicom.read_dicom(file_name, force=kind == utils.DICOM_RAW)
+        return ods, (file_name, file_name, os.path.getsize(file_name))
+
+    def anonymize(self, source, buffers=True):
+        """
+        Anonymizes a single dicom. Returns an AnonymizedDicom.
+        """
+        result = AnonymizedDicom(source)
+        self.run_metrics.count('files')
+        try:
+            ods, file_source = self.read(source)
+        except Exception as error:
+            return self.failed(result, error)
+        if ods is None:
+            result.status = INVALID
+            result.error = 'not a dicom'
+            self.run_metrics.count('invalid')
+            return result
+        if file_source is not None:
+            self.run_metrics.count('bytes', file_source[2])
+
+        # The fingerprint of a file or buffer is recorded, and known fingerprints are reported as duplicates.
+        file_fingerprint = None
+        if file_source is not None and self.fingerprints.is_enabled:
+            with self.run_metrics.stage('fingerprint'):
+                file_fingerprint, is_known = self.fingerprints.check(*file_source)
+            if is_known:
+                result.status = DUPLICATE
+                self.run_metrics.count('duplicates')
+                self.run_metrics.count('fingerprint_skips')
+                return result
+
+        missing_fields = [dicom_field for dicom_field in DICOM_FIELDS if dicom_field not in ods]
+        if missing_fields:
+            result.status = INVALID
+            result.error = '{} not in DICOM tags'.format(', '.join(missing_fields))
+            self.run_metrics.count('invalid')
+            return result
+
+        values = tuple(str(ods.get(dicom_field)).upper() for dicom_field in DICOM_FIELDS)
+        with self.run_metrics.stage('id_mapping'):
+            anon_values, is_duplicate = self.allocator.assign(values, file_fingerprint)
+        result.anon_values = anon_values
+        if is_duplicate:
+            result.status = DUPLICATE
+            self.run_metrics.count('duplicates')
+            return result
+
+        try:
+            frames = int(ods.get('NumberOfFrames') or 1)
+            with self.run_metrics.stage('build_header'):
+                ds = constructDicom.build_dicom(ods, anon_values, self.export_options['tag_plan'])
+                filename = constructDicom.get_filename(ds, anon_values)
+            if buffers:
+                header, pixels = constructDicom.encode_dicom(ods, ds, self.export_options, self.run_metrics, frames)
+                pixel_array = None
+            else:
+                header, pixels = None, None
+                with self.run_metrics.stage('pixel_decode'):
+                    pixel_array = pixelExport.get_pixel_array(ods, self.run_metrics) if 'PixelData' in ods else None
+        except Exception as error:
+            self.allocator.complete(anon_values, success=False)
+            return self.failed(result, error)
+
+        with self.run_metrics.stage('id_mapping'):
+            self.allocator.complete(anon_values, file_fingerprint=file_fingerprint)
+        self.run_metrics.count('anonymized')
+        result.status = ANONYMIZED
+        result.dataset = ds
+        result.filename = filename
+        result.header = header
+        result.pixels = pixels
+        result.pixel_array = pixel_array
+        return result
+
+    def failed(self, result, error):
+        result.status = ERROR
+        result.error = error
+        self.run_metrics.count('errors')
+        logger.warning('WARNING - source: {} | message: {} {}'.format(str(result.source)[:256], str(error), str(type(error))))
+        return result
+
+    def anonymize_many(self, sources, buffers=True):
+        """
+        Anonymizes a batch of dicoms, each a file path, bytes or a pydicom dataset, and commits the link logs.
+        Returns the AnonymizedDicom of each, in order.
+        """
+        results = [self.anonymize(source, buffers) for source in sources]
+        self.allocator.commit()
+        return results
+
+    def close(self):
+        self.allocator.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,202 @@
+"""
+Archive input: dicoms packed in tar (optionally gzip, bzip2 or xz compressed) or zip archives are anonymized straight
+from the archives, without extracting them to disk first.
+
+Archives found while walking the input directory (or given as the input itself) are listed member by member: each
+member is a file of the archive's directory in the partition, with path <archive path>::<member name>, and is sniffed
+from its first bytes like any other file. Members are read whole into memory when they are anonymized, through archives
+kept open by each process.
+
+Uncompressed tars and zips are read by member offset. Compressed tars can only be read sequentially: members are read
+in order within a chunk, but the archive is decompressed again from its start whenever a member is read out of order,
+e.g. at the start of each chunk. Large archives are best packed as uncompressed tars or as zips.
+
+Tars have no index of their members, so that finding a member means walking (and for compressed tars, decompressing)
+the archive up to it. The offset and size of the members of each tar are indexed once per process, by the listing pass
+of the scan or on first read, and kept for the life of the process rather than with the open archive: an archive
+closed to make room for others is reopened without walking it again. Worker processes forked after the scan inherit
+the index of its listing pass. An index is dropped once its archive changes size or modification time.
+"""
+
+import os
+import tarfile
+import zipfile
+import threading
+from collections import OrderedDict
+
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+MEMBER_SEPARATOR = '::'
+# Bytes of each member read while listing an archive, enough to sniff it (see utils.sniff_header).
+HEAD_BYTES = 132
+# Number of archives kept open at once per process, least recently used archives are closed first.
+MAX_OPEN_ARCHIVES = 8
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_archive_file(path):
+    return os.path.isfile(path) and is_archive(path)
+
+
+def member_path(archive_path, name):
+    return '{}{}{}'.format(archive_path, MEMBER_SEPARATOR, name)
+
+
+def split_member(f):
+    """
+    Returns the archive path and member name of archive member path <f>, or None for other paths.
+    """
+    archive_path, separator, name = f.partition(MEMBER_SEPARATOR)
+    if not separator or not is_archive(archive_path):
+        return None
+    return archive_path, name
+
+
+def is_member(f):
+    return split_member(f) is not None
+
+
+def walk(dcm_directory, manifest=None):
+    """
+    Yields (root, file names) for the input <dcm_directory>, like os.walk, or through the scan manifest <manifest>.
+    An archive given as the input is yielded as the single file of its directory.
+    """
+    if is_archive_file(dcm_directory):
+        return iter([(os.path.dirname(dcm_directory) or '.', [os.path.basename(dcm_directory)])])
+    if manifest is not None:
+        return manifest.walk(dcm_directory)
+    return ((root, files) for root, dirs, files in os.walk(dcm_directory))
+
+
+def archive_version(archive_path):
+    st = os.stat(archive_path)
+    return st.st_size, st.st_mtime_ns
+
+
+def set_member_index(archive_path, version, members):
+    with member_indexes_lock:
+        member_indexes[archive_path] = (version, members)
+
+
+def get_member_index(archive_path, tar):
+    """
+    Returns the index {member name: (data offset, size)} of the regular files of tar <archive_path>, opened as <tar>,
+    indexing it unless it already was by this process.
+    """
+    version = archive_version(archive_path)
+    with member_indexes_lock:
+        indexed = member_indexes.get(archive_path)
+    if indexed is not None and indexed[0] == version:
+        return indexed[1]
+    # Index the members up to where a truncated archive is cut short, as list_members does.
+    members = {}
+    try:
+        for info in tar:
+            if info.isfile():
+                members[info.name] = (info.offset_data, info.size)
+    except (OSError, EOFError, tarfile.TarError):
+        pass
+    set_member_index(archive_path, version, members)
+    return members
+
+
+def list_members(archive_path):
+    """
+    Yields (member path, size, first HEAD_BYTES bytes) for each regular file of the archive <archive_path>, in the
+    archive's order. Members listed before an archive turns out to be corrupt or truncated are still yielded.
+    """
+    try:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with archive.open(info) as member:
+                        head = member.read(HEAD_BYTES)
+                    yield member_path(archive_path, info.filename), info.file_size, head
+        else:
+            # The members are indexed along the way, so that reading them does not walk the archive again.
+            # A listing stopped early leaves no index, while that of a truncated archive is complete as far as it goes.
+            version = archive_version(archive_path)
+            members = {}
+            with tarfile.open(archive_path, 'r:*') as archive:
+                try:
+                    for info in archive:
+                        if not info.isfile():
+                            continue
+                        members[info.name] = (info.offset_data, info.size)
+                        head = archive.extractfile(info).read(HEAD_BYTES)
+                        yield member_path(archive_path, info.name), info.size, head
+                except (OSError, EOFError, tarfile.TarError):
+                    set_member_index(archive_path, version, members)
+                    raise
+            set_member_index(archive_path, version, members)
+    except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile) as error:
+        print('Could not read archive {}: {}'.format(archive_path, error))
+
+
+class Archive(object):
+    """
+    An archive opened for reading members by name, one at a time.
+    """
+    def __init__(self, archive_path):
+        self.lock = threading.Lock()
+        if archive_path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(archive_path)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(archive_path, 'r:*')
+            self.members = get_member_index(archive_path, self.tar)
+
+    def read(self, name):
+        with self.lock:
+            if self.zip is not None:
+                return self.zip.read(name)
+            info = tarfile.TarInfo(name)
+            info.offset_data, info.size = self.members[name]
+            return self.tar.extractfile(info).read()
+
+    def close(self):
+        with self.lock:
+            (self.zip or self.tar).close()
+
+
+open_archives = OrderedDict()
+open_archives_lock = threading.Lock()
+# Member index of each tar, with the size and modification time of the archive it was built from.
+member_indexes = {}
+member_indexes_lock = threading.Lock()
+
+
+def read_member(f):
+    """
+    Returns the bytes of archive member <f>, given by its member path.
+    """
+    archive_path, name = split_member(f)
+    try:
+        return open_archive(archive_path).read(name)
+    except KeyError:
+        raise FileNotFoundError('No member {} in archive {}'.format(name, archive_path))
+    except OSError:
+        raise
+    except Exception as error:
+        # Corrupt, truncated, encrypted or unsupported members (EOFError, tarfile.TarError, zipfile.BadZipFile,
+        # zlib.error, RuntimeError, NotImplementedError...) are reported like a file which could not be read.
+        raise OSError('Could not read member {} of archive {}: {}'.format(name, archive_path, error))
+
+
+def open_archive(archive_path):
+    with open_archives_lock:
+        archive = open_archives.get(archive_path)
+        if archive is None:
+            if len(open_archives) >= MAX_OPEN_ARCHIVES:
+                _, oldest = open_archives.popitem(last=False)
+                oldest.close()
+            archive = Archive(archive_path)
+            open_archives[archive_path] = archive
+        else:
+            open_archives.move_to_end(archive_path)
+    return archive
@@ -0,0 +1,243 @@
+"""
+Benchmark of the anonymizers on synthetic dicom corpora.
+
+A corpus is generated with pydicom from a seed, so that the same settings always produce the same corpus:
+- --files dicoms in --dirs directories, with series spread over directories according to a Zipf distribution of
+exponent --skew (0 for even directories, larger values pile most series into a few directories),
+- --rows x --columns 16 bit images of --frames frames, in a mix of --transfer_syntaxes
+(explicit, implicit, big, deflated, rle),
+- a fraction --duplicate_rate of additional copies of dicoms, and --noise_rate of non-dicom files.
+Corpora are cached in the work directory, keyed by their settings.
+
+Each entry point (serial and/or mp) is then run --repeat times on the corpus, with fresh output and linking log folders,
+and any --args passed on. The run's metrics (see runMetrics.py) are collected through --metrics_file.
+One json record per run is appended to the --results file, with the settings, the environment and the metrics:
+files/s, MB/s, and the time spent per stage (scan, read, parse, id_mapping, build_header, pixel_decode, pixel_export,
+header_write).
+
+Usage:
+python3 benchmark.py --files 1000 --dirs 20 --skew 1 --transfer_syntaxes explicit,rle --scripts serial,mp --args "-w 4"
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import datetime
+import subprocess
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (ExplicitVRLittleEndian, ImplicitVRLittleEndian, ExplicitVRBigEndian,
+                         DeflatedExplicitVRLittleEndian, RLELossless, SecondaryCaptureImageStorage)
+
+import utils
+
+TRANSFER_SYNTAXES = {'explicit': ExplicitVRLittleEndian,
+                     'implicit': ImplicitVRLittleEndian,
+                     'big': ExplicitVRBigEndian,
+                     'deflated': DeflatedExplicitVRLittleEndian,
+                     'rle': RLELossless}
+SCRIPTS = {'serial': 'dcmAnonymizerV02.py',
+           'mp': 'dcmAnonymizerV02MP.py'}
+
+# Corpus hierarchy: instances per series, series per study. Each patient has a single study.
+SERIES_SIZE = 4
+STUDY_SIZE = 2
+NOISE_SIZE = 4096
+
+
+def make_uid(rng):
+    return '2.25.{}'.format(rng.getrandbits(96))
+
+
+def make_dicom(file_name, ids, transfer_syntax, pixel_array, rng):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    file_meta.MediaStorageSOPInstanceUID = ids['sop']
+    file_meta.TransferSyntaxUID = transfer_syntax
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.PatientID = ids['patient']
+    ds.PatientName = 'Synthetic^{}'.format(ids['patient'])
+    ds.PatientBirthDate = '19{:02d}0101'.format(rng.randrange(30, 90))
+    ds.PatientSex = rng.choice(('F', 'M'))
+    ds.AccessionNumber = ids['accession']
+    ds.StudyInstanceUID = ids['study']
+    ds.SeriesInstanceUID = ids['series']
+    ds.SOPInstanceUID = ids['sop']
+    ds.StudyDate = '20200101'
+    ds.Modality = 'OT'
+    ds.SeriesNumber = ids['series_number']
+    ds.InstanceNumber = ids['instance_number']
+
+    frames = pixel_array.shape[0]
+    ds.Rows, ds.Columns = pixel_array.shape[1:]
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+
+    if transfer_syntax.is_compressed:
+        ds.compress(transfer_syntax, pixel_array if frames > 1 else pixel_array[0])
+    else:
+        ds.PixelData = pixel_array.astype('<u2' if transfer_syntax.is_little_endian else '>u2').tobytes()
+    ds.save_as(file_name, enforce_file_format=True)
+
+
+def generate_corpus(corpus_dir, n_files, n_dirs, skew, rows, columns, frames, transfer_syntaxes, duplicate_rate,
+                    noise_rate, seed):
+    rng = random.Random(seed)
+    np_rng = np.random.RandomState(seed)
+    directories = [os.path.join(corpus_dir, 'd{:04d}'.format(i_dir)) for i_dir in range(n_dirs)]
+    for directory in directories:
+        utils.make_dirs(directory)
+    weights = [1.0/(i_dir + 1)**skew for i_dir in range(n_dirs)]
+
+    # Smooth images with noise, which compress about as well as typical radiographs.
+    gradient = (np.add.outer(np.arange(rows), np.arange(columns))*(4095 - 64)//max(1, rows + columns - 2)).astype(np.uint16)
+
+    dicoms = []
+    ids = None
+    for i_file in range(n_files):
+        if i_file % (SERIES_SIZE*STUDY_SIZE) == 0:
+            patient = i_file//(SERIES_SIZE*STUDY_SIZE)
+            ids = {'patient': 'PID{:08d}'.format(patient), 'accession': 'ACC{:08d}'.format(patient),
+                   'study': make_uid(rng), 'series_number': 0}
+        if i_file % SERIES_SIZE == 0:
+            ids['series'] = make_uid(rng)
+            ids['series_number'] += 1
+            ids['instance_number'] = 0
+            directory = rng.choices(directories, weights)[0]
+        ids['sop'] = make_uid(rng)
+        ids['instance_number'] += 1
+
+        pixel_array = gradient + np_rng.randint(0, 64, size=(frames, rows, columns)).astype(np.uint16)
+        transfer_syntax = TRANSFER_SYNTAXES[rng.choice(transfer_syntaxes)]
+        file_name = os.path.join(directory, 'i{:08d}.dcm'.format(i_file))
+        make_dicom(file_name, ids, transfer_syntax, pixel_array, rng)
+        dicoms.append(file_name)
+
+    for i_duplicate in range(int(round(n_files*duplicate_rate))):
+        original = rng.choice(dicoms)
+        shutil.copyfile(original, os.path.join(os.path.dirname(original), 'dup{:08d}.dcm'.format(i_duplicate)))
+
+    for i_noise in range(int(round(n_files*noise_rate))):
+        with open(os.path.join(rng.choice(directories), 'noise{:08d}.txt'.format(i_noise)), 'wb') as outfile:
+            outfile.write(rng.getrandbits(8*NOISE_SIZE).to_bytes(NOISE_SIZE, 'little'))
+
+
+def get_corpus(work_dir, settings):
+    """
+    Returns the directory of the corpus with the given settings, generating it unless it is already cached.
+    """
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+    corpus_dir = os.path.join(work_dir, 'corpus_{}'.format(key))
+    if utils.load_json(os.path.join(corpus_dir, 'corpus.json')) != settings:
+        print('Generating corpus in {}.'.format(corpus_dir))
+        if os.path.isdir(corpus_dir):
+            shutil.rmtree(corpus_dir)
+        start_time = time.time()
+        generate_corpus(os.path.join(corpus_dir, 'data'), **settings)
+        print('Generated corpus in {} seconds.'.format(round(time.time() - start_time, 2)))
+        utils.save_json(settings, os.path.join(corpus_dir, 'corpus.json'))
+    return corpus_dir
+
+
+def run_script(script, corpus_dir, run_dir, extra_args):
+    """
+    Runs an anonymizer on the corpus, in a clean <run_dir>. Returns the run's wall time and metrics.
+    """
+    # The anonymizers write their stdout folder to the working directory, so all paths are made absolute.
+    corpus_dir, run_dir = os.path.abspath(corpus_dir), os.path.abspath(run_dir)
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    utils.make_dirs(run_dir)
+    metrics_file = os.path.join(run_dir, 'metrics.json')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[script]),
+               '-d', os.path.join(corpus_dir, 'data'), '-o', os.path.join(run_dir, 'out'), '-l', os.path.join(run_dir, 'linklog'),
+               '-g', 'a', '--metrics_file', metrics_file] + extra_args
+
+    start_time = time.time()
+    process = subprocess.run(command, cwd=run_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall_seconds = time.time() - start_time
+    if process.returncode != 0:
+        print(process.stderr.decode(errors='replace'))
+        raise RuntimeError('{} exited with code {}'.format(SCRIPTS[script], process.returncode))
+    return wall_seconds, utils.load_json(metrics_file)
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the anonymizers on a synthetic dicom corpus")
+    parser.add_argument("--files", type=int, default=200, help="Number of distinct dicoms")
+    parser.add_argument("--dirs", type=int, default=8, help="Number of directories")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the number of series per directory")
+    parser.add_argument("--rows", type=int, default=256, help="Image rows")
+    parser.add_argument("--columns", type=int, default=256, help="Image columns")
+    parser.add_argument("--frames", type=int, default=1, help="Frames per dicom")
+    parser.add_argument("--transfer_syntaxes", type=str, default='explicit',
+                        help="Comma-separated transfer syntaxes, among {}".format(', '.join(TRANSFER_SYNTAXES)))
+    parser.add_argument("--duplicate_rate", type=float, default=0.0, help="Additional copies of dicoms, as a fraction of --files")
+    parser.add_argument("--noise_rate", type=float, default=0.0, help="Non-dicom files, as a fraction of --files")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus generator")
+    parser.add_argument("--scripts", type=str, default='serial,mp', help="Comma-separated entry points to run, among serial, mp")
+    parser.add_argument("--args", type=str, default='', help="Additional arguments passed on to the entry points")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each entry point")
+    parser.add_argument("--work_dir", type=str, default='./benchmark', help="Directory of the corpora and runs")
+    parser.add_argument("--results", type=str, default='./benchmark/results.jsonl', help="File the json records of the runs are appended to")
+    args = parser.parse_args()
+
+    for transfer_syntax in args.transfer_syntaxes.split(','):
+        if transfer_syntax not in TRANSFER_SYNTAXES:
+            parser.error('unknown transfer syntax {}'.format(transfer_syntax))
+    for script in args.scripts.split(','):
+        if script not in SCRIPTS:
+            parser.error('unknown script {}'.format(script))
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    utils.make_dirs(args.work_dir)
+
+    settings = {'n_files': args.files, 'n_dirs': args.dirs, 'skew': args.skew, 'rows': args.rows, 'columns': args.columns,
+                'frames': args.frames, 'transfer_syntaxes': args.transfer_syntaxes.split(','),
+                'duplicate_rate': args.duplicate_rate, 'noise_rate': args.noise_rate, 'seed': args.seed}
+    corpus_dir = get_corpus(args.work_dir, settings)
+    environment = get_environment()
+
+    utils.make_dirs(os.path.dirname(os.path.abspath(args.results)))
+    for script in args.scripts.split(','):
+        for i_repeat in range(args.repeat):
+            wall_seconds, metrics = run_script(script, corpus_dir, os.path.join(args.work_dir, 'run_{}'.format(script)),
+                                               shlex.split(args.args))
+            record = {'time': str(datetime.datetime.now()), 'script': script, 'args': args.args, 'repeat': i_repeat,
+                      'corpus': settings, 'environment': environment, 'wall_seconds': wall_seconds, 'metrics': metrics}
+            with open(args.results, 'a') as outfile:
+                outfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+            stages = ', '.join('{} {}s'.format(stage, round(values['seconds'], 2)) for stage, values in metrics['stages'].items())
+            print('{} run {}: {} files/s, {} MB/s | {}'.format(script, i_repeat, round(metrics['files_per_second'], 1),
+                                                            round(metrics['mb_per_second'], 2), stages))
@@ -0,0 +1,36 @@
+"""
+Periodic checkpoints of a run's progress, so that a killed run resumes from its last checkpoint instead of from scratch.
+
+A checkpoint commits the link logs (see linkLog.py), then atomically rewrites partition.json with the dicoms not yet
+anonymized. The link logs are always persisted first: the saved partition never omits a dicom whose anonymized
+identifiers could still be lost, so a resumed run assigns the same identifiers as the interrupted one.
+"""
+
+import os
+import time
+
+import utils
+
+# Default number of seconds between checkpoints.
+CHECKPOINT_INTERVAL = 60
+
+
+class Checkpointer(object):
+    def __init__(self, allocator, link_log_path, interval=CHECKPOINT_INTERVAL):
+        self.allocator = allocator
+        self.partition_file = os.path.join(link_log_path, 'partition.json')
+        self.interval = interval
+        self.last_checkpoint = time.time()
+
+    def is_due(self):
+        return bool(self.interval) and time.time() - self.last_checkpoint >= self.interval
+
+    def save(self, partition=None):
+        """
+        Commits the link logs and, if given, saves <partition> as the remaining work.
+        The partition must not be modified while it is saved.
+        """
+        self.allocator.commit()
+        if partition is not None:
+            utils.save_json(partition, self.partition_file)
+        self.last_checkpoint = time.time()
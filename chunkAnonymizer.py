@@ -0,0 +1,174 @@
+"""
+Anonymization of chunks of dicoms, shared by dcmAnonymizerV02.py and dcmAnonymizerV02MP.py.
+
+anonymize_files runs the per-file loop of a chunk: read ahead, fingerprint, parse, identifier mapping, and writing.
+It runs in the program's process, or in a worker process of the multiprocessing program.
+ChunkProgress keeps the bookkeeping of the chunks of a run in the program's process: the partition of the dicoms not yet
+anonymized, the output space reserved for the chunks, and the periodic checkpoints.
+"""
+
+import logging
+import functools
+import threading
+
+import constructDicom
+import fingerprint
+import outputWriter
+import prefetch
+import runMetrics
+import scheduler
+import spaceManager
+from idAllocator import DICOM_FIELDS, IDENTIFIER_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+def write_done(allocator, run_metrics, f, values, anon_values, file_fingerprint=None, error=None):
+    # Confirm the dicom to the allocator once its files are written, or release its identifiers if they could not be.
+    if error is None:
+        with run_metrics.stage('id_mapping'):
+            allocator.complete(anon_values, file_fingerprint=file_fingerprint)
+        run_metrics.count('anonymized')
+    else:
+        allocator.complete(anon_values, success=False)
+        run_metrics.count('errors')
+        if spaceManager.is_out_of_space(error):
+            run_metrics.count('out_of_space')
+        logger.warning('WARNING - file: {} | message: {} {} {} . This warning is for case {} with anon_values {} .'
+                       .format(str(f), str(error), str(type(error)), str(error.__traceback__.tb_lineno if error.__traceback__ else ''),
+                               str(values), str(anon_values)))
+
+
+def read_failed(run_metrics, f, error):
+    run_metrics.count('errors')
+    logger.warning('WARNING - file: {} | message: {} {} {} . The file could not be read.'
+                   .format(str(f), str(error), str(type(error)), str(error.__traceback__.tb_lineno if error.__traceback__ else '')))
+
+
+def anonymize_files(allocator, chunk, out_dir, grouping, export_options, shards, prefetch_bytes=prefetch.PREFETCH_BYTES,
+                    run_metrics=None):
+    """
+    Anonymizes the dicoms of <chunk> to <out_dir>, counting them in <run_metrics>, which is returned.
+    Dicoms are confirmed to <allocator> once their files are written, all of them before this returns.
+    """
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+    raw_files = set(chunk['raw'])
+    sizes = dict(zip(chunk['files'], chunk['sizes']))
+    # Output files are written in the background, and each dicom is confirmed once its files are in place.
+    writer = outputWriter.open_writer(export_options, run_metrics)
+    # Files already seen are skipped by their fingerprint, before being parsed.
+    fingerprints = fingerprint.FingerprintIndex(allocator)
+    # The next files are read in the background while the current one is anonymized. Only their heads are read ahead
+    # when they may be skipped by fingerprint, so that skipped files are never read in full.
+    prefetcher = prefetch.Prefetcher(chunk['files'], chunk['sizes'], prefetch_bytes, run_metrics=run_metrics,
+                                     head_bytes=fingerprint.FINGERPRINT_BYTES if fingerprints.is_enabled else None)
+    for f, source in prefetcher:
+        run_metrics.count('files')
+        run_metrics.count('bytes', sizes[f])
+        # A file which cannot be read or parsed is counted as an error, and the rest of the chunk goes on.
+        try:
+            file_fingerprint = None
+            if fingerprints.is_enabled:
+                with run_metrics.stage('fingerprint'):
+                    file_fingerprint, is_known = fingerprints.check(f, source, sizes[f])
+                if is_known:
+                    run_metrics.count('duplicates')
+                    run_metrics.count('fingerprint_skips')
+                    continue
+                source = prefetcher.whole(f, source)
+
+            with run_metrics.stage('parse'):
+                ds = constructDicom.read_dicom(source, force=f in raw_files)
+        except Exception as error:
+            read_failed(run_metrics, f, error)
+            continue
+
+        # Check if requisite tags exist
+        is_valid_dicom_image = True
+        for dicom_field in DICOM_FIELDS:
+            if dicom_field not in ds:
+                logger.warning("WARNING - file: {} | {} not in DICOM tags".format(str(f), dicom_field))
+                is_valid_dicom_image = False
+
+        if is_valid_dicom_image:
+            values = (str(ds.PatientID).upper(), str(ds.AccessionNumber).upper(), str(ds.StudyInstanceUID).upper(),
+                      str(ds.SeriesInstanceUID).upper(), str(ds.SOPInstanceUID).upper())
+
+            # Look up or create the anonymous keys of all identifiers in a single request to the allocator.
+            with run_metrics.stage('id_mapping'):
+                anon_values, is_duplicate = allocator.assign(values, file_fingerprint)
+
+            # If combination of keys already exists in the cache, skip the current dicom.
+            if is_duplicate:
+                run_metrics.count('duplicates')
+                dicom_tuple = tuple(anon_values[IDENTIFIER_FIELDS[i_iter]] for i_iter in range(len(IDENTIFIER_FIELDS)))
+                print('mrn-accession-studyID-seriesID-sopID tuple {} has already been anonymized.'.format(str(dicom_tuple)))
+                logger.warning('mrn-accession-studyID-seriesID-sopID tuple {} has already been anonymized.'.format(str(dicom_tuple)))
+            else:
+                try:
+                    constructDicom.write_dicom(ds, anon_values, out_dir, grouping, export_options, shards, run_metrics, writer,
+                                               functools.partial(write_done, allocator, run_metrics, f, values, anon_values,
+                                                                 file_fingerprint))
+                except Exception as error:
+                    write_done(allocator, run_metrics, f, values, anon_values, file_fingerprint, error)
+        else:
+            run_metrics.count('invalid')
+
+    # Wait for the chunk's files to be written, so that its dicoms are all confirmed when the chunk completes.
+    writer.close()
+    return run_metrics
+
+
+class ChunkProgress(object):
+    """
+    Bookkeeping of the chunks of a run: <partition> holds the dicoms not yet anonymized, output space is reserved
+    for chunks in <space> (see spaceManager.py), and checkpoints are taken by <checkpointer> as chunks complete.
+    While <is_walking>, the partition only holds the chunks discovered so far, and checkpoints only commit the link logs:
+    a partial partition would hide the dicoms not yet discovered from the next run.
+    Chunks may complete on other threads than the one adding them.
+    """
+    def __init__(self, partition, space, checkpointer, run_metrics, is_walking=False):
+        self.partition = partition
+        self.space = space
+        self.checkpointer = checkpointer
+        self.run_metrics = run_metrics
+        self.is_walking = is_walking
+        self.lock = threading.Lock()
+
+    def add(self, chunk):
+        # Record a discovered chunk as remaining work until it has been anonymized.
+        with self.lock:
+            scheduler.add_chunk(self.partition, chunk)
+            self.run_metrics.add_remaining([chunk])
+
+    def walk_done(self):
+        with self.lock:
+            self.is_walking = False
+
+    def done(self, chunk, out_dir, reservation, bytes_written, out_of_space):
+        """
+        Records a chunk written to <out_dir>, releasing its <reservation>. Returns False if it ran out of space, in which
+        case the output directory is marked full, and the chunk should be written again to the next one.
+        """
+        self.space.release(out_dir, reservation, chunk['size'], bytes_written)
+        # Remove the chunk's dicoms from further consideration, unless it could not be written.
+        # Dicoms are confirmed to the allocator before their chunk completes, so a checkpoint taken here
+        # has committed the identifiers of every dicom removed from the partition.
+        with self.lock:
+            if out_of_space:
+                self.space.mark_full(out_dir)
+            else:
+                scheduler.remove_chunk(self.partition, chunk)
+                self.run_metrics.remove_remaining([chunk])
+            if self.checkpointer.is_due():
+                self.checkpointer.save(None if self.is_walking else self.partition)
+        return not out_of_space
+
+    def failed(self, chunk, out_dir, reservation, error):
+        # Release the chunk's reservation, or its space would stay reserved for the rest of the run. Its input bytes
+        # are not recorded, as the bytes it wrote are unknown and would skew the estimated output sizes.
+        # The chunk stays in the partition, to be anonymized again by the next run.
+        logger.warning('WARNING - chunk of {} files in {} failed | message: {} {}'
+                       .format(len(chunk['files']), out_dir, str(error), str(type(error))))
+        self.space.release(out_dir, reservation, 0, 0)
@@ -0,0 +1,136 @@
+"""
+Codec registry: the pixel data decoder of each transfer syntax, chosen and imported on first use.
+
+Uncompressed dicoms are decoded by the native pixel path of pixelExport.py, which needs no codec. For other transfer
+syntaxes, the first dicom of a syntax seen by a process picks a decoder among those installed for it: if several are,
+each decodes the first TIMING_FRAMES frames of that dicom, TIMING_RUNS times, and the fastest one which succeeds is
+chosen. The choice is cached for the rest of the process: later dicoms of that syntax go straight to that decoder,
+instead of pydicom trying its decoders in turn. Codec packages are only imported by the handlers which
+need them, when a dicom needs them, so that workers anonymizing uncompressed dicoms never import them, and a missing
+codec is reported once per process, for the transfer syntax which needs it, rather than on every startup.
+
+Decoders are pydicom's decoding plugins (pydicom 3), or its pixel data handlers with older versions of pydicom, which
+cannot decode single frames: the first handler installed, in the order of HANDLER_PREFERENCE, is chosen instead.
+Decode times are recorded per transfer syntax and decoder in the run metrics (see runMetrics.py).
+"""
+
+import time
+import importlib
+
+# Frames of the first dicom of a transfer syntax decoded by each candidate decoder, and number of timed runs of each.
+TIMING_FRAMES = 2
+TIMING_RUNS = 2
+# Pixel data handlers of older versions of pydicom, in order of preference.
+HANDLER_PREFERENCE = ('jpeg_ls_handler', 'pylibjpeg_handler', 'gdcm_handler', 'rle_handler', 'pillow_handler', 'numpy_handler')
+NATIVE_DECODER = 'native'
+# Decoder name recorded when the choice is left to pydicom, e.g. for transfer syntaxes without an installed decoder.
+DEFAULT_DECODER = 'pydicom_default'
+
+# Decoder chosen for each transfer syntax by this process, None to leave the choice to pydicom.
+decoders = {}
+
+
+def transfer_syntax_of(ods):
+    return str(ods.file_meta.TransferSyntaxUID) if "TransferSyntaxUID" in ods.file_meta else None
+
+
+def time_decoders(decoder, ods, names):
+    """
+    Decodes the first frames of dicom <ods> with each of the decoding plugins <names> of <decoder>. Returns the
+    shortest time each took, for those which succeeded.
+    """
+    frames = int(ods.get('NumberOfFrames') or 1)
+    times = {}
+    for name in names:
+        try:
+            best = None
+            for _ in range(TIMING_RUNS):
+                start = time.perf_counter()
+                for index in range(min(frames, TIMING_FRAMES)):
+                    decoder.as_array(ods, index=index, decoding_plugin=name)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times[name] = best
+        except Exception as error:
+            print('Pixel data decoder {} failed on transfer syntax {}: {}'.format(name, transfer_syntax_of(ods), error))
+    return times
+
+
+def find_decoder(ods):
+    """
+    Returns the fastest decoder installed for the transfer syntax of dicom <ods>, timed on its first frames,
+    or None if none is known to be installed.
+    """
+    transfer_syntax = transfer_syntax_of(ods)
+    try:
+        from pydicom.pixels import get_decoder
+    except ImportError:
+        get_decoder = None
+
+    if get_decoder is not None:
+        try:
+            decoder = get_decoder(transfer_syntax)
+        except NotImplementedError:
+            print('No pixel data decoder is known for transfer syntax {}.'.format(transfer_syntax))
+            return None
+        if decoder.is_native:
+            return None
+        names = list(decoder.available_plugins)
+        if not names:
+            print('No pixel data decoder of transfer syntax {} is installed: {}.'
+                  .format(transfer_syntax, '; '.join(decoder.missing_dependencies)))
+            return None
+        if len(names) == 1:
+            return names[0]
+        times = time_decoders(decoder, ods, names)
+        if not times:
+            return None
+        name = min(times, key=times.get)
+        print('Decoding transfer syntax {} with {} ({}).'.format(
+            transfer_syntax, name, ', '.join('{} {:.1f} ms'.format(n, 1000*t) for n, t in sorted(times.items(), key=lambda item: item[1]))))
+        return name
+
+    for name in HANDLER_PREFERENCE:
+        try:
+            handler = importlib.import_module('pydicom.pixel_data_handlers.{}'.format(name))
+        except ImportError:
+            continue
+        if handler.is_available() and handler.supports_transfer_syntax(transfer_syntax):
+            return name
+    print('No pixel data handler of transfer syntax {} is installed.'.format(transfer_syntax))
+    return None
+
+
+def decoder_for(ods):
+    transfer_syntax = transfer_syntax_of(ods)
+    if transfer_syntax not in decoders:
+        decoders[transfer_syntax] = find_decoder(ods) if transfer_syntax is not None else None
+    return decoders[transfer_syntax]
+
+
+def decode(ods):
+    """
+    Decodes the pixel array of dicom <ods> with the decoder of its transfer syntax. Returns the pixel array, as
+    ods.pixel_array, and the name of the decoder.
+    """
+    name = decoder_for(ods)
+    if name is None:
+        return ods.pixel_array, DEFAULT_DECODER
+    if hasattr(ods, 'pixel_array_options'):
+        ods.pixel_array_options(decoding_plugin=name)
+    else:
+        ods.convert_pixel_data(handler_name=name)
+    return ods.pixel_array, name
+
+
+def iter_options(ods):
+    """
+    Keyword arguments of pydicom.pixels.iter_pixels decoding the frames of <ods> with the decoder of its transfer syntax.
+    """
+    name = decoder_for(ods)
+    return {'decoding_plugin': name} if name is not None else {}
+
+
+def record(run_metrics, ods, decoder, start):
+    if run_metrics is not None:
+        run_metrics.record_decode(transfer_syntax_of(ods), decoder, time.perf_counter() - start)
@@ -0,0 +1,231 @@
+"""
+Compact in-memory index of the json link logs, for link logs of tens of millions of entries.
+
+A dict of str to int costs well over 100 bytes per entry (the str and int objects, and the dict's own slots).
+A CompactMap instead stores its keys back to back as bytes in an arena, its values in an array of 64 bit integers, and
+an open addressing hash table (with linear probing on the crc32 of the packed key) of 32 bit entry numbers, for about
+30 bytes per entry on top of the packed key:
+- UIDs and other keys made of digits and dots (most PatientIDs) are packed two characters per byte.
+- link_master_log keys, str(tuple) of anonymized identifiers, e.g. "(1, 2, 3, 4, 5)", are packed as their integers,
+also two digits (or separators) per byte.
+- Fingerprints (hex digests) are packed as their bytes.
+- Other keys are stored as utf-8.
+Keys and values are packed and unpacked at the interface, which has the same semantics as the dict it replaces.
+
+The json files are read and written line by line, in the format of utils.save_json, without ever holding a whole link
+log as a dict. Files are written in insertion order rather than sorted, and remain readable by json.load.
+"""
+
+import os
+import re
+import json
+import zlib
+import array
+
+# Marker bytes of packed keys. They never start a utf-8 encoded key.
+DIGITS_KEY = 0xFF
+TUPLE_KEY = 0xFE
+HEX_KEY = 0xFD
+
+DIGITS_PATTERN = re.compile(r'[0-9.]+')
+TUPLE_PATTERN = re.compile(r'\(-?\d+(, -?\d+)+\)')
+HEX_PATTERN = re.compile(r'(?:[0-9a-f]{2})+')
+# Digits and dots are packed as the hexadecimal digits 0-9 and a, padded with f. Tuples of integers are packed the
+# same way, with a separating the integers and b as the minus sign.
+
+# Number of identifiers in the tuple values of link_fingerprint_log.
+TUPLE_WIDTH = 5
+
+INITIAL_SLOTS = 8
+# The hash table is doubled once more than this fraction of its slots are used.
+MAX_LOAD = 0.6
+# Bytes per entry assumed when sizing a map for a json file, to avoid rehashing while it is loaded.
+LOADED_LINE_BYTES = 64
+WRITE_BATCH = 10000
+
+
+def pack_key(key):
+    if DIGITS_PATTERN.fullmatch(key):
+        digits = key.replace('.', 'a')
+        if len(digits) % 2:
+            digits += 'f'
+        return bytes((DIGITS_KEY,)) + bytes.fromhex(digits)
+    if TUPLE_PATTERN.fullmatch(key):
+        digits = key[1:-1].replace(', ', 'a').replace('-', 'b')
+        if len(digits) % 2:
+            digits += 'f'
+        return bytes((TUPLE_KEY,)) + bytes.fromhex(digits)
+    if HEX_PATTERN.fullmatch(key):
+        return bytes((HEX_KEY,)) + bytes.fromhex(key)
+    return key.encode('utf-8')
+
+
+def unpack_key(packed):
+    marker = packed[0] if packed else None
+    if marker == DIGITS_KEY:
+        return packed[1:].hex().rstrip('f').replace('a', '.')
+    if marker == TUPLE_KEY:
+        return '({})'.format(', '.join(packed[1:].hex().rstrip('f').replace('b', '-').split('a')))
+    if marker == HEX_KEY:
+        return packed[1:].hex()
+    return packed.decode('utf-8')
+
+
+class CompactMap(object):
+    """
+    Map of str keys to int values (or, with <value_width>, to str(tuple) values of that many ints).
+    Entries are never removed. At most 2**31 entries.
+    """
+    def __init__(self, value_width=None, n_entries=0):
+        self.value_width = value_width
+        self.arena = bytearray()
+        # Key i is arena[offsets[i]:offsets[i + 1]].
+        self.offsets = array.array('q', [0])
+        self.hashes = array.array('I')
+        self.data = array.array('q')
+        n_slots = INITIAL_SLOTS
+        while n_slots*MAX_LOAD < n_entries:
+            n_slots *= 2
+        self.table = array.array('i', [-1])*n_slots
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def find(self, packed, key_hash):
+        """
+        Returns the entry of packed key <packed> (-1 if there is none), and its slot in the hash table.
+        """
+        mask = len(self.table) - 1
+        slot = key_hash & mask
+        while True:
+            entry = self.table[slot]
+            if entry < 0 or (self.hashes[entry] == key_hash and
+                             self.arena[self.offsets[entry]:self.offsets[entry + 1]] == packed):
+                return entry, slot
+            slot = (slot + 1) & mask
+
+    def rehash(self, n_slots):
+        table = array.array('i', [-1])*n_slots
+        mask = n_slots - 1
+        for entry, key_hash in enumerate(self.hashes):
+            slot = key_hash & mask
+            while table[slot] >= 0:
+                slot = (slot + 1) & mask
+            table[slot] = entry
+        self.table = table
+
+    def pack_value(self, value):
+        if self.value_width is None:
+            return (value,)
+        values = tuple(int(item) for item in value[1:-1].split(','))
+        if len(values) != self.value_width:
+            raise ValueError('Expected a tuple of {} identifiers, got {}'.format(self.value_width, value))
+        return values
+
+    def value(self, entry):
+        if self.value_width is None:
+            return self.data[entry]
+        start = entry*self.value_width
+        return str(tuple(self.data[start:start + self.value_width]))
+
+    def get(self, key, default=None):
+        packed = pack_key(key)
+        entry, _ = self.find(packed, zlib.crc32(packed))
+        return self.value(entry) if entry >= 0 else default
+
+    def __contains__(self, key):
+        packed = pack_key(key)
+        return self.find(packed, zlib.crc32(packed))[0] >= 0
+
+    def __getitem__(self, key):
+        packed = pack_key(key)
+        entry, _ = self.find(packed, zlib.crc32(packed))
+        if entry < 0:
+            raise KeyError(key)
+        return self.value(entry)
+
+    def __setitem__(self, key, value):
+        packed = pack_key(key)
+        key_hash = zlib.crc32(packed)
+        values = self.pack_value(value)
+        entry, slot = self.find(packed, key_hash)
+        if entry >= 0:
+            start = entry*len(values)
+            self.data[start:start + len(values)] = array.array('q', values)
+            return
+        entry = len(self.hashes)
+        self.arena += packed
+        self.offsets.append(len(self.arena))
+        self.hashes.append(key_hash)
+        self.data.extend(values)
+        self.table[slot] = entry
+        if len(self.hashes) > len(self.table)*MAX_LOAD:
+            self.rehash(2*len(self.table))
+
+    def keys(self):
+        for entry in range(len(self.hashes)):
+            yield unpack_key(bytes(self.arena[self.offsets[entry]:self.offsets[entry + 1]]))
+
+    def values(self):
+        for entry in range(len(self.hashes)):
+            yield self.value(entry)
+
+    def items(self):
+        for entry in range(len(self.hashes)):
+            yield unpack_key(bytes(self.arena[self.offsets[entry]:self.offsets[entry + 1]])), self.value(entry)
+
+    def __iter__(self):
+        return self.keys()
+
+
+def load(file_name, value_width=None):
+    """
+    Loads the json link log <file_name> into a CompactMap, line by line if it was written by utils.save_json or save(),
+    or through json.load otherwise.
+    """
+    compact_map = CompactMap(value_width, os.path.getsize(file_name)//LOADED_LINE_BYTES)
+    try:
+        with open(file_name, encoding='utf-8') as infile:
+            for line in infile:
+                line = line.strip()
+                if line in ('{', '}', '{}'):
+                    continue
+                if line.endswith(','):
+                    line = line[:-1]
+                key, separator, value = line.rpartition(': ')
+                if not separator or len(key) < 2 or key[0] != '"' or key[-1] != '"':
+                    raise ValueError('Unexpected line {}'.format(line))
+                key = key[1:-1] if '\\' not in key else json.loads(key)
+                compact_map[key] = int(value) if value_width is None else json.loads(value)
+    except ValueError:
+        compact_map = CompactMap(value_width)
+        with open(file_name, encoding='utf-8') as infile:
+            for key, value in json.load(infile).items():
+                compact_map[key] = value
+    return compact_map
+
+
+def save(compact_map, file_name):
+    """
+    Writes <compact_map> to <file_name> in the format of utils.save_json, through a temporary file.
+    """
+    temp_file_name = '{}.tmp'.format(file_name)
+    with open(temp_file_name, 'w') as outfile:
+        if not len(compact_map):
+            outfile.write('{}')
+        else:
+            outfile.write('{\n')
+            separator = ''
+            lines = []
+            for key, value in compact_map.items():
+                lines.append('    {}: {}'.format(json.dumps(key), value if compact_map.value_width is None else json.dumps(value)))
+                if len(lines) >= WRITE_BATCH:
+                    outfile.write(separator + ',\n'.join(lines))
+                    separator = ',\n'
+                    lines = []
+            if lines:
+                outfile.write(separator + ',\n'.join(lines))
+            outfile.write('\n}')
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_file_name, file_name)
@@ -1,6 +1,28 @@
 import argparse
 
 
+def positive_int(value):
+    """
+    Argument type of a strictly positive integer.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not an integer'.format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return number
+
+
+def workers(value):
+    """
+    Argument type of --workers: a positive number of workers, or auto.
+    """
+    if value == 'auto':
+        return value
+    return positive_int(value)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Anonymizes DICOM directory")
     parser.add_argument("-d",
@@ -11,8 +33,10 @@ def parse_args():
     parser.add_argument("-o",
                         "--output_dir",
                         type=str,
-                        default='./anondata',
-                        help="Output DICOM directory path")
+                        nargs='+',
+                        default=['./anondata'],
+                        help="Output DICOM directory path. Several directories (e.g. on different volumes) are filled "
+                             "in order, moving on to the next once one is full")
     parser.add_argument("-l",
                         "--link_log_dir",
                         type=str,
@@ -25,6 +49,126 @@ def parse_args():
                         help="Group output dicoms into subfolders by"
                              "anonymized accession number (a), Study Instance UID (s), MRN (m),"
                              "or do not group into subfolders at all (n)")
+    parser.add_argument("-b",
+                        "--link_log_backend",
+                        type=str,
+                        default='json',
+                        choices=['json', 'sqlite', 'none'],
+                        help="Link log storage: whole-file json dumps (json), "
+                             "an incrementally committed sqlite database (sqlite), "
+                             "or no link logs at all, only with --id_mode hmac (none)")
+    parser.add_argument("-c",
+                        "--codec",
+                        type=str,
+                        default='gzip',
+                        help="Compression of the exported pixel arrays: none, lzf, gzip[:level], "
+                             "or blosc[:compressor[:level]] and lz4 (both require hdf5plugin)")
+    parser.add_argument("--chunks",
+                        type=str,
+                        default='auto',
+                        help="HDF5 chunk shape of the exported pixel arrays: auto, frame, or comma-separated dimensions")
+    parser.add_argument("--output_mode",
+                        type=str,
+                        default='files',
+                        choices=['files', 'shard', 'tar'],
+                        help="Write one .dcm and one .hdf5 file per instance (files), append instances to hdf5 shards "
+                             "(shard), or pack their .dcm and .hdf5 files into indexed tar shards (tar)")
+    parser.add_argument("--shard_by",
+                        type=str,
+                        default='group',
+                        choices=['group', 'series'],
+                        help="Key of the hdf5 or tar shards: a single stream of shards per process, with the output grouping "
+                             "given by -g recorded in their index (group), or a stream per anonymized series (series)")
+    parser.add_argument("--shard_size",
+                        type=int,
+                        default=0,
+                        help="Size in MB after which an hdf5 or tar shard is rolled over to a new file (0 for no limit)")
+    parser.add_argument("-w",
+                        "--workers",
+                        type=workers,
+                        default=None,
+                        help="Number of worker processes of the multiprocessing version, "
+                             "or auto to tune the number of workers from the measured throughput")
+    parser.add_argument("--stream",
+                        action='store_true',
+                        help="Anonymize dicoms while the input directory is still being walked, "
+                             "instead of walking the whole directory first")
+    parser.add_argument("--incremental",
+                        action='store_true',
+                        help="Only consider files new or changed since the previous scan, "
+                             "using the scan manifest kept in the linking log directory")
+    parser.add_argument("--checkpoint_interval",
+                        type=int,
+                        default=60,
+                        help="Seconds between checkpoints of the link logs and of the remaining dicoms, "
+                             "from which a killed run resumes (0 to only save them at the end of the run)")
+    parser.add_argument("--prefetch_bytes",
+                        type=int,
+                        default=64,
+                        help="Read-ahead window in MB of files read in the background by each worker, "
+                             "while the current file is anonymized (0 to disable read-ahead)")
+    parser.add_argument("--writer_threads",
+                        type=int,
+                        default=2,
+                        help="Threads writing the output files of each worker in the background, "
+                             "while the next files are anonymized (0 to write them in the worker itself)")
+    parser.add_argument("--memory_budget",
+                        type=int,
+                        default=1024,
+                        help="Size in MB of the largest pixel array decoded at once by each worker. Multi-frame dicoms "
+                             "beyond it are decoded and exported a batch of frames at a time (0 for no limit)")
+    parser.add_argument("--metrics_file",
+                        type=str,
+                        default=None,
+                        help="Write the run's throughput, time spent per stage and progress to this json file, "
+                             "and to a Prometheus text file of the same name with a .prom extension")
+    parser.add_argument("--metrics_interval",
+                        type=int,
+                        default=30,
+                        help="Seconds between rewrites of the metrics file while the run progresses")
+    parser.add_argument("--profile_dir",
+                        type=str,
+                        default=None,
+                        help="Profile each worker with cProfile, and dump the profiles to this directory")
+    parser.add_argument("--fingerprint",
+                        type=str,
+                        choices=['none', 'index', 'bloom'],
+                        default='none',
+                        help="Skip files already anonymized by their content fingerprint, before parsing them: "
+                             "look up every fingerprint (index), or only those a Bloom filter may hold (bloom)")
+    parser.add_argument("--node_index",
+                        type=int,
+                        default=0,
+                        help="Index of this node, from 0, when the input directory is split across several nodes "
+                             "(see multiNode.py)")
+    parser.add_argument("--node_count",
+                        type=int,
+                        default=1,
+                        help="Number of nodes the input directory is split across, by top-level directory")
+    parser.add_argument("--coordinator",
+                        type=str,
+                        default=None,
+                        help="Coordinator file, on storage shared by the nodes, from which anonymized identifier "
+                             "ranges are leased. Required with several nodes, unless --id_mode is hmac")
+    parser.add_argument("--id_mode",
+                        type=str,
+                        default='sequential',
+                        choices=['sequential', 'hmac'],
+                        help="Number anonymized identifiers in order (sequential), or derive them from the original "
+                             "values under the site secret of --secret_file (hmac), see keyedIds.py")
+    parser.add_argument("--secret_file",
+                        type=str,
+                        default=None,
+                        help="File holding the site secret of --id_mode hmac")
+    parser.add_argument("--anon_profile",
+                        type=str,
+                        default=None,
+                        help="Json file of the anonymization profile, listing the header attributes to keep, blank, "
+                             "replace or derive (see anonProfile.py). Defaults to the standard profile")
 
     args = parser.parse_args()
+    if args.id_mode == 'hmac' and args.secret_file is None:
+        parser.error('--id_mode hmac requires --secret_file')
+    if args.id_mode != 'hmac' and args.link_log_backend == 'none':
+        parser.error('--link_log_backend none requires --id_mode hmac')
     return args
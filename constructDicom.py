@@ -1,125 +1,152 @@
 import os
+from io import BytesIO
 
-# Image handlers
-IMPORT_ERROR_MESSAGE = 'could not be imported. This may cause issues, depending on the transfer syntaxes of the dicom files.' \
-                       'See https://pydicom.github.io/pydicom/dev/old/image_data_handlers.html for details.'
-try:
-    import numpy
-    import numpy as np
-except ImportError:
-    print('Python package numpy', IMPORT_ERROR_MESSAGE)
-try:
-    import PIL
-    from PIL import Image
-except ImportError:
-    print('Python package PIL', IMPORT_ERROR_MESSAGE)
-try:
-    import jpeg_ls
-except ImportError:
-    print('Python package jpeg_ls', IMPORT_ERROR_MESSAGE)
-try:
-    import gdcm
-except ImportError:
-    print('Python package gdcm', IMPORT_ERROR_MESSAGE)
-
-import h5py
-
+import pydicom
 from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import SecondaryCaptureImageStorage
 
 import utils
+import anonProfile
+import outputWriter
+import pixelExport
+import runMetrics
+
+# Values larger than this many bytes (PixelData in particular) are skipped while parsing a file,
+# and are only read from disk when accessed.
+DEFER_SIZE = 64*1024
+
+DEFAULT_TAG_PLAN = anonProfile.load_plan()
+
+# Transfer syntaxes the anonymized headers keep. The pixel data is exported decoded, so that the headers of compressed
+# and big endian dicoms, which hold no pixel data, are written as explicit VR little endian.
+HEADER_TRANSFER_SYNTAXES = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1', '1.2.840.10008.1.2.1.99', '0.0')
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
 
 
-def write_dicom(ods, anon_values, out_dir, grouping):
+def read_dicom(f, force=False):
+    """
+    Parses the header of a dicom file only. Large values are seeked over rather than read, and are loaded on first access,
+    so that files skipped as already anonymized or as missing tags never pay for reading their pixel data.
+    The pixel data is then read by write_dicom, when the file is actually anonymized.
+    """
+    return pydicom.dcmread(f, force=force, defer_size=DEFER_SIZE)
+
+
+def build_dicom(ods, anon_values, tag_plan=None):
+    """
+    Builds the anonymized header of dicom <ods>, according to the compiled anonymization profile <tag_plan>
+    (see anonProfile.py), or the default profile.
+    """
+    if tag_plan is None:
+        tag_plan = DEFAULT_TAG_PLAN
+
     file_meta = Dataset()
-    file_meta.MediaStorageSOPClassUID = 'Secondary Capture Image Storage'
-    file_meta.MediaStorageSOPInstanceUID = str(anon_values['sopID'])
+    file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    file_meta.MediaStorageSOPInstanceUID = tag_plan.uid_root + str(anon_values['sopID'])
     file_meta.ImplementationClassUID = '0.0'
     file_meta.TransferSyntaxUID = ods.file_meta.TransferSyntaxUID if "TransferSyntaxUID" in ods.file_meta else "0.0"
+    if file_meta.TransferSyntaxUID not in HEADER_TRANSFER_SYNTAXES:
+        file_meta.TransferSyntaxUID = EXPLICIT_VR_LITTLE_ENDIAN
 
     ds = FileDataset(anon_values['studyID'], {}, file_meta=file_meta, preamble=ods.preamble)
+    tag_plan.apply(ods, ds, anon_values)
 
-    ds.StudyInstanceUID = str(anon_values['studyID'])
-    ds.SeriesInstanceUID = str(anon_values['seriesID'])
-    ds.SOPInstanceUID = str(anon_values['sopID'])
-    ds.SOPClassUID = 'Secondary Capture Image Storage'
-    ds.AccessionNumber = str(anon_values['accession'])
-    ds.PatientID = str(anon_values['mrn'])
-    ds.StudyID = str(anon_values['studyID'])
-
-    ds.PatientName = str(anon_values['mrn'])
-    ds.ReferringPhysicianName = ""
-    ds.StudyDate = "000000"
-    ds.StudyTime = "000000"
-    ds.PatientBirthTime = "000000.000000"
-    ds.PatientBirthDate = "00000000"
-    ds.PatientAge = utils.calculate_age(ods.StudyDate, ods.PatientBirthDate) if ("StudyDate" in ods and "PatientBirthDate" in ods) else ""
-    ds.PatientSex = ods.PatientSex if "PatientSex" in ods else ""
-
-    ds.StudyDescription = ods.StudyDescription if "StudyDescription" in ods else ""
-    ds.SeriesDescription = ods.SeriesDescription if "SeriesDescription" in ods else ""
-    ds.Modality = ods.Modality if "Modality" in ods else ""
-    ds.SeriesNumber = ods.SeriesNumber if "SeriesNumber" in ods else ""
-    ds.InstanceNumber = ods.InstanceNumber if "InstanceNumber" in ods else ""
-
-    ds.PlanarConfiguration = ods.PlanarConfiguration if "PlanarConfiguration" in ods else ""
-    ds.ViewPosition = ods.ViewPosition if "ViewPosition" in ods else ""
-    ds.PatientOrientation = ods.PatientOrientation if "PatientOrientation" in ods else ""
-
-    ds.SamplesPerPixel = ods.SamplesPerPixel if "SamplesPerPixel" in ods else ""
-    ds.PhotometricInterpretation = ods.PhotometricInterpretation if "PhotometricInterpretation" in ods else ""
-    ds.PixelRepresentation = ods.PixelRepresentation if "PixelRepresentation" in ods else ""
-    ds.ImagerPixelSpacing = ods.ImagerPixelSpacing if "ImagerPixelSpacing" in ods else ""
-    ds.HighBit = ods.HighBit if "HighBit" in ods else ""
-    ds.BitsStored = ods.BitsStored if "BitsStored" in ods else ""
-    ds.BitsAllocated = ods.BitsAllocated if "BitsAllocated" in ods else ""
-    ds.Columns = ods.Columns if "Columns" in ods else ""
-    ds.Rows = ods.Rows if "Rows" in ods else ""
-
-    ds.SpecificCharacterSet = ods.SpecificCharacterSet if "SpecificCharacterSet" in ods else ""
-    ds.SecondaryCaptureDeviceManufctur = 'Python 3.X'
-    ds.PresentationLUTShape = ods.PresentationLUTShape if "PresentationLUTShape" in ods else ""
-    ds.KVP = ods.KVP if "KVP" in ods else ""
-    ds.XRayTubeCurrent = ods.XRayTubeCurrent if "XRayTubeCurrent" in ods else ""
-    ds.ExposureTime = ods.ExposureTime if "ExposureTime" in ods else ""
-    ds.Exposure = ods.Exposure if "Exposure" in ods else ""
-    ds.ExposureControlMode = ods.ExposureControlMode if "ExposureControlMode" in ods else ""
-    ds.RelativeXRayExposure = ods.RelativeXRayExposure if "RelativeXRayExposure" in ods else ""
-    ds.FocalSpots = ods.FocalSpots if "FocalSpots" in ods else ""
-    ds.AnodeTargetMaterial = ods.AnodeTargetMaterial if "AnodeTargetMaterial" in ods else ""
-    ds.BodyPartThickness = ods.BodyPartThickness if "BodyPartThickness" in ods else ""
-    ds.CompressionForce = ods.CompressionForce if "CompressionForce" in ods else ""
-    ds.PaddleDescription = ods.PaddleDescription if "PaddleDescription" in ods else ""
-    ds.BurnedInAnnotation = ""
-    ds.DistanceSourceToDetector = ods.DistanceSourceToDetector if "DistanceSourceToDetector" in ods else ""
-    ds.DistanceSourceToPatient = ods.DistanceSourceToPatient if "DistanceSourceToPatient" in ods else ""
-    ds.PositionerPrimaryAngle = ods.PositionerPrimaryAngle if "PositionerPrimaryAngle" in ods else ""
-    ds.PositionerPrimaryAngleDirection = ods.PositionerPrimaryAngleDirection if "PositionerPrimaryAngleDirection" in ods else ""
-    ds.PositionerSecondaryAngle = ods.PositionerSecondaryAngle if "PositionerSecondaryAngle" in ods else ""
-    ds.ImageLaterality = ods.ImageLaterality if "ImageLaterality" in ods else ""
-    ds.BreastImplantPresent = ods.BreastImplantPresent if "BreastImplantPresent" in ods else ""
-    ds.Manufacturer = ods.Manufacturer if "Manufacturer" in ods else ""
-    ds.ManufacturerModelName = ods.ManufacturerModelName if "ManufacturerModelName" in ods else ""
-    ds.EstimatedRadiographicMagnificationFactor = ods.EstimatedRadiographicMagnificationFactor if "EstimatedRadiographicMagnificationFactor" in ods else ""
-    ds.DateOfLastDetectorCalibration = ods.DateOfLastDetectorCalibration if "DateOfLastDetectorCalibration" in ods else ""
-
-    filename = utils.clean_string('m' + str(anon_values['mrn']) + '_a' + str(anon_values['accession']) + '_st' + str(anon_values['studyID']) + "_se" + str(anon_values['seriesID']) + "_i" + str(anon_values['sopID']) + "_" + str(ds.SeriesNumber) + "_" + str(ds.InstanceNumber) + "_" + str(ds.Modality) + "_" + str(ds.ViewPosition) + ".dcm")
-
-    # Create study directory, if it doesn't already exist.
+    if 'PixelData' in ods:
+        ds.PixelData = b''
+    return ds
+
+
+def get_filename(ds, anon_values):
+    return utils.clean_string('m' + str(anon_values['mrn']) + '_a' + str(anon_values['accession']) + '_st' + str(anon_values['studyID']) + "_se" + str(anon_values['seriesID']) + "_i" + str(anon_values['sopID']) + "_" + str(ds.get('SeriesNumber', '')) + "_" + str(ds.get('InstanceNumber', '')) + "_" + str(ds.get('Modality', '')) + "_" + str(ds.get('ViewPosition', '')) + ".dcm")
+
+
+def encode_dicom(ods, ds, export_options=None, run_metrics=None, frames=1):
+    """
+    Encodes the anonymized header <ds> of dicom <ods> as the bytes of a .dcm file, and the pixel array of <ods>, if any,
+    as the bytes of a .hdf5 file (None otherwise). Returns (header, pixels).
+    """
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+    pixels = None
+    if 'PixelData' in ods:
+        with run_metrics.stage('pixel_decode'):
+            pixel_array = pixelExport.get_pixel_array(ods, run_metrics)
+        with run_metrics.stage('pixel_export'):
+            pixels = pixelExport.pixel_file_image(pixel_array, export_options, frames=frames)
+    with run_metrics.stage('header_write'):
+        header = encode_header(ds)
+    return header, pixels
+
+
+def encode_header(ds):
+    header = BytesIO()
+    ds.save_as(header, enforce_file_format=True)
+    return header.getvalue()
+
+
+def write_dicom(ods, anon_values, out_dir, grouping, export_options=None, shards=None, run_metrics=None, writer=None,
+                callback=None):
+    """
+    Writes the anonymized dicom of <ods>: its header as a .dcm file and its pixel array as a .hdf5 file, or both to
+    a shard. The files are built in memory and handed to <writer> (see outputWriter.py), which calls callback(None)
+    once they are in place, or callback(error) if they could not be written. Without a writer, the files are written
+    before returning, and write errors are raised. The pixel files of dicoms exceeding the memory budget of the export
+    options are written before returning instead, a batch of frames at a time (see pixelExport.py).
+    """
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+    frames = int(ods.get('NumberOfFrames') or 1)
+
+    with run_metrics.stage('build_header'):
+        ds = build_dicom(ods, anon_values, export_options.get('tag_plan') if export_options is not None else None)
+        filename = get_filename(ds, anon_values)
+
+    # Pixel arrays too large for the memory budget are decoded and written a batch of frames at a time.
+    pixel_frames = pixelExport.frame_stream(ods, export_options)
+
+    if shards is not None:
+        # Append the header and pixel array to the instance's shard, rather than writing files of its own.
+        with run_metrics.stage('pixel_decode'):
+            pixel_array = pixel_frames
+            if pixel_array is None and 'PixelData' in ods:
+                pixel_array = pixelExport.get_pixel_array(ods, run_metrics)
+        with run_metrics.stage('pixel_export'):
+            run_metrics.count('bytes_written', shards.append(ds, pixel_array, anon_values, filename, frames=frames))
+        if callback is not None:
+            callback(None)
+        return
+
+    # Group into study directories, created by the writer.
     if grouping == 'a':
-        utils.make_dirs(os.path.join(out_dir, str(anon_values['accession'])))
         out_path = os.path.join(out_dir, str(anon_values['accession']), filename)
     elif grouping == 's':
-        utils.make_dirs(os.path.join(out_dir, str(anon_values['studyID'])))
         out_path = os.path.join(out_dir, str(anon_values['studyID']), filename)
     elif grouping == 'm':
-        utils.make_dirs(os.path.join(out_dir, str(anon_values['mrn'])))
         out_path = os.path.join(out_dir, str(anon_values['mrn']), filename)
     else:
         out_path = os.path.join(out_dir, filename)
 
-    if 'PixelData' in ods:
-        ds.PixelData = ''
-        pixel_array = ods.pixel_array
-        f = h5py.File('{}.hdf5'.format(out_path[0:-4]))
-        f.create_dataset("pixel_array", pixel_array.shape, data=pixel_array, dtype=str(pixel_array.dtype), compression="gzip", shuffle=True)
-    ds.save_as(out_path, write_like_original=False)
+    # The pixel file is written first, so that a dicom header never exists without its pixel array.
+    if pixel_frames is not None:
+        # Written here rather than by the writer, straight to disk as the frames are decoded.
+        pixel_file = '{}.hdf5'.format(out_path[0:-4])
+        with run_metrics.stage('pixel_export'):
+            outputWriter.write_atomic(pixel_file, lambda outfile: pixelExport.write_pixel_array(pixel_frames, outfile, export_options, frames))
+        run_metrics.count('bytes_written', os.path.getsize(pixel_file))
+        with run_metrics.stage('header_write'):
+            header, pixels = encode_header(ds), None
+    else:
+        header, pixels = encode_dicom(ods, ds, export_options, run_metrics, frames)
+    files = []
+    if pixels is not None:
+        files.append(('{}.hdf5'.format(out_path[0:-4]), pixels))
+    files.append((out_path, header))
+
+    run_metrics.count('bytes_written', sum(len(data) for file_name, data in files))
+    if writer is not None:
+        writer.submit(files, callback)
+        return
+    errors = []
+    outputWriter.OutputWriter(0, run_metrics=run_metrics).submit(files, errors.append)
+    if errors[0] is not None:
+        raise errors[0]
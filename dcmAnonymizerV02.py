@@ -31,8 +31,9 @@ Program input:
 
 Notes:
 1. For the same dataset, the path of the linking log folder must be consistent across different runs of the program.
-2. If the program terminates because extra disk space is needed to write dicoms to the output folder,
-run the program again as many times as needed, each time with a new output folder containing additional disk space.
+2. Several output folders can be given to -o, e.g. on different volumes. Output folders are filled in order, and the program
+moves on to the next one once one is full. If the program terminates because extra disk space is needed to write dicoms to all
+output folders, run the program again as many times as needed, each time with a new output folder containing additional disk space.
 
 Program output:
 1. For each dicom in the input directory (recursive for subdirectories), if it doesn't already exist, the program writes an anonymized version to the desired output directory.
@@ -42,114 +43,163 @@ Program output:
 import sys
 import os
 import logging
-import psutil
 import time
 import datetime
 
-import pydicom
-
+import anonProfile
+import archiveReader
+import checkpoint
+import chunkAnonymizer
 import config
-import constructDicom
+import keyedIds
+import multiNode
+import outputWriter
+import pixelExport
+import prefetch
+import runMetrics
+import scanManifest
+import scheduler
+import shardWriter
+import spaceManager
 import utils
+from idAllocator import open_allocator
 
-DICOM_FIELDS = ('PatientID', 'AccessionNumber', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID')
-IDENTIFIER_FIELDS = ('mrn', 'accession', 'studyID', 'seriesID', 'sopID')
-MAX_FIELDS = ('max_mrn', 'max_accession', 'max_studyID', 'max_seriesID', 'max_sopID')
-LINK_LOG_FIELDS = ('link_mrn_log', 'link_accession_log', 'link_study_log', 'link_series_log', 'link_sop_log', 'link_master_log')
-
-RESERVE_OUTPUT_SPACE = 50*10**6
 
-
-def get_dicoms(dcm_directory):
+def get_dicoms(dcm_directory, manifest=None, node=None):
     partition = {}
-    if os.path.isdir(dcm_directory):
+    if os.path.isdir(dcm_directory) or archiveReader.is_archive_file(dcm_directory):
         # Walks through directory, and returns a dictionary with
         # keys as root folder paths and
         # values as file paths and total directory size.
         print("Getting dicoms in", dcm_directory)
         logger.info("Getting dicoms in {}".format(dcm_directory))
-        for root, dirs, files in os.walk(dcm_directory):
-            partition[root] = {'queue': [], 'size': 0.0}
-            for name in files:
-                is_dicom = False
-                if name.endswith((".dcm", ".dicom")):
-                    is_dicom = True
-                else:
-                    try:
-                        _ = pydicom.dcmread(os.path.join(root, name))
-                        is_dicom = True
-                    except:
-                        pass
-                if is_dicom:
-                    partition[root]['queue'].append(os.path.join(root, name))
-                    partition[root]['size'] += os.stat(os.path.join(root, name)).st_size
+        # With a scan manifest, only consider files new or changed since the previous scan.
+        # Archives, or an archive given as the input directory, are listed member by member.
+        walk = archiveReader.walk(dcm_directory, manifest)
+        # On several nodes, only consider the files of this node.
+        if node is not None:
+            walk = node.select(dcm_directory, walk)
+        for root, files in walk:
+            partition[root] = utils.scan_directory(root, files)
     else:
         print("DICOM directory does not exist - check the path")
         logger.error("DICOM directory does not exist - check the path")
     return partition
 
 
-def anonymize_dicoms(link_log_path, partition, out_dir, grouping, link_dict):
-    # Directories containing dicoms to be anonymized
-    directories = list(partition.keys())
+def anonymize_chunk(allocator, chunk, progress, shards, grouping, export_options, prefetch_bytes, run_metrics, profile_dir):
+    """
+    Anonymizes a chunk to the first output directory with room for it (see spaceManager.py), moving on to the next
+    output directory if one runs out of space while the chunk is written. Returns False if no output directory has
+    room left for the chunk.
+    """
+    while True:
+        out_dir, reservation = progress.space.reserve(chunk['size'])
+        if out_dir is None:
+            return False
+        if out_dir not in shards:
+            shards[out_dir] = shardWriter.open_shards(out_dir, grouping, export_options)
+
+        bytes_written = run_metrics.counters['bytes_written']
+        out_of_space = run_metrics.counters['out_of_space']
+        runMetrics.run_task(profile_dir, chunkAnonymizer.anonymize_files, allocator, chunk, out_dir, grouping, export_options,
+                            shards[out_dir], prefetch_bytes, run_metrics)
+        if progress.done(chunk, out_dir, reservation, run_metrics.counters['bytes_written'] - bytes_written,
+                         run_metrics.counters['out_of_space'] != out_of_space):
+            return True
+
+
+def close_shards(shards):
+    for out_dir_shards in shards.values():
+        if out_dir_shards is not None:
+            out_dir_shards.close()
+
+
+def anonymize_dicoms(link_log_path, partition, out_dirs, grouping, link_log_backend, export_options=None,
+                     checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL, prefetch_bytes=prefetch.PREFETCH_BYTES, run_metrics=None,
+                     profile_dir=None, fingerprint_mode='none', node=None, secret=None):
+    # Chunks of dicoms to be anonymized, small enough for checkpoints to be taken regularly.
+    chunks = scheduler.make_chunks(partition)
+    for directory in [directory for directory in partition if not partition[directory]['queue']]:
+        del partition[directory]
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+    run_metrics.add_remaining(chunks)
+
+    # Single owner of the link logs and incrementers, from which anonymized identifiers are requested.
+    allocator = open_allocator(link_log_path, link_log_backend, fingerprint_mode, node, secret)
+    progress = chunkAnonymizer.ChunkProgress(partition, spaceManager.SpaceManager(out_dirs),
+                                             checkpoint.Checkpointer(allocator, link_log_path, checkpoint_interval), run_metrics)
+    shards = {}
+
+    for i_chunk, chunk in enumerate(chunks):
+        run_metrics.set_gauge('chunks_queued', len(chunks) - i_chunk)
+        # Terminate program if no output directory has space left for the chunk.
+        if not anonymize_chunk(allocator, chunk, progress, shards, grouping, export_options, prefetch_bytes, run_metrics, profile_dir):
+            print('Ran out of space to write files.')
+            logger.warning('Ran out of space to write files.')
+            break
+
+    close_shards(shards)
+
+    # Save cache of already-visited patients.
+    allocator.close()
+
+    # Update partition.
+    utils.save_json(partition, os.path.join(link_log_path, 'partition.json'))
 
-    # Determine where the incrementer stopped in previous runs of the program.
-    # Important for creating new identifiers for newly encountered cases.
-    max_values = {MAX_FIELDS[i_iter]: utils.find_max(link_dict[LINK_LOG_FIELDS[i_iter]]) for i_iter in range(len(MAX_FIELDS))}
 
-    for directory in directories:
-        # Check space limitation. Terminate program if space left is too small.
-        free_space = float(psutil.disk_usage(out_dir).free)
-        if partition[directory]['size'] > free_space or free_space < RESERVE_OUTPUT_SPACE:
+def stream_dicoms(dcm_directory, link_log_path, out_dirs, grouping, link_log_backend, export_options=None, manifest=None,
+                  checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL, prefetch_bytes=prefetch.PREFETCH_BYTES, run_metrics=None,
+                  profile_dir=None, fingerprint_mode='none', node=None, secret=None):
+    """
+    Anonymizes dicoms while the directory is still being walked, instead of walking the whole directory first.
+    The partition only holds chunks discovered but not yet anonymized. If the run stops early for lack of space,
+    the rest of the directory is still walked, so that the saved partition lists all remaining dicoms.
+    Until the walk completes, checkpoints only commit the link logs: a partial partition would hide the dicoms not yet
+    discovered from the next run.
+    """
+    if not (os.path.isdir(dcm_directory) or archiveReader.is_archive_file(dcm_directory)):
+        print("DICOM directory does not exist - check the path")
+        logger.error("DICOM directory does not exist - check the path")
+        return
+
+    print("Streaming dicoms in", dcm_directory)
+    logger.info("Streaming dicoms in {}".format(dcm_directory))
+
+    partition = {}
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+    allocator = open_allocator(link_log_path, link_log_backend, fingerprint_mode, node, secret)
+    progress = chunkAnonymizer.ChunkProgress(partition, spaceManager.SpaceManager(out_dirs),
+                                             checkpoint.Checkpointer(allocator, link_log_path, checkpoint_interval), run_metrics,
+                                             is_walking=True)
+    shards = {}
+
+    walker = scheduler.DirectoryWalker(dcm_directory, manifest=manifest, run_metrics=run_metrics, node=node)
+    walker.start()
+    out_of_space = False
+    for chunk in walker:
+        progress.add(chunk)
+        run_metrics.set_gauge('chunks_queued', walker.queue.qsize())
+        if out_of_space:
+            continue
+
+        # Stop anonymizing if no output directory has space left for the chunk.
+        if not anonymize_chunk(allocator, chunk, progress, shards, grouping, export_options, prefetch_bytes, run_metrics, profile_dir):
             print('Ran out of space to write files.')
             logger.warning('Ran out of space to write files.')
-            break
+            out_of_space = True
 
-        for f in partition[directory]['queue']:
-            ds = pydicom.dcmread(f)
-
-            # Check if requisite tags exist
-            is_valid_dicom_image = True
-            for dicom_field in DICOM_FIELDS:
-                if dicom_field not in ds:
-                    logger.warning("WARNING - file: {} | {} not in DICOM tags".format(str(f), dicom_field))
-                    is_valid_dicom_image = False
-
-            if is_valid_dicom_image:
-                values = (str(ds.PatientID).upper(), str(ds.AccessionNumber).upper(), str(ds.StudyInstanceUID).upper(),
-                          str(ds.SeriesInstanceUID).upper(), str(ds.SOPInstanceUID).upper())
-                anon_values = {identifier: None for identifier in IDENTIFIER_FIELDS}
-
-                for i_iter in range(len(DICOM_FIELDS)):
-                    # Create a unique link between dicom info and anonymous keys to be stored.
-                    if values[i_iter] in link_dict[LINK_LOG_FIELDS[i_iter]]:
-                        anon_values[IDENTIFIER_FIELDS[i_iter]] = link_dict[LINK_LOG_FIELDS[i_iter]][values[i_iter]]
-                    else:
-                        max_values[MAX_FIELDS[i_iter]] += 1
-                        anon_values[IDENTIFIER_FIELDS[i_iter]] = max_values[MAX_FIELDS[i_iter]]
-                        link_dict[LINK_LOG_FIELDS[i_iter]][values[i_iter]] = anon_values[IDENTIFIER_FIELDS[i_iter]]
-
-                # If combination of keys already exists in the cache, skip the current dicom.
-                dicom_tuple = tuple(anon_values[IDENTIFIER_FIELDS[i_iter]] for i_iter in range(len(IDENTIFIER_FIELDS)))
-                if str(dicom_tuple) in link_dict[LINK_LOG_FIELDS[-1]]:
-                    link_dict[LINK_LOG_FIELDS[-1]][str(dicom_tuple)] += 1
-                    print('mrn-accession-studyID-seriesID-sopID tuple has already been anonymized.')
-                    logger.warning('mrn-accession-studyID-seriesID-sopID tuple has already been anonymized.')
-                else:
-                    try:
-                        constructDicom.write_dicom(ds, anon_values, out_dir, grouping)
-                        link_dict[LINK_LOG_FIELDS[-1]][str(dicom_tuple)] = 1
-                    except Exception as error:
-                        exc_type, exc_obj, exc_tb = sys.exc_info()
-                        logger.warning('WARNING - file: {} | message: {} {} {} . This warning is for case {} with anon_values {} .'
-                            .format(str(f), str(error), str(exc_type), str(exc_tb.tb_lineno), str(values), str(anon_values)))
-
-        # Remove directory's dicoms from further consideration.
-        del partition[directory]
+    close_shards(shards)
 
     # Save cache of already-visited patients.
-    for i_iter in range(len(LINK_LOG_FIELDS)):
-         utils.save_json(link_dict[LINK_LOG_FIELDS[i_iter]], os.path.join(link_log_path, "{}.json".format(LINK_LOG_FIELDS[i_iter])))
+    allocator.close()
+
+    # A partition missing the dicoms the failed walk never reached is not saved, nor is the scan manifest,
+    # so that the next run walks the directory again.
+    if walker.error is not None:
+        raise walker.error
 
     # Update partition.
     utils.save_json(partition, os.path.join(link_log_path, 'partition.json'))
@@ -157,6 +207,7 @@ def anonymize_dicoms(link_log_path, partition, out_dir, grouping, link_dict):
 
 if __name__ == "__main__":
     start_time = str(datetime.datetime.now())
+    start_time_run = time.time()
 
     utils.make_dirs(os.path.join(os.getcwd(), 'stdout'))
     sys.stdout = open(os.path.join(os.getcwd(), 'stdout', 'stdout_{}'.format(''.join(start_time.split(':')))), 'w')
@@ -164,12 +215,22 @@ if __name__ == "__main__":
     # Parse command line arguments.
     args = config.parse_args()
     input_dir = args.input_dir
-    output_dir = args.output_dir
+    output_dirs = args.output_dir
     link_log_dir = args.link_log_dir
     group_by = args.group_by
-
-    # Create link log and output directories, if they don't already exist.
-    utils.make_dirs(output_dir)
+    link_log_backend = args.link_log_backend
+    export_options = pixelExport.make_export_options(args.codec, args.chunks, args.output_mode, args.shard_by, args.shard_size*10**6,
+                                                     anonProfile.load_plan(args.anon_profile, keyedIds.uid_root(args.id_mode)),
+                                                     args.writer_threads, args.memory_budget*10**6)
+    # Site secret from which keyed identifiers are derived, None for sequential identifiers.
+    secret = keyedIds.load_secret(args.secret_file) if args.id_mode == 'hmac' else None
+    # Subset of the input directory anonymized by this node, and coordinator file from which it leases identifiers.
+    node = multiNode.NodeShard(args.node_index, args.node_count, args.coordinator, args.id_mode)
+
+    # Create link log and output directories, if they don't already exist, and mark the output directories as being
+    # written to, removing the temporary files of an interrupted run.
+    for out_dir in output_dirs:
+        outputWriter.begin_run(out_dir)
     utils.make_dirs(link_log_dir)
 
     # Log at WARNING level.
@@ -180,9 +241,12 @@ if __name__ == "__main__":
     handler = logging.FileHandler(os.path.join(link_log_dir, 'dcm_anonymize_{}.log'.format(''.join(start_time.split(':')))))
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+    # The warnings about the files of each chunk go to the same log file.
+    chunkAnonymizer.logger.setLevel(logging.WARNING)
+    chunkAnonymizer.logger.addHandler(handler)
 
-    print(input_dir, output_dir, link_log_dir, group_by)
-    logger.info(input_dir, output_dir, link_log_dir, group_by)
+    print(input_dir, output_dirs, link_log_dir, group_by)
+    logger.info(input_dir, output_dirs, link_log_dir, group_by)
 
     # Load partition, if it exists.
     partition = utils.load_json(os.path.join(link_log_dir, 'partition.json'))
@@ -192,27 +256,54 @@ if __name__ == "__main__":
     else:
         partition = {}
 
-    # Load cache of cases already analyzed, otherwise instantiate new caches.
-    link_dict = {link_log_field:
-                 utils.load_link_log(logger, link_log_dir, "{}.json".format(link_log_field), "Loading existing {}.".format(link_log_field))
-                 for link_log_field in LINK_LOG_FIELDS}
+    # Load the scan manifest of previous runs, to only consider new or changed files.
+    manifest = scanManifest.Manifest(link_log_dir) if args.incremental else None
+
+    # Time spent per stage, and number of files and bytes processed, rewritten to the metrics file as the run progresses.
+    run_metrics = runMetrics.RunMetrics()
+    if args.metrics_file:
+        exporter = runMetrics.MetricsExporter(run_metrics, args.metrics_file, args.metrics_interval)
+        exporter.start()
+    if args.profile_dir:
+        utils.make_dirs(args.profile_dir)
 
     # Load and anonymize dicoms.
     try:
-        if not partition:
-            start_time_get_dicoms = time.time()
-            partition = get_dicoms(input_dir)
-            end_time_get_dicoms = time.time()
-            print("--- Process get_dicoms took %s seconds to execute ---" % round((end_time_get_dicoms - start_time_get_dicoms), 2))
-            utils.save_json(partition, os.path.join(link_log_dir, 'partition.json'))
-
-        start_time_anonymize_dicoms = time.time()
-        anonymize_dicoms(link_log_dir, partition, output_dir, group_by, link_dict)
-        end_time_anonymize_dicoms = time.time()
-        print("--- Process anonymize_dicoms took %s seconds to execute ---" % round((end_time_anonymize_dicoms - start_time_anonymize_dicoms), 2))
+        if args.stream and not partition:
+            start_time_stream_dicoms = time.time()
+            stream_dicoms(input_dir, link_log_dir, output_dirs, group_by, link_log_backend, export_options, manifest,
+                          args.checkpoint_interval, args.prefetch_bytes*10**6, run_metrics, args.profile_dir,
+                          args.fingerprint, node, secret)
+            end_time_stream_dicoms = time.time()
+            print("--- Process stream_dicoms took %s seconds to execute ---" % round((end_time_stream_dicoms - start_time_stream_dicoms), 2))
+            if manifest is not None:
+                manifest.save()
+        else:
+            if not partition:
+                start_time_get_dicoms = time.time()
+                with run_metrics.stage('scan'):
+                    partition = get_dicoms(input_dir, manifest, node)
+                end_time_get_dicoms = time.time()
+                print("--- Process get_dicoms took %s seconds to execute ---" % round((end_time_get_dicoms - start_time_get_dicoms), 2))
+                utils.save_json(partition, os.path.join(link_log_dir, 'partition.json'))
+                if manifest is not None:
+                    manifest.save()
+
+            start_time_anonymize_dicoms = time.time()
+            anonymize_dicoms(link_log_dir, partition, output_dirs, group_by, link_log_backend, export_options, args.checkpoint_interval,
+                             args.prefetch_bytes*10**6, run_metrics, args.profile_dir, args.fingerprint, node, secret)
+            end_time_anonymize_dicoms = time.time()
+            print("--- Process anonymize_dicoms took %s seconds to execute ---" % round((end_time_anonymize_dicoms - start_time_anonymize_dicoms), 2))
     except ValueError:
         print("DICOM file list could not be loaded.")
         logger.error("DICOM file list could not be loaded.")
 
+    if args.metrics_file:
+        exporter.stop()
+        run_metrics.save(args.metrics_file, time.time() - start_time_run)
+
+    for out_dir in output_dirs:
+        outputWriter.end_run(out_dir)
+
     print("Anonymization Complete!")
     logger.info("Anonymization Complete!")
@@ -31,10 +31,13 @@ Program input:
 
 Notes:
 1. For the same dataset, the path of the linking log folder must be consistent across different runs of the program.
-2. If the program terminates because extra disk space is needed to write dicoms to the output folder,
-run the program again as many times as needed, each time with a new output folder containing additional disk space.
+2. Several output folders can be given to -o, e.g. on different volumes. Output folders are filled in order, and the program
+moves on to the next one once one is full. If the program terminates because extra disk space is needed to write dicoms to all
+output folders, run the program again as many times as needed, each time with a new output folder containing additional disk space.
 3. This version of the program uses parallelism (multiple processors) to speed-up the anonymization.
 Only up to three of the available logical cores are used by default, to minimize performance issues of other tasks running on the machine.
+Pass -w <number of workers> to use more, or -w auto to tune the number of workers from the measured throughput.
+Files are anonymized in size-balanced chunks, so that large directories are spread over all workers.
 See https://docs.python.org/3/library/multiprocessing.html for details on the multiprocessing module.
 
 Program output:
@@ -45,70 +48,63 @@ Program output:
 import sys
 import os
 import logging
-import psutil
 import time
 import datetime
+import functools
 
 import multiprocessing as mp
 
-import pydicom
-
+import anonProfile
+import archiveReader
+import checkpoint
+import chunkAnonymizer
 import config
-import constructDicom
+import keyedIds
+import multiNode
+import outputWriter
+import pixelExport
+import prefetch
+import runMetrics
+import scanManifest
+import scheduler
+import shardWriter
+import spaceManager
 import utils
-
-DICOM_FIELDS = ('PatientID', 'AccessionNumber', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID')
-IDENTIFIER_FIELDS = ('mrn', 'accession', 'studyID', 'seriesID', 'sopID')
-MAX_FIELDS = ('max_mrn', 'max_accession', 'max_studyID', 'max_seriesID', 'max_sopID')
-LINK_LOG_FIELDS = ('link_mrn_log', 'link_accession_log', 'link_study_log', 'link_series_log', 'link_sop_log', 'link_master_log')
-
-RESERVE_OUTPUT_SPACE = 50*10**6
+from idAllocator import AllocatorManager
 
 N_CORES = mp.cpu_count()
-# Based on empirical performance observations on different machines, restrict the number of cores used
-# TODO: identify a more scientifically grounded approach to deriving the optimal number of cores to use for a given machine
+# Default number of workers when --workers is not given, and the number the tuner starts from with --workers auto.
 USE_CORES = max(1, min(3, N_CORES//2))
 
 
 class Anonymize(object):
-    def __init__(self):
-        self.pool = mp.Pool(USE_CORES)
-
-    def terminate_callback(self, result):
-        if result:
-            self.pool.terminate()
+    def __init__(self, workers=None, initializer=None, initargs=()):
+        # Use the given number of workers, tune their number from measured throughput ('auto'),
+        # or fall back to the default restricted number of cores.
+        if workers == 'auto':
+            n_workers = N_CORES
+            tuner = scheduler.ThroughputTuner(USE_CORES, N_CORES)
+        else:
+            n_workers = int(workers) if workers else USE_CORES
+            tuner = None
+        self.pool = mp.Pool(n_workers, initializer=initializer, initargs=initargs)
+        self.scheduler = scheduler.Scheduler(self.pool, n_workers, tuner)
 
-    def execute(self, function, args):
-        self.pool.apply_async(function, args=args, callback=self.terminate_callback)
+    def execute(self, function, args, size, callback, error_callback=None):
+        return self.scheduler.execute(function, args, size, callback, error_callback)
 
     def wait(self):
+        self.scheduler.wait()
         self.pool.close()
         self.pool.join()
 
 
 def get_dicoms_mp(partition, root, dirs, files):
-    partition[root] = {'queue': [], 'size': 0.0}
-    for name in files:
-        is_dicom = False
-        if name.endswith((".dcm", ".dicom")):
-            is_dicom = True
-        else:
-            try:
-                _ = pydicom.dcmread(os.path.join(root, name))
-                is_dicom = True
-            except:
-                pass
-        if is_dicom:
-            content = partition[root]
+    partition[root] = utils.scan_directory(root, files)
 
-            content['queue'].append(os.path.join(root, name))
-            content['size'] += os.stat(os.path.join(root, name)).st_size
 
-            partition[root] = content
-
-
-def get_dicoms(dcm_directory):
-    if os.path.isdir(dcm_directory):
+def get_dicoms(dcm_directory, manifest=None, node=None):
+    if os.path.isdir(dcm_directory) or archiveReader.is_archive_file(dcm_directory):
         # Walks through directory, and returns a dictionary with
         # keys as root folder paths and
         # values as file paths and total directory size.
@@ -120,8 +116,14 @@ def get_dicoms(dcm_directory):
 
         pool = mp.Pool(USE_CORES)
 
-        for root, dirs, files in os.walk(dcm_directory):
-            pool.apply_async(get_dicoms_mp, args=(partition, root, dirs, files))
+        # With a scan manifest, only consider files new or changed since the previous scan.
+        # Archives, or an archive given as the input directory, are listed member by member.
+        walk = archiveReader.walk(dcm_directory, manifest)
+        # On several nodes, only consider the files of this node.
+        if node is not None:
+            walk = node.select(dcm_directory, walk)
+        for root, files in walk:
+            pool.apply_async(get_dicoms_mp, args=(partition, root, [], files))
         pool.close()
         pool.join()
 
@@ -134,103 +136,183 @@ def get_dicoms(dcm_directory):
         return {}
 
 
-def anonymize_dicoms_mp(link_dict, partition, directory, max_values, out_dir, grouping):
-    # Check space limitation. Terminate program if space left is too small.
-    free_space = float(psutil.disk_usage(out_dir).free)
-    if partition[directory]['size'] > free_space or free_space < RESERVE_OUTPUT_SPACE:
-        print('Ran out of space to write files.')
-        logger.warning('Ran out of space to write files.')
+def anonymize_dicoms_mp(allocator, chunk, out_dir, grouping, export_options, prefetch_bytes=prefetch.PREFETCH_BYTES):
+    """
+    Anonymizes the dicoms of a chunk to <out_dir>, where space has been reserved for it. Returns whether some dicoms
+    could not be written for lack of space, and the task's metrics (see runMetrics.py).
+    """
+    # Shards are opened by the worker process, and kept open across its tasks (see shardWriter.init_worker).
+    shards = shardWriter.open_worker_shards(out_dir)
+    run_metrics = chunkAnonymizer.anonymize_files(allocator, chunk, out_dir, grouping, export_options, shards, prefetch_bytes)
+    return run_metrics.counters['out_of_space'] > 0, run_metrics.as_dict()
+
+
+class ChunkDispatcher(object):
+    """
+    Dispatches chunks to the workers of <anonymizer>, each to the first output directory with room for it, and records
+    them in <progress> (see chunkAnonymizer.ChunkProgress) as they complete. Chunks which run out of space are written
+    again to the next output directory by finish().
+    """
+    def __init__(self, anonymizer, progress, allocator, grouping, export_options, prefetch_bytes, profile_dir):
+        self.anonymizer = anonymizer
+        self.progress = progress
+        self.run_metrics = progress.run_metrics
+        self.task_args = (allocator, grouping, export_options, prefetch_bytes)
+        self.profile_dir = profile_dir
+        # Chunks which ran out of space, to be written again to the next output directory.
+        self.spilled = []
+        self.is_dispatching = True
+
+    def chunk_done(self, chunk, out_dir, reservation, result):
+        out_of_space, task_metrics = result
+        self.run_metrics.merge(task_metrics)
+        self.run_metrics.add_gauge('chunks_in_flight', -1)
+        if not self.progress.done(chunk, out_dir, reservation, task_metrics['counters']['bytes_written'], out_of_space):
+            self.spilled.append(chunk)
+        return False
+
+    def chunk_failed(self, chunk, out_dir, reservation, error):
+        self.progress.failed(chunk, out_dir, reservation, error)
+        self.run_metrics.add_gauge('chunks_in_flight', -1)
+
+    def dispatch(self, chunk):
+        """
+        Dispatches the chunk to the first output directory with room for it. Returns False, and dispatches no further
+        chunks, once all output directories are full or dispatching has been stopped.
+        """
+        if not self.is_dispatching:
+            return False
+        out_dir, reservation = self.progress.space.wait_reserve(chunk['size'])
+        if out_dir is None:
+            print('Ran out of space to write files.')
+            logger.warning('Ran out of space to write files.')
+            self.is_dispatching = False
+            return False
+        allocator, grouping, export_options, prefetch_bytes = self.task_args
+        if not self.anonymizer.execute(runMetrics.run_task, (self.profile_dir, anonymize_dicoms_mp, allocator, chunk, out_dir,
+                                                             grouping, export_options, prefetch_bytes),
+                                       chunk['size'], functools.partial(self.chunk_done, chunk, out_dir, reservation),
+                                       functools.partial(self.chunk_failed, chunk, out_dir, reservation)):
+            # Dispatching stopped after a callback failed.
+            self.progress.space.release(out_dir, reservation, 0, 0)
+            self.is_dispatching = False
+            return False
+        self.run_metrics.set_gauge('chunks_in_flight', self.anonymizer.scheduler.active)
         return True
 
-    for f in partition[directory]['queue']:
-        ds = pydicom.dcmread(f)
-
-        # Check if requisite tags exist
-        is_valid_dicom_image = True
-        for dicom_field in DICOM_FIELDS:
-            if dicom_field not in ds:
-                logger.warning("WARNING - file: {} | {} not in DICOM tags".format(str(f), dicom_field))
-                is_valid_dicom_image = False
-
-        if is_valid_dicom_image:
-            values = (str(ds.PatientID).upper(), str(ds.AccessionNumber).upper(), str(ds.StudyInstanceUID).upper(),
-                      str(ds.SeriesInstanceUID).upper(), str(ds.SOPInstanceUID).upper())
-            anon_values = {identifier: None for identifier in IDENTIFIER_FIELDS}
-
-            for i_iter in range(len(DICOM_FIELDS)):
-                # Create a unique link between dicom info and anonymous keys to be stored.
-                if values[i_iter] in link_dict[LINK_LOG_FIELDS[i_iter]]:
-                    temp_anon_value = link_dict[LINK_LOG_FIELDS[i_iter]][values[i_iter]]
-                    anon_values[IDENTIFIER_FIELDS[i_iter]] = temp_anon_value
-                else:
-                    temp_max_value = max_values[MAX_FIELDS[i_iter]] + 1
-                    max_values[MAX_FIELDS[i_iter]] = temp_max_value
-
-                    anon_values[IDENTIFIER_FIELDS[i_iter]] = max_values[MAX_FIELDS[i_iter]]
-
-                    temp_link_dict = link_dict[LINK_LOG_FIELDS[i_iter]]
-                    temp_link_dict[values[i_iter]] = anon_values[IDENTIFIER_FIELDS[i_iter]]
-                    link_dict[LINK_LOG_FIELDS[i_iter]] = temp_link_dict
-
-            # If combination of keys already exists in the cache, skip the current dicom.
-            dicom_tuple = tuple(anon_values[IDENTIFIER_FIELDS[i_iter]] for i_iter in range(len(IDENTIFIER_FIELDS)))
-            if str(dicom_tuple) in link_dict[LINK_LOG_FIELDS[-1]]:
-                temp_link_dict_master = link_dict[LINK_LOG_FIELDS[-1]]
-                temp_link_dict_master[str(dicom_tuple)] += 1
-                link_dict[LINK_LOG_FIELDS[-1]] = temp_link_dict_master
-
-                print('mrn-accession-studyID-seriesID-sopID tuple {} has already been anonymized.'.format(str(dicom_tuple)))
-                logger.warning('mrn-accession-studyID-seriesID-sopID tuple {} has already been anonymized.'.format(str(dicom_tuple)))
-            else:
-                try:
-                    constructDicom.write_dicom(ds, anon_values, out_dir, grouping)
-                    temp_link_dict_master = link_dict[LINK_LOG_FIELDS[-1]]
-                    temp_link_dict_master[str(dicom_tuple)] = 1
-                    link_dict[LINK_LOG_FIELDS[-1]] = temp_link_dict_master
-                except Exception as error:
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    logger.warning('WARNING - file: {} | message: {} {} {} . This warning is for case {} with anon_values {} .'
-                                   .format(str(f), str(error), str(exc_type), str(exc_tb.tb_lineno), str(values), str(anon_values)))
-
-    # Remove directory's dicoms from further consideration.
-    del partition[directory]
-
-    return False
-
-
-def anonymize_dicoms(link_log_path, partition, out_dir, grouping, link_dict):
-    # Directories containing dicoms to be anonymized
-    directories = list(partition.keys())
-
-    # Determine where the incrementer stopped in previous runs of the program.
-    # Important for creating new identifiers for newly encountered cases.
-    max_values = {MAX_FIELDS[i_iter]: utils.find_max(link_dict[LINK_LOG_FIELDS[i_iter]]) for i_iter in range(len(MAX_FIELDS))}
-
-    # Create a manager instance to share variables across processors during multiprocessing execution
-    manager = mp.Manager()
-    link_dict = manager.dict(link_dict)
-    max_values = manager.dict(max_values)
-    partition = manager.dict(partition)
+    def finish(self):
+        """
+        Waits for the dispatched chunks, writing the chunks which ran out of space again while an output directory
+        has room, then stops the workers.
+        """
+        self.anonymizer.scheduler.wait()
+        while self.is_dispatching and self.spilled:
+            retry = list(self.spilled)
+            del self.spilled[:]
+            for chunk in retry:
+                if not self.dispatch(chunk):
+                    break
+            self.anonymizer.scheduler.wait()
+        self.anonymizer.wait()
+
+
+def anonymize_dicoms(link_log_path, partition, out_dirs, grouping, link_log_backend, export_options=None, workers=None,
+                     checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL, prefetch_bytes=prefetch.PREFETCH_BYTES, run_metrics=None,
+                     profile_dir=None, fingerprint_mode='none', node=None, secret=None):
+    # Size-balanced chunks of dicoms to be anonymized, largest first.
+    chunks = scheduler.make_chunks(partition)
+    for directory in [directory for directory in partition if not partition[directory]['queue']]:
+        del partition[directory]
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+    run_metrics.add_remaining(chunks)
+
+    # Start a single process owning the link logs and incrementers, from which workers request anonymized identifiers.
+    allocator_manager = AllocatorManager()
+    allocator_manager.start()
+    allocator = allocator_manager.IdAllocator(link_log_path, link_log_backend, fingerprint_mode, node, secret)
+    progress = chunkAnonymizer.ChunkProgress(partition, spaceManager.SpaceManager(out_dirs),
+                                             checkpoint.Checkpointer(allocator, link_log_path, checkpoint_interval), run_metrics)
 
     # Run anonymization
-    anonymizer = Anonymize()
-    for directory in directories:
-        anonymizer.execute(anonymize_dicoms_mp, args=(link_dict, partition, directory, max_values, out_dir, grouping))
-    anonymizer.wait()
+    anonymizer = Anonymize(workers, shardWriter.init_worker, (grouping, export_options))
+    dispatcher = ChunkDispatcher(anonymizer, progress, allocator, grouping, export_options, prefetch_bytes, profile_dir)
+    for i_chunk, chunk in enumerate(chunks):
+        if not dispatcher.dispatch(chunk):
+            break
+        run_metrics.set_gauge('chunks_queued', len(chunks) - i_chunk - 1)
+    dispatcher.finish()
+
+    # Save cache of already-visited patients.
+    allocator.close()
+    allocator_manager.shutdown()
+
+    # Update partition, then abort the run if a chunk's completion could not be handled.
+    utils.save_json(partition, os.path.join(link_log_path, 'partition.json'))
+    anonymizer.scheduler.check()
+
+
+def stream_dicoms(dcm_directory, link_log_path, out_dirs, grouping, link_log_backend, export_options=None, workers=None, manifest=None,
+                  checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL, prefetch_bytes=prefetch.PREFETCH_BYTES, run_metrics=None,
+                  profile_dir=None, fingerprint_mode='none', node=None, secret=None):
+    """
+    Anonymizes dicoms while the directory is still being walked, instead of walking the whole directory first.
+    Chunks are dispatched as they are discovered, and the walk blocks while the workers are busy and the queue of
+    discovered chunks is full. The partition only holds chunks discovered but not yet anonymized. If the run stops
+    early for lack of space, the rest of the directory is still walked, so that the saved partition lists all remaining dicoms.
+    Until the walk completes, checkpoints only commit the link logs: a partial partition would hide the dicoms not yet
+    discovered from the next run.
+    """
+    if not (os.path.isdir(dcm_directory) or archiveReader.is_archive_file(dcm_directory)):
+        print("DICOM directory does not exist - ensure path exists")
+        logger.error("DICOM directory does not exist - ensure path exists")
+        return
+
+    print("Streaming dicoms in", dcm_directory)
+    logger.info("Streaming dicoms in {}".format(dcm_directory))
 
-    link_dict = link_dict.copy()
-    partition = partition.copy()
+    partition = {}
+    if run_metrics is None:
+        run_metrics = runMetrics.RunMetrics()
+
+    # Start a single process owning the link logs and incrementers, from which workers request anonymized identifiers.
+    allocator_manager = AllocatorManager()
+    allocator_manager.start()
+    allocator = allocator_manager.IdAllocator(link_log_path, link_log_backend, fingerprint_mode, node, secret)
+    progress = chunkAnonymizer.ChunkProgress(partition, spaceManager.SpaceManager(out_dirs),
+                                             checkpoint.Checkpointer(allocator, link_log_path, checkpoint_interval), run_metrics,
+                                             is_walking=True)
+
+    # Run anonymization
+    anonymizer = Anonymize(workers, shardWriter.init_worker, (grouping, export_options))
+    dispatcher = ChunkDispatcher(anonymizer, progress, allocator, grouping, export_options, prefetch_bytes, profile_dir)
+    walker = scheduler.DirectoryWalker(dcm_directory, manifest=manifest, run_metrics=run_metrics, node=node)
+    walker.start()
+    for chunk in walker:
+        progress.add(chunk)
+        dispatcher.dispatch(chunk)
+        run_metrics.set_gauge('chunks_queued', walker.queue.qsize())
+    if walker.error is None:
+        progress.walk_done()
+    dispatcher.finish()
 
     # Save cache of already-visited patients.
-    for i_iter in range(len(LINK_LOG_FIELDS)):
-         utils.save_json(link_dict[LINK_LOG_FIELDS[i_iter]], os.path.join(link_log_path, "{}.json".format(LINK_LOG_FIELDS[i_iter])))
+    allocator.close()
+    allocator_manager.shutdown()
 
-    # Update partition.
+    # A partition missing the dicoms the failed walk never reached is not saved, nor is the scan manifest,
+    # so that the next run walks the directory again.
+    if walker.error is not None:
+        raise walker.error
+
+    # Update partition, then abort the run if a chunk's completion could not be handled.
     utils.save_json(partition, os.path.join(link_log_path, 'partition.json'))
+    anonymizer.scheduler.check()
 
 
 if __name__ == "__main__":
     start_time = str(datetime.datetime.now())
+    start_time_run = time.time()
 
     utils.make_dirs(os.path.join(os.getcwd(), 'stdout'))
     sys.stdout = open(os.path.join(os.getcwd(), 'stdout', 'stdout_{}'.format(''.join(start_time.split(':')))), 'w')
@@ -238,12 +320,22 @@ if __name__ == "__main__":
     # Parse command line arguments.
     args = config.parse_args()
     input_dir = args.input_dir
-    output_dir = args.output_dir
+    output_dirs = args.output_dir
     link_log_dir = args.link_log_dir
     group_by = args.group_by
-
-    # Create link log and output directories, if they don't already exist.
-    utils.make_dirs(output_dir)
+    link_log_backend = args.link_log_backend
+    export_options = pixelExport.make_export_options(args.codec, args.chunks, args.output_mode, args.shard_by, args.shard_size*10**6,
+                                                     anonProfile.load_plan(args.anon_profile, keyedIds.uid_root(args.id_mode)),
+                                                     args.writer_threads, args.memory_budget*10**6)
+    # Site secret from which keyed identifiers are derived, None for sequential identifiers.
+    secret = keyedIds.load_secret(args.secret_file) if args.id_mode == 'hmac' else None
+    # Subset of the input directory anonymized by this node, and coordinator file from which it leases identifiers.
+    node = multiNode.NodeShard(args.node_index, args.node_count, args.coordinator, args.id_mode)
+
+    # Create link log and output directories, if they don't already exist, and mark the output directories as being
+    # written to, removing the temporary files of an interrupted run.
+    for out_dir in output_dirs:
+        outputWriter.begin_run(out_dir)
     utils.make_dirs(link_log_dir)
 
     # Log at WARNING level.
@@ -254,12 +346,15 @@ if __name__ == "__main__":
     handler = logging.FileHandler(os.path.join(link_log_dir, 'dcm_anonymize_{}.log'.format(''.join(start_time.split(':')))))
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+    # The warnings about the files of each chunk go to the same log file.
+    chunkAnonymizer.logger.setLevel(logging.WARNING)
+    chunkAnonymizer.logger.addHandler(handler)
 
-    print(input_dir, output_dir, link_log_dir, group_by)
-    logger.info(input_dir, output_dir, link_log_dir, group_by)
+    print(input_dir, output_dirs, link_log_dir, group_by)
+    logger.info(input_dir, output_dirs, link_log_dir, group_by)
 
-    print('Total number of cores {} available. Using {} cores.'.format(N_CORES, USE_CORES))
-    logger.info('Total number of cores {} available. Using {} cores.'.format(N_CORES, USE_CORES))
+    print('Total number of cores {} available. Using {} cores.'.format(N_CORES, args.workers or USE_CORES))
+    logger.info('Total number of cores {} available. Using {} cores.'.format(N_CORES, args.workers or USE_CORES))
 
     # Load partition, if it exists.
     partition = utils.load_json(os.path.join(link_log_dir, 'partition.json'))
@@ -269,27 +364,55 @@ if __name__ == "__main__":
     else:
         partition = {}
 
-    # Load cache of cases already analyzed, otherwise instantiate new caches.
-    link_dict = {link_log_field:
-                 utils.load_link_log(logger, link_log_dir, "{}.json".format(link_log_field), "Loading existing {}.".format(link_log_field))
-                 for link_log_field in LINK_LOG_FIELDS}
+    # Load the scan manifest of previous runs, to only consider new or changed files.
+    manifest = scanManifest.Manifest(link_log_dir) if args.incremental else None
+
+    # Time spent per stage, and number of files and bytes processed, rewritten to the metrics file as the run progresses.
+    run_metrics = runMetrics.RunMetrics()
+    if args.metrics_file:
+        exporter = runMetrics.MetricsExporter(run_metrics, args.metrics_file, args.metrics_interval)
+        exporter.start()
+    if args.profile_dir:
+        utils.make_dirs(args.profile_dir)
 
     # Load and anonymize dicoms.
     try:
-        if not partition:
-            start_time_get_dicoms = time.time()
-            partition = get_dicoms(input_dir)
-            end_time_get_dicoms = time.time()
-            print("--- Process get_dicoms took %s seconds to execute ---" % round((end_time_get_dicoms - start_time_get_dicoms), 2))
-            utils.save_json(partition, os.path.join(link_log_dir, 'partition.json'))
-
-        start_time_anonymize_dicoms = time.time()
-        anonymize_dicoms(link_log_dir, partition, output_dir, group_by, link_dict)
-        end_time_anonymize_dicoms = time.time()
-        print("--- Process anonymize_dicoms took %s seconds to execute ---" % round((end_time_anonymize_dicoms - start_time_anonymize_dicoms), 2))
+        if args.stream and not partition:
+            start_time_stream_dicoms = time.time()
+            stream_dicoms(input_dir, link_log_dir, output_dirs, group_by, link_log_backend, export_options, args.workers, manifest,
+                          args.checkpoint_interval, args.prefetch_bytes*10**6, run_metrics, args.profile_dir,
+                          args.fingerprint, node, secret)
+            end_time_stream_dicoms = time.time()
+            print("--- Process stream_dicoms took %s seconds to execute ---" % round((end_time_stream_dicoms - start_time_stream_dicoms), 2))
+            if manifest is not None:
+                manifest.save()
+        else:
+            if not partition:
+                start_time_get_dicoms = time.time()
+                with run_metrics.stage('scan'):
+                    partition = get_dicoms(input_dir, manifest, node)
+                end_time_get_dicoms = time.time()
+                print("--- Process get_dicoms took %s seconds to execute ---" % round((end_time_get_dicoms - start_time_get_dicoms), 2))
+                utils.save_json(partition, os.path.join(link_log_dir, 'partition.json'))
+                if manifest is not None:
+                    manifest.save()
+
+            start_time_anonymize_dicoms = time.time()
+            anonymize_dicoms(link_log_dir, partition, output_dirs, group_by, link_log_backend, export_options, args.workers,
+                             args.checkpoint_interval, args.prefetch_bytes*10**6, run_metrics, args.profile_dir,
+                             args.fingerprint, node, secret)
+            end_time_anonymize_dicoms = time.time()
+            print("--- Process anonymize_dicoms took %s seconds to execute ---" % round((end_time_anonymize_dicoms - start_time_anonymize_dicoms), 2))
     except ValueError:
         print("DICOM file list could not be loaded.")
         logger.error("DICOM file list could not be loaded.")
 
+    if args.metrics_file:
+        exporter.stop()
+        run_metrics.save(args.metrics_file, time.time() - start_time_run)
+
+    for out_dir in output_dirs:
+        outputWriter.end_run(out_dir)
+
     print("Anonymization Complete!")
     logger.info("Anonymization Complete!")
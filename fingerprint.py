@@ -0,0 +1,141 @@
+"""
+Content fingerprints of input files, to skip files already anonymized (e.g. the same study exported under several
+folders, or a rerun over the same input directory) before parsing them.
+
+A fingerprint is a 128 bit blake2b hash of the first FINGERPRINT_BYTES of a file, which hold its header for all but
+unusually large headers, and of the file size. The allocator maps the fingerprint of every file anonymized or found to
+be a duplicate to its anonymized tuple (link_fingerprint_log, see linkLog.py). A file whose fingerprint is known is
+counted in link_master_log like any other duplicate, without being parsed or having its identifiers looked up.
+
+Modes (--fingerprint):
+none: files are not fingerprinted.
+index: the fingerprint of every file is looked up in the link logs.
+bloom: a Bloom filter of the known fingerprints answers for most new files without a lookup, which saves a round trip to
+the allocator per file in the multiprocessing version. The filter is saved alongside the link logs at the end of a run,
+and memory mapped by each worker: fingerprints added during the current run are only known to the allocator, so
+duplicates within a run are found by the usual lookups after parsing, and recorded for the next run.
+"""
+
+import os
+import mmap
+import math
+import struct
+import hashlib
+from io import BytesIO
+
+FINGERPRINT_MODES = ('none', 'index', 'bloom')
+FINGERPRINT_BYTES = 64*1024
+
+BLOOM_FILE_NAME = 'link_fingerprint_bloom.bin'
+# Number of fingerprints a new Bloom filter is sized for, and its false positive rate at that number.
+BLOOM_CAPACITY = 10**7
+BLOOM_ERROR_RATE = 0.01
+# Bloom filter file header: number of bits, number of hashes, capacity and number of fingerprints added.
+BLOOM_HEADER = struct.Struct('<QQQQ')
+
+
+def file_fingerprint(f, source, size):
+    """
+    Fingerprint of file <f>, read from <source> (a BytesIO of the whole file, or its path) of <size> bytes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(source, BytesIO):
+        with source.getbuffer() as buffer:
+            digest.update(buffer[:FINGERPRINT_BYTES])
+    else:
+        with open(f, 'rb') as infile:
+            digest.update(infile.read(FINGERPRINT_BYTES))
+    digest.update(struct.pack('<Q', int(size)))
+    return digest.hexdigest()
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of fingerprints. Fingerprints are uniformly distributed already, so bit positions are derived from
+    the fingerprint itself by double hashing.
+    """
+    def __init__(self, n_bits, n_hashes, capacity, count=0, bits=None, offset=0):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.capacity = capacity
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((n_bits + 7)//8)
+        self.offset = offset
+
+    @classmethod
+    def create(cls, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        n_bits = int(math.ceil(-capacity*math.log(error_rate)/math.log(2)**2))
+        n_hashes = max(1, int(round(n_bits/capacity*math.log(2))))
+        return cls(n_bits, n_hashes, capacity)
+
+    @classmethod
+    def load(cls, file_name, read_only=False):
+        """
+        Loads a saved filter, or memory maps it read-only, e.g. in workers.
+        """
+        with open(file_name, 'rb') as infile:
+            n_bits, n_hashes, capacity, count = BLOOM_HEADER.unpack(infile.read(BLOOM_HEADER.size))
+            if read_only:
+                return cls(n_bits, n_hashes, capacity, count, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ), BLOOM_HEADER.size)
+            return cls(n_bits, n_hashes, capacity, count, bytearray(infile.read()))
+
+    def positions(self, fingerprint):
+        value = int(fingerprint, 16)
+        h1, h2 = value >> 64, (value & 0xFFFFFFFFFFFFFFFF) | 1
+        return [(h1 + i*h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, fingerprint):
+        for position in self.positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[self.offset + (position >> 3)] & (1 << (position & 7)) for position in self.positions(fingerprint))
+
+    def save(self, file_name):
+        temp_file_name = '{}.tmp'.format(file_name)
+        with open(temp_file_name, 'wb') as outfile:
+            outfile.write(BLOOM_HEADER.pack(self.n_bits, self.n_hashes, self.capacity, self.count))
+            outfile.write(self.bits)
+        os.replace(temp_file_name, file_name)
+
+
+# Read-only Bloom filter of this process, with the file and modification time it was loaded from.
+process_filter = (None, None, None)
+
+
+def load_filter(file_name):
+    """
+    Memory maps the Bloom filter saved as <file_name>, once per process and saved version. Returns None if there is none.
+    """
+    global process_filter
+    if file_name is None or not os.path.isfile(file_name):
+        return None
+    mtime = os.path.getmtime(file_name)
+    if process_filter[:2] != (file_name, mtime):
+        process_filter = (file_name, mtime, BloomFilter.load(file_name, read_only=True))
+    return process_filter[2]
+
+
+class FingerprintIndex(object):
+    """
+    A task's view of the fingerprints known to <allocator>: check() fingerprints a file and, if the fingerprint is known,
+    counts the file as a duplicate.
+    """
+    def __init__(self, allocator):
+        self.allocator = allocator
+        self.mode, bloom_file = allocator.fingerprint_settings()
+        self.is_enabled = self.mode != 'none'
+        self.bloom = load_filter(bloom_file) if self.mode == 'bloom' else None
+
+    def check(self, f, source, size):
+        """
+        Returns the fingerprint of file <f> (None if it could not be read), and whether the file is a known duplicate.
+        """
+        try:
+            fingerprint = file_fingerprint(f, source, size)
+        except OSError:
+            return None, False
+        if self.mode == 'bloom' and (self.bloom is None or fingerprint not in self.bloom):
+            return fingerprint, False
+        return fingerprint, self.allocator.skip_fingerprint(fingerprint)
@@ -0,0 +1,176 @@
+import os
+import threading
+
+from multiprocessing.managers import BaseManager
+
+import fingerprint
+import keyedIds
+import linkLog
+import multiNode
+
+DICOM_FIELDS = ('PatientID', 'AccessionNumber', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID')
+IDENTIFIER_FIELDS = ('mrn', 'accession', 'studyID', 'seriesID', 'sopID')
+LINK_LOG_FIELDS = ('link_mrn_log', 'link_accession_log', 'link_study_log', 'link_series_log', 'link_sop_log', 'link_master_log')
+
+
+class IdAllocator(object):
+    """
+    Owns the link log store and hands out anonymized identifiers, continuing from the store's running maximum of each field.
+    Every call is O(1) in the size of the link logs. When served through an AllocatorManager, a single server process
+    owns the store and workers only exchange the five identifiers of a file (one round trip per file), instead of
+    pickling whole link log dictionaries back and forth through a Manager dict proxy.
+    Calls are serialized by a lock, so two workers can never be handed the same anonymized identifier.
+    With an IdLease (see multiNode.py), new identifiers are taken from ranges leased by this node instead.
+    With KeyedIds (see keyedIds.py), new identifiers are derived from the original values, avoiding those already recorded.
+    """
+    def __init__(self, store, fingerprint_mode='none', bloom_file=None, lease=None, keyed_ids=None):
+        self.store = store
+        self.lease = lease
+        self.keyed_ids = keyed_ids
+        self.lock = threading.Lock()
+
+        # Tuples handed out for writing, but not yet confirmed as written, with the number of duplicates seen meanwhile.
+        self.pending = {}
+
+        # Fingerprints are recorded whenever given, and looked up unless the mode is none.
+        # In bloom mode, a filter of the known fingerprints is kept up to date, and saved for the workers.
+        self.fingerprint_mode = fingerprint_mode
+        self.bloom_file = bloom_file
+        self.bloom = None
+        if fingerprint_mode == 'bloom':
+            if os.path.isfile(bloom_file):
+                self.bloom = fingerprint.BloomFilter.load(bloom_file)
+            else:
+                self.rebuild_bloom()
+
+    def rebuild_bloom(self):
+        fingerprints = [key for key, _ in self.store.items(linkLog.FINGERPRINT_LOG_FIELD)]
+        self.bloom = fingerprint.BloomFilter.create(max(fingerprint.BLOOM_CAPACITY, 2*len(fingerprints)))
+        for key in fingerprints:
+            self.bloom.add(key)
+        self.bloom.save(self.bloom_file)
+
+    def add_fingerprint(self, file_fingerprint, dicom_tuple):
+        if file_fingerprint is None:
+            return
+        self.store.set(linkLog.FINGERPRINT_LOG_FIELD, file_fingerprint, dicom_tuple)
+        if self.bloom is not None:
+            self.bloom.add(file_fingerprint)
+
+    def fingerprint_settings(self):
+        """
+        The fingerprint mode, and the file of the Bloom filter workers should load.
+        """
+        return self.fingerprint_mode, self.bloom_file if self.bloom is not None else None
+
+    def skip_fingerprint(self, file_fingerprint):
+        """
+        Counts a file as a duplicate in link_master_log if its fingerprint is known. Returns whether it was.
+        """
+        with self.lock:
+            dicom_tuple = self.store.get(linkLog.FINGERPRINT_LOG_FIELD, file_fingerprint)
+            if dicom_tuple is None:
+                return False
+            count = self.store.get(LINK_LOG_FIELDS[-1], dicom_tuple)
+            if count is None:
+                return False
+            self.store.set(LINK_LOG_FIELDS[-1], dicom_tuple, count + 1)
+            return True
+
+    def next_id(self, field, value):
+        if self.keyed_ids is not None:
+            return self.keyed_id(field, value)
+        if self.lease is not None:
+            return self.lease.next_id(field, self.store.max(field) + 1)
+        return self.store.max(field) + 1
+
+    def keyed_id(self, field, value):
+        # Derive again while the identifier is recorded for another original value, looked up in the store's index
+        # of the anonymized identifiers. The identifier returned is recorded by assign() before the next lookup.
+        attempt = 0
+        anon_value = self.keyed_ids.derive(field, value)
+        while self.store.has_value(field, anon_value):
+            attempt += 1
+            anon_value = self.keyed_ids.derive(field, value, attempt)
+        return anon_value
+
+    def assign(self, values, file_fingerprint=None):
+        """
+        Maps the (uppercased) values of DICOM_FIELDS to anonymized identifiers, creating new identifiers as needed.
+        Returns the anonymized values and whether the mrn-accession-studyID-seriesID-sopID tuple has already been
+        anonymized (or is currently being anonymized by another worker).
+        A tuple returned as not yet anonymized must be confirmed with complete() once written.
+        The fingerprint of a file found to be a duplicate is recorded, so that the file is skipped before parsing next time.
+        """
+        with self.lock:
+            anon_values = {identifier: None for identifier in IDENTIFIER_FIELDS}
+            for i_iter in range(len(DICOM_FIELDS)):
+                # Create a unique link between dicom info and anonymous keys to be stored.
+                anon_value = self.store.get(LINK_LOG_FIELDS[i_iter], values[i_iter])
+                if anon_value is None:
+                    anon_value = self.next_id(LINK_LOG_FIELDS[i_iter], values[i_iter])
+                    self.store.set(LINK_LOG_FIELDS[i_iter], values[i_iter], anon_value)
+                anon_values[IDENTIFIER_FIELDS[i_iter]] = anon_value
+
+            dicom_tuple = str(tuple(anon_values[identifier] for identifier in IDENTIFIER_FIELDS))
+            count = self.store.get(LINK_LOG_FIELDS[-1], dicom_tuple)
+            if count is not None:
+                self.store.set(LINK_LOG_FIELDS[-1], dicom_tuple, count + 1)
+                self.add_fingerprint(file_fingerprint, dicom_tuple)
+                is_duplicate = True
+            elif dicom_tuple in self.pending:
+                self.pending[dicom_tuple] += 1
+                is_duplicate = True
+            else:
+                self.pending[dicom_tuple] = 0
+                is_duplicate = False
+        return anon_values, is_duplicate
+
+    def complete(self, anon_values, success=True, file_fingerprint=None):
+        """
+        Confirms (or, on failure, releases) a tuple previously returned by assign() as not yet anonymized,
+        along with the fingerprint of its file.
+        """
+        dicom_tuple = str(tuple(anon_values[identifier] for identifier in IDENTIFIER_FIELDS))
+        with self.lock:
+            duplicates = self.pending.pop(dicom_tuple, 0)
+            if success:
+                self.store.set(LINK_LOG_FIELDS[-1], dicom_tuple, 1 + duplicates)
+                self.add_fingerprint(file_fingerprint, dicom_tuple)
+
+    def commit(self):
+        with self.lock:
+            self.store.commit()
+
+    def close(self):
+        with self.lock:
+            if self.bloom is not None:
+                # Resize the filter once it holds more fingerprints than it was sized for.
+                if self.bloom.count > self.bloom.capacity:
+                    self.rebuild_bloom()
+                else:
+                    self.bloom.save(self.bloom_file)
+            self.store.close()
+
+
+def open_allocator(link_log_dir, backend='json', fingerprint_mode='none', node=None, secret=None):
+    """
+    Opens the allocator of <link_log_dir>. Identifiers are sequential, or derived under the site <secret> if given.
+    """
+    if secret is None and backend == 'none':
+        raise ValueError('Link logs can only be left unrecorded with keyed identifiers (--id_mode hmac)')
+    keyed_ids = keyedIds.KeyedIds(secret) if secret is not None else None
+    # A node given a coordinator file (see multiNode.NodeShard) leases its identifiers, unless they are keyed.
+    lease = None
+    if keyed_ids is None and node is not None and node.coordinator is not None:
+        lease = multiNode.IdLease(node.coordinator, node.name)
+    return IdAllocator(linkLog.open_link_log(link_log_dir, backend), fingerprint_mode,
+                       os.path.join(link_log_dir, fingerprint.BLOOM_FILE_NAME), lease, keyed_ids)
+
+
+class AllocatorManager(BaseManager):
+    pass
+
+
+# The store is opened inside the manager's server process, which is then its single owner.
+AllocatorManager.register('IdAllocator', open_allocator)
@@ -0,0 +1,69 @@
+"""
+Keyed identifiers (--id_mode hmac): each anonymized identifier is derived from an HMAC-SHA256 of the original value
+under a site secret, instead of being taken from a counter. The same original value is anonymized to the same identifier
+by every run, worker and node holding the secret, so that nodes anonymize without leasing identifier ranges from a
+coordinator file (see multiNode.py), and their link logs merge without conflicts. Recording the mapping in the link logs,
+for re-identification and to skip dicoms already anonymized, becomes optional (--link_log_backend none).
+
+Identifiers are integers, which fit the link logs and shard indexes as sequential ones do. Accession numbers and study
+IDs are written to SH elements, and stay below MAX_SHORT_ID. UID elements are written as <UID_ROOT><identifier>, a valid
+DICOM UID under the 2.25 (UUID derived) root, rather than as the bare identifier.
+
+An identifier already recorded in the link logs for another original value is a collision: the identifier is derived
+again, from the original value and an attempt number, until it is free. Collisions are only detected against the link
+logs of a run, and resolved in the order values are met, so that two nodes may resolve the same rare collision
+differently. These show as conflicts when their link logs are merged.
+
+The secret is read from --secret_file, and must be kept: without it, the identifiers of later runs would no longer match.
+"""
+
+import hmac
+import hashlib
+
+ID_MODES = ('sequential', 'hmac')
+UID_ROOT = '2.25.'
+# Shortest secret accepted, in bytes.
+MIN_SECRET_BYTES = 16
+# Accession numbers and study IDs are written to SH elements of at most 16 characters,
+# other identifiers are kept within signed 64 bit integers.
+MAX_SHORT_ID = 10**16 - 1
+MAX_ID = 2**63 - 1
+MAX_IDS = {'link_mrn_log': MAX_ID,
+           'link_accession_log': MAX_SHORT_ID,
+           'link_study_log': MAX_SHORT_ID,
+           'link_series_log': MAX_ID,
+           'link_sop_log': MAX_ID}
+
+
+def load_secret(file_name):
+    """
+    Reads the site secret of --secret_file, ignoring surrounding whitespace.
+    """
+    try:
+        with open(file_name, 'rb') as secret_file:
+            secret = secret_file.read().strip()
+    except OSError as error:
+        raise ValueError('Could not read secret file {}: {}'.format(file_name, error))
+    if len(secret) < MIN_SECRET_BYTES:
+        raise ValueError('Secret file {} must hold at least {} bytes'.format(file_name, MIN_SECRET_BYTES))
+    return secret
+
+
+def uid_root(id_mode):
+    return UID_ROOT if id_mode == 'hmac' else ''
+
+
+class KeyedIds(object):
+    """
+    Derives the identifiers of each link log field from original values, under <secret>.
+    """
+    def __init__(self, secret):
+        self.secret = secret
+
+    def derive(self, field, value, attempt=0):
+        """
+        The identifier of original <value> in link log <field>, between 1 and the field's maximum.
+        """
+        message = '{}\x00{}\x00{}'.format(field, value, attempt).encode('utf-8')
+        digest = hmac.new(self.secret, message, hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') % MAX_IDS[field] + 1
@@ -0,0 +1,272 @@
+"""
+Link log backends. A link log maps each original identifier (uppercased) to its anonymized identifier, one log per
+field of LINK_LOG_FIELDS, and link_master_log counts how many times each anonymized tuple was encountered.
+link_fingerprint_log maps the content fingerprints of files already seen to their anonymized tuple (see fingerprint.py).
+
+json: the original format. All link_*_log.json files are loaded at startup, into compact in-memory indexes (see
+compactIndex.py), and rewritten in full on close.
+Mappings added since the previous commit are written to a link_log_delta_<n>.json file on each commit, and deltas
+left behind by an interrupted run are replayed at startup, so that a crash loses at most the mappings since the last commit.
+sqlite: a single link_log.sqlite database in WAL mode. Lookups are indexed, new mappings are committed in batches
+during the run, and the running maximum of each field is stored alongside the mappings.
+Existing json link logs are imported automatically the first time the sqlite backend is used on a link log directory,
+or explicitly with: python3 linkLog.py -l <linking log directory>
+none: mappings are only held in memory for the run, and never written, for keyed identifiers (see keyedIds.py) whose
+mapping need not be recorded. Dicoms are then only found to be already anonymized within a run.
+"""
+
+import os
+import re
+import sys
+import logging
+import argparse
+import sqlite3
+
+import compactIndex
+import utils
+
+LINK_LOG_FIELDS = ('link_mrn_log', 'link_accession_log', 'link_study_log', 'link_series_log', 'link_sop_log', 'link_master_log')
+FINGERPRINT_LOG_FIELD = 'link_fingerprint_log'
+# Fields held by a store: the link logs, and the fingerprint log, whose values are anonymized tuples rather than identifiers.
+STORE_FIELDS = LINK_LOG_FIELDS + (FINGERPRINT_LOG_FIELD,)
+LINK_LOG_BACKENDS = ('json', 'sqlite', 'none')
+
+SQLITE_FILE_NAME = 'link_log.sqlite'
+DELTA_FILE_NAME = re.compile(r'^link_log_delta_(\d+)\.json$')
+# Number of writes after which the sqlite backend commits its current transaction.
+COMMIT_INTERVAL = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def load_log(link_log_dir, link_log_field):
+    """
+    Loads the json link log of <link_log_field> into a compactIndex.CompactMap, empty if there is none yet.
+    """
+    value_width = compactIndex.TUPLE_WIDTH if link_log_field == FINGERPRINT_LOG_FIELD else None
+    file_name = os.path.join(link_log_dir, "{}.json".format(link_log_field))
+    if not os.path.exists(file_name):
+        return compactIndex.CompactMap(value_width)
+    message = "Loading existing {}.".format(link_log_field)
+    print(message)
+    logger.info(message)
+    return compactIndex.load(file_name, value_width)
+
+
+class JsonLinkLog(object):
+    def __init__(self, link_log_dir):
+        self.link_log_dir = link_log_dir
+        # Load cache of cases already analyzed, otherwise instantiate new caches.
+        self.link_dict = {link_log_field: load_log(link_log_dir, link_log_field) for link_log_field in STORE_FIELDS}
+        self.max_values = {link_log_field: utils.find_max(self.link_dict[link_log_field]) for link_log_field in LINK_LOG_FIELDS[:-1]}
+
+        # Replay the deltas committed by an interrupted run, in order.
+        self.delta = {link_log_field: {} for link_log_field in STORE_FIELDS}
+        self.value_index = {}
+        self.delta_files = sorted((int(match.group(1)), match.group(0)) for match in
+                                  (DELTA_FILE_NAME.match(name) for name in os.listdir(link_log_dir)) if match)
+        for _, delta_file in self.delta_files:
+            message = "Replaying {}.".format(delta_file)
+            print(message)
+            logger.info(message)
+            for link_log_field, link_dict in utils.load_json(os.path.join(link_log_dir, delta_file)).items():
+                for key, value in link_dict.items():
+                    self.set(link_log_field, key, value)
+        self.delta = {link_log_field: {} for link_log_field in STORE_FIELDS}
+
+    def get(self, field, key):
+        return self.link_dict[field].get(key)
+
+    def set(self, field, key, value):
+        self.link_dict[field][key] = value
+        self.delta[field][key] = value
+        if field in self.max_values and value > self.max_values[field]:
+            self.max_values[field] = value
+        if field in self.value_index:
+            self.value_index[field][str(value)] = 0
+
+    def max(self, field):
+        return self.max_values[field]
+
+    def has_value(self, field, value):
+        return has_value(self.value_index, self.link_dict, field, value)
+
+    def items(self, field):
+        return self.link_dict[field].items()
+
+    def commit(self):
+        # Persist the mappings added since the previous commit, without rewriting the full link logs.
+        delta = {link_log_field: link_dict for link_log_field, link_dict in self.delta.items() if link_dict}
+        if delta:
+            number = self.delta_files[-1][0] + 1 if self.delta_files else 0
+            delta_file = 'link_log_delta_{}.json'.format(number)
+            utils.save_json(delta, os.path.join(self.link_log_dir, delta_file))
+            self.delta_files.append((number, delta_file))
+            self.delta = {link_log_field: {} for link_log_field in STORE_FIELDS}
+
+    def close(self):
+        # Commit first, so that replaying the deltas after an interrupted save restores exactly the saved state.
+        self.commit()
+        # Save cache of already-visited patients.
+        for link_log_field in STORE_FIELDS:
+            if link_log_field == FINGERPRINT_LOG_FIELD and not self.link_dict[link_log_field]:
+                continue
+            compactIndex.save(self.link_dict[link_log_field], os.path.join(self.link_log_dir, "{}.json".format(link_log_field)))
+        # The full link logs now include every delta.
+        for _, delta_file in self.delta_files:
+            os.remove(os.path.join(self.link_log_dir, delta_file))
+        self.delta_files = []
+
+
+class SqliteLinkLog(object):
+    def __init__(self, link_log_dir, commit_interval=COMMIT_INTERVAL):
+        self.commit_interval = commit_interval
+        self.n_uncommitted = 0
+        self.value_indexes = set()
+
+        is_new = not os.path.isfile(os.path.join(link_log_dir, SQLITE_FILE_NAME))
+        # The connection is owned by a single allocator, which serializes its calls, possibly from several threads.
+        self.connection = sqlite3.connect(os.path.join(link_log_dir, SQLITE_FILE_NAME), isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for link_log_field in LINK_LOG_FIELDS:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID'.format(link_log_field))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID'.format(FINGERPRINT_LOG_FIELD))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS link_max (field TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+        self.max_values = {link_log_field: 0 for link_log_field in LINK_LOG_FIELDS[:-1]}
+        if is_new:
+            self.connection.execute('BEGIN')
+            import_json_logs(link_log_dir, self)
+            self.connection.execute('COMMIT')
+
+        for field, value in self.connection.execute('SELECT field, value FROM link_max'):
+            self.max_values[field] = value
+        self.connection.execute('BEGIN')
+
+    def get(self, field, key):
+        row = self.connection.execute('SELECT value FROM {} WHERE key = ?'.format(field), (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, field, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'.format(field), (key, value))
+        if field in self.max_values and value > self.max_values[field]:
+            self.max_values[field] = value
+            self.connection.execute('INSERT OR REPLACE INTO link_max (field, value) VALUES (?, ?)', (field, value))
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= self.commit_interval:
+            self.commit()
+
+    def max(self, field):
+        return self.max_values[field]
+
+    def has_value(self, field, value):
+        # The index of the anonymized identifiers of a field is only created once they are looked up, by keyed runs.
+        if field not in self.value_indexes:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS {0}_value ON {0} (value)'.format(field))
+            self.value_indexes.add(field)
+        return self.connection.execute('SELECT 1 FROM {} WHERE value = ? LIMIT 1'.format(field), (value,)).fetchone() is not None
+
+    def items(self, field):
+        return self.connection.execute('SELECT key, value FROM {}'.format(field)).fetchall()
+
+    def set_many(self, field, items):
+        self.connection.executemany('INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'.format(field), items)
+        if field in self.max_values:
+            row = self.connection.execute('SELECT MAX(value) FROM {}'.format(field)).fetchone()
+            self.max_values[field] = max(self.max_values[field], row[0] or 0)
+            self.connection.execute('INSERT OR REPLACE INTO link_max (field, value) VALUES (?, ?)', (field, self.max_values[field]))
+
+    def commit(self):
+        if self.connection.in_transaction:
+            self.connection.execute('COMMIT')
+        self.connection.execute('BEGIN')
+        self.n_uncommitted = 0
+
+    def close(self):
+        if self.connection.in_transaction:
+            self.connection.execute('COMMIT')
+        self.connection.close()
+
+
+class MemoryLinkLog(object):
+    def __init__(self):
+        value_widths = {link_log_field: compactIndex.TUPLE_WIDTH if link_log_field == FINGERPRINT_LOG_FIELD else None
+                        for link_log_field in STORE_FIELDS}
+        self.link_dict = {link_log_field: compactIndex.CompactMap(value_widths[link_log_field]) for link_log_field in STORE_FIELDS}
+        self.max_values = {link_log_field: 0 for link_log_field in LINK_LOG_FIELDS[:-1]}
+        self.value_index = {}
+
+    def get(self, field, key):
+        return self.link_dict[field].get(key)
+
+    def set(self, field, key, value):
+        self.link_dict[field][key] = value
+        if field in self.max_values and value > self.max_values[field]:
+            self.max_values[field] = value
+        if field in self.value_index:
+            self.value_index[field][str(value)] = 0
+
+    def max(self, field):
+        return self.max_values[field]
+
+    def has_value(self, field, value):
+        return has_value(self.value_index, self.link_dict, field, value)
+
+    def items(self, field):
+        return self.link_dict[field].items()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def has_value(value_index, link_dict, field, value):
+    """
+    Whether anonymized identifier <value> is recorded in <field> of the in-memory <link_dict>. The reverse index of
+    a field is built in <value_index> on its first lookup, and kept up to date by the store from then on.
+    """
+    if field not in value_index:
+        value_index[field] = compactIndex.CompactMap()
+        for _, anon_value in link_dict[field].items():
+            value_index[field][str(anon_value)] = 0
+    return str(value) in value_index[field]
+
+
+def import_json_logs(link_log_dir, store):
+    """
+    Copies the link_*_log.json files of <link_log_dir>, if any, into <store>, along with any uncompacted deltas.
+    """
+    json_log = JsonLinkLog(link_log_dir)
+    for link_log_field in STORE_FIELDS:
+        link_dict = json_log.link_dict[link_log_field]
+        if link_dict:
+            store.set_many(link_log_field, link_dict.items())
+
+
+def open_link_log(link_log_dir, backend='json'):
+    if backend == 'sqlite':
+        return SqliteLinkLog(link_log_dir)
+    if backend == 'none':
+        return MemoryLinkLog()
+    return JsonLinkLog(link_log_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Imports json link logs into the sqlite link log backend")
+    parser.add_argument("-l",
+                        "--link_log_dir",
+                        type=str,
+                        default='./linklog',
+                        help="Linking log directory")
+    args = parser.parse_args()
+
+    if os.path.isfile(os.path.join(args.link_log_dir, SQLITE_FILE_NAME)):
+        print('{} already exists in {}.'.format(SQLITE_FILE_NAME, args.link_log_dir))
+        sys.exit(1)
+
+    store = SqliteLinkLog(args.link_log_dir)
+    store.close()
+    print('Imported link logs into {}.'.format(os.path.join(args.link_log_dir, SQLITE_FILE_NAME)))
@@ -0,0 +1,265 @@
+"""
+Multi-node anonymization: several nodes (or several local processes) share one input directory, each anonymizing a
+deterministic subset of it with its own link log directory, and their link logs are merged once they are done.
+
+Subset: each top-level entry of the input directory (typically a PatientID directory) belongs to node
+crc32(name) % node_count, so that all dicoms of a patient are anonymized by the same node, and that the subsets of the
+nodes are disjoint and cover the whole input directory, whatever the order in which they are walked. The scan manifest
+of a node (--incremental) records the directories of the other nodes as seen, so the number of nodes must not change
+between incremental runs.
+
+Identifiers: a node does not continue from the running maximum of its own link logs, which would collide with the
+identifiers of the other nodes. Instead, it leases ranges of LEASE_SIZE identifiers per field from a coordinator file
+on storage shared by the nodes, and hands out identifiers from its current range. Leases are recorded in the coordinator
+file before any of their identifiers is used, under an exclusive lock on <coordinator file>.lock, so that no two nodes
+(or runs) are ever leased overlapping ranges. The unused remainder of a node's last range is left as a gap.
+Nodes deriving keyed identifiers (--id_mode hmac, see keyedIds.py) need no coordinator file, nor any other coordination.
+
+Merge: once the nodes are done, the link logs of each node directory are merged into the canonical link log directory.
+An original identifier anonymized by several nodes (e.g. a study found under two patient directories) keeps its first
+identifier, and the others are listed in merge_conflicts.json, as they may already have been written to anonymized dicoms.
+
+Usage:
+python3 multiNode.py init -c <coordinator file> -l <canonical linking log directory>
+(starts leases above the identifiers of existing link logs, before the first multi-node run)
+python3 dcmAnonymizerV02MP.py -d <input directory> -o <output directory> -l <node linking log directory>
+    --node_index <i> --node_count <n> --coordinator <coordinator file>
+python3 multiNode.py merge -l <canonical linking log directory> <node linking log directory> ...
+"""
+
+import os
+import sys
+import time
+import zlib
+import fcntl
+import socket
+import threading
+import argparse
+
+import linkLog
+import utils
+
+# Number of identifiers of a field leased at once.
+LEASE_SIZE = 10000
+CONFLICTS_FILE_NAME = 'merge_conflicts.json'
+
+
+def node_of(name, node_count):
+    return zlib.crc32(name.encode('utf-8')) % node_count
+
+
+class NodeShard(object):
+    """
+    Node <index> of <node_count>, leasing identifiers from <coordinator> when there are several nodes, unless its
+    identifiers are keyed.
+    """
+    def __init__(self, index=0, node_count=1, coordinator=None, id_mode='sequential'):
+        if node_count < 1 or not 0 <= index < node_count:
+            raise ValueError('Invalid node index {} of {} nodes'.format(index, node_count))
+        if node_count > 1 and coordinator is None and id_mode != 'hmac':
+            raise ValueError('A coordinator file is required to run on several nodes')
+        self.index = index
+        self.node_count = node_count
+        self.coordinator = coordinator
+        self.name = '{}@{}'.format(index, socket.gethostname())
+
+    def owns(self, dcm_directory, path):
+        """
+        Whether the file or directory <path>, within <dcm_directory>, belongs to this node.
+        """
+        if self.node_count == 1:
+            return True
+        relative_path = os.path.relpath(path, dcm_directory)
+        return node_of(relative_path.split(os.sep)[0], self.node_count) == self.index
+
+    def select(self, dcm_directory, walk):
+        """
+        Filters the (root, file names) pairs of <walk> over <dcm_directory> down to the files of this node.
+        """
+        for root, files in walk:
+            if os.path.normpath(root) == os.path.normpath(dcm_directory):
+                files = [name for name in files if self.owns(dcm_directory, os.path.join(root, name))]
+            elif not self.owns(dcm_directory, root):
+                continue
+            if files:
+                yield root, files
+
+
+class Coordinator(object):
+    """
+    Coordinator file, holding the next identifier to lease of each field, and the leases handed out.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock_file_name = '{}.lock'.format(file_name)
+        self.lock_fd = None
+        # POSIX record locks are held per process, so threads of a process are excluded by a lock of their own.
+        self.thread_lock = threading.Lock()
+
+    def lock(self):
+        # A POSIX record lock on a lock file which is never removed: it is released by the system when its process
+        # dies, so that no lock is ever left behind to be broken, and is honoured across nodes on NFS.
+        self.thread_lock.acquire()
+        try:
+            fd = os.open(self.lock_file_name, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        self.lock_fd = fd
+
+    def unlock(self):
+        fd, self.lock_fd = self.lock_fd, None
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+            self.thread_lock.release()
+
+    def update(self, function):
+        """
+        Applies <function> to the coordinator state under the lock, and saves the state. Returns the function's result.
+        """
+        self.lock()
+        try:
+            state = utils.load_json(self.file_name) or {'next': {}, 'leases': []}
+            result = function(state)
+            utils.save_json(state, self.file_name)
+        finally:
+            self.unlock()
+        return result
+
+    def lease(self, node_name, field, floor, size=LEASE_SIZE):
+        """
+        Leases <size> identifiers of <field> to <node_name>, starting no lower than <floor>. Returns the range [start, end).
+        """
+        def lease(state):
+            start = max(state['next'].get(field, 1), floor)
+            state['next'][field] = start + size
+            state['leases'].append({'node': node_name, 'field': field, 'start': start, 'end': start + size, 'time': time.time()})
+            return start, start + size
+        return self.update(lease)
+
+    def raise_floor(self, max_values):
+        """
+        Starts future leases above <max_values>, the maximum identifier of each field in existing link logs.
+        """
+        def raise_floor(state):
+            for field, value in max_values.items():
+                state['next'][field] = max(state['next'].get(field, 1), value + 1)
+        self.update(raise_floor)
+
+
+class IdLease(object):
+    """
+    Identifiers handed out by a node from its leased ranges, leasing a new range whenever the current one is used up.
+    """
+    def __init__(self, coordinator_file, node_name):
+        self.coordinator = Coordinator(coordinator_file)
+        self.node_name = node_name
+        self.ranges = {}
+
+    def next_id(self, field, floor):
+        start, end = self.ranges.get(field, (0, 0))
+        if start >= end:
+            start, end = self.coordinator.lease(self.node_name, field, floor)
+        self.ranges[field] = (start + 1, end)
+        return start
+
+
+def open_store(link_log_dir):
+    backend = 'sqlite' if os.path.isfile(os.path.join(link_log_dir, linkLog.SQLITE_FILE_NAME)) else 'json'
+    return linkLog.open_link_log(link_log_dir, backend)
+
+
+def merge_link_logs(link_log_dir, node_dirs, backend='json'):
+    """
+    Merges the link logs of <node_dirs> into those of <link_log_dir>. Returns the conflicts found, as
+    {field: {original identifier: [identifier kept, other identifiers]}}, which are also saved to merge_conflicts.json.
+    Duplicate counts of link_master_log are merged by their maximum, so that node directories started from a copy of
+    the canonical link logs, or merged again, are not counted twice.
+    """
+    store = linkLog.open_link_log(link_log_dir, backend)
+    conflicts = utils.load_json(os.path.join(link_log_dir, CONFLICTS_FILE_NAME)) or {}
+    for node_dir in node_dirs:
+        print('Merging link logs of {}.'.format(node_dir))
+        node_store = open_store(node_dir)
+        for link_log_field in linkLog.LINK_LOG_FIELDS[:-1]:
+            for key, value in node_store.items(link_log_field):
+                existing = store.get(link_log_field, key)
+                if existing is None:
+                    store.set(link_log_field, key, value)
+                elif existing != value:
+                    identifiers = conflicts.setdefault(link_log_field, {}).setdefault(key, [existing])
+                    if value not in identifiers:
+                        identifiers.append(value)
+        master_field = linkLog.LINK_LOG_FIELDS[-1]
+        for key, count in node_store.items(master_field):
+            existing = store.get(master_field, key)
+            if existing is None or count > existing:
+                store.set(master_field, key, count)
+        for key, value in node_store.items(linkLog.FINGERPRINT_LOG_FIELD):
+            if store.get(linkLog.FINGERPRINT_LOG_FIELD, key) is None:
+                store.set(linkLog.FINGERPRINT_LOG_FIELD, key, value)
+        node_store.close()
+        store.commit()
+    store.close()
+
+    if conflicts:
+        utils.save_json(conflicts, os.path.join(link_log_dir, CONFLICTS_FILE_NAME))
+        print('{} original identifiers were anonymized differently by several nodes, see {}.'
+              .format(sum(len(field_conflicts) for field_conflicts in conflicts.values()), CONFLICTS_FILE_NAME))
+    return conflicts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepares and merges multi-node anonymization runs")
+    subparsers = parser.add_subparsers(dest='command')
+    init_parser = subparsers.add_parser('init', help="Starts the leases of a coordinator file above existing link logs")
+    init_parser.add_argument("-c",
+                             "--coordinator",
+                             type=str,
+                             required=True,
+                             help="Coordinator file shared by the nodes")
+    init_parser.add_argument("-l",
+                             "--link_log_dir",
+                             type=str,
+                             default='./linklog',
+                             help="Canonical linking log directory")
+    merge_parser = subparsers.add_parser('merge', help="Merges the link logs of the nodes into the canonical link logs")
+    merge_parser.add_argument("-l",
+                              "--link_log_dir",
+                              type=str,
+                              default='./linklog',
+                              help="Canonical linking log directory")
+    merge_parser.add_argument("-b",
+                              "--link_log_backend",
+                              type=str,
+                              default='json',
+                              choices=['json', 'sqlite'],
+                              help="Link log storage of the canonical linking log directory")
+    merge_parser.add_argument("node_dirs",
+                              type=str,
+                              nargs='+',
+                              help="Linking log directories of the nodes")
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        max_values = {}
+        if os.path.isdir(args.link_log_dir):
+            store = open_store(args.link_log_dir)
+            max_values = {link_log_field: store.max(link_log_field) for link_log_field in linkLog.LINK_LOG_FIELDS[:-1]}
+            store.close()
+        Coordinator(args.coordinator).raise_floor(max_values)
+        print('Leases of {} start above {}.'.format(args.coordinator, max_values))
+    elif args.command == 'merge':
+        utils.make_dirs(args.link_log_dir)
+        merge_link_logs(args.link_log_dir, args.node_dirs, args.link_log_backend)
+        print('Merged link logs into {}.'.format(args.link_log_dir))
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,196 @@
+"""
+Output writer: writes the files of anonymized dicoms from a small pool of threads, so that disk and network file system
+writes overlap with the parsing, pixel decoding and compression of the next dicoms.
+
+The anonymization loop builds each output fully in memory (the dicom header, and the hdf5 pixel file image), and hands
+it over with a callback. Each file is written under a temporary name, flushed to disk, and renamed to its final name,
+so that an interrupted run never leaves a truncated file behind. The directories of the output are then flushed to disk
+too, so that the renames survive a crash. The callback runs once all files of the output are in place, and is where
+a dicom is confirmed to the link logs: a dicom is only ever recorded as anonymized once its files exist.
+
+The programs mark each output directory with a RUN_MARKER file while they run. The temporary files of a run
+interrupted before it could remove its marker are removed by the next run, which only walks the output directories
+when it finds a marker, and leaves temporary files younger than STALE_TEMP_AGE to the other runs which may be writing
+to the same directories (e.g. other nodes).
+
+At most WRITER_PENDING_BYTES of outputs wait to be written; the anonymization loop blocks beyond that. Output directories
+are created once per process and remembered, rather than checked for on every file.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of writing threads, and bytes of outputs waiting to be written before the anonymization loop blocks.
+WRITER_THREADS = 2
+WRITER_PENDING_BYTES = 256*10**6
+
+# Output directories created (or found to exist) by this process.
+created_dirs = set()
+
+TEMP_SUFFIX = '.tmp'
+RUN_MARKER = '.anonymizing'
+# Seconds after their last modification from which the temporary files of an interrupted run are removed.
+STALE_TEMP_AGE = 3600
+
+
+def make_dirs(path):
+    if path not in created_dirs:
+        os.makedirs(path, exist_ok=True)
+        created_dirs.add(path)
+
+
+def sync_directory(path):
+    # Flush the entries of directory <path>, e.g. a file renamed into it, to disk.
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(file_name, data, sync=True):
+    """
+    Writes <data> to <file_name> through a temporary file, which is flushed to disk before being renamed.
+    <data> is either bytes, or a function writing the file to the (readable) file object it is given, for files too
+    large to be built in memory. The directory is flushed to disk after the rename, unless <sync> is False, in which
+    case the caller flushes it with sync_directory.
+    """
+    directory = os.path.dirname(file_name)
+    make_dirs(directory)
+    temp_file_name = '{}{}'.format(file_name, TEMP_SUFFIX)
+    try:
+        outfile = open(temp_file_name, 'w+b')
+    except FileNotFoundError:
+        # The directory was removed since it was created: forget it, and create it again.
+        created_dirs.discard(directory)
+        make_dirs(directory)
+        outfile = open(temp_file_name, 'w+b')
+    try:
+        with outfile:
+            if callable(data):
+                data(outfile)
+            else:
+                outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temp_file_name, file_name)
+        if sync:
+            sync_directory(directory)
+    except OSError:
+        # Do not leave a partial file behind, e.g. taking up space on a full disk.
+        if os.path.isfile(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+
+class OutputWriter(object):
+    """
+    Writes outputs, each a list of (file name, bytes) written in order, then calls the output's callback with None,
+    or with the exception that prevented writing it. With 0 threads, outputs are written by the caller, as submitted.
+    Time spent writing is recorded as the write stage of <run_metrics>, if given.
+    """
+    def __init__(self, n_threads=WRITER_THREADS, max_pending_bytes=WRITER_PENDING_BYTES, run_metrics=None):
+        self.executor = ThreadPoolExecutor(n_threads) if n_threads else None
+        self.max_pending_bytes = max_pending_bytes
+        self.run_metrics = run_metrics
+        self.condition = threading.Condition()
+        self.pending_bytes = 0
+        self.pending = 0
+
+    def submit(self, files, callback):
+        size = sum(len(data) for file_name, data in files)
+        with self.condition:
+            # Always accept an output when none is pending, however large.
+            self.condition.wait_for(lambda: not self.pending or self.pending_bytes + size <= self.max_pending_bytes)
+            self.pending_bytes += size
+            self.pending += 1
+        if self.executor is None:
+            self.write(files, callback, size)
+        else:
+            self.executor.submit(self.write, files, callback, size)
+
+    def write(self, files, callback, size):
+        start = time.perf_counter()
+        error = None
+        try:
+            # The files of an output usually share a directory, which is flushed once they are all in place.
+            for file_name, data in files:
+                write_atomic(file_name, data, sync=False)
+            for directory in set(os.path.dirname(file_name) for file_name, data in files):
+                sync_directory(directory)
+        except Exception as write_error:
+            error = write_error
+        if self.run_metrics is not None:
+            self.run_metrics.record('write', time.perf_counter() - start)
+        try:
+            callback(error)
+        finally:
+            with self.condition:
+                self.pending_bytes -= size
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def flush(self):
+        """
+        Waits until all submitted outputs are written, and their callbacks have run.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def open_writer(export_options, run_metrics=None):
+    """
+    Returns an OutputWriter with the number of threads of the export options (see pixelExport.make_export_options).
+    """
+    n_threads = export_options['writer_threads'] if export_options is not None else WRITER_THREADS
+    return OutputWriter(n_threads, run_metrics=run_metrics)
+
+
+def remove_temp_files(out_dir, min_age=STALE_TEMP_AGE):
+    """
+    Removes the temporary files under <out_dir> last modified at least <min_age> seconds ago. Returns their number.
+    """
+    n_removed = 0
+    now = time.time()
+    for root, dirs, files in os.walk(out_dir):
+        for name in files:
+            if not name.endswith(TEMP_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            try:
+                if now - os.path.getmtime(path) >= min_age:
+                    os.remove(path)
+                    n_removed += 1
+            except OSError:
+                # Renamed or removed meanwhile by the run writing it.
+                continue
+    return n_removed
+
+
+def begin_run(out_dir):
+    """
+    Marks <out_dir> as written to by a run, after removing the stale temporary files of an earlier run interrupted
+    while writing to it.
+    """
+    make_dirs(out_dir)
+    marker = os.path.join(out_dir, RUN_MARKER)
+    if os.path.isfile(marker):
+        n_removed = remove_temp_files(out_dir)
+        if n_removed:
+            print('Removed {} temporary files left in {} by an interrupted run.'.format(n_removed, out_dir))
+    with open(marker, 'w'):
+        pass
+
+
+def end_run(out_dir):
+    try:
+        os.remove(os.path.join(out_dir, RUN_MARKER))
+    except FileNotFoundError:
+        pass
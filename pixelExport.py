@@ -0,0 +1,338 @@
+"""
+Pixel export: writes the pixel array of a dicom to an hdf5 file, with a selectable compression codec and chunk shape.
+
+Codecs: none, lzf, gzip[:level] (level 0-9, default 4), and blosc[:compressor[:level]] / lz4 when hdf5plugin is installed.
+Chunks: auto (chosen by h5py), frame (one chunk per frame/image), or explicit comma-separated chunk dimensions.
+
+Memory budget: a multi-frame dicom whose decoded pixel array would not fit in the memory budget (e.g. breast
+tomosynthesis, or long multi-frame CT and US) is never decoded whole. Its frames are read and decoded a batch at a
+time (see PixelFrames) and appended to a resizable dataset chunked by frame, so that neither its PixelData nor its
+pixel array is ever held in memory in full. Uncompressed pixel data is read batch by batch straight from the file,
+at the offset of each frame. Compressed pixel data is decoded frame by frame with pydicom's iter_pixels (pydicom 3),
+and decoded whole with older pydicom versions. A single frame larger than the budget, the pixel data of deflated
+dicoms (whose value offsets are offsets into their inflated stream), and compressed dicoms built in memory rather than
+read from a file or buffer, are still decoded whole. Frames are read from the BytesIO a dicom was read from whichever
+pydicom version kept it (as the dataset's buffer with pydicom 3, as its filename before).
+"""
+
+import time
+import itertools
+import contextlib
+
+import numpy as np
+import h5py
+
+import codecRegistry
+import outputWriter
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+try:
+    from pydicom.pixels import iter_pixels
+except ImportError:
+    iter_pixels = None
+
+DEFAULT_CODEC = 'gzip'
+DEFAULT_CHUNKS = 'auto'
+DEFAULT_GZIP_LEVEL = 4
+DEFAULT_MEMORY_BUDGET = 1024*10**6
+# Copies of a batch of frames held at once while it is exported (the bytes read, the decoded frames, and the frames
+# masked or byte swapped, or stacked), which the memory budget is divided by.
+BATCH_COPIES = 3
+
+# Uncompressed transfer syntaxes, with the byte order of their pixel data.
+# The pixel data of deflated explicit VR little endian is inflated by pydicom while the file is read.
+NATIVE_TRANSFER_SYNTAXES = {'1.2.840.10008.1.2': '<',
+                            '1.2.840.10008.1.2.1': '<',
+                            '1.2.840.10008.1.2.1.99': '<',
+                            '1.2.840.10008.1.2.2': '>'}
+# The offsets of the values of a deflated dicom are offsets into its inflated stream, not into its file, so that its
+# frames cannot be read batch by batch from the file. Its pixel data is decoded whole.
+DEFLATED_TRANSFER_SYNTAX = '1.2.840.10008.1.2.1.99'
+# Names of in-memory hdf5 files, which must be unique among the files open in a process.
+memory_file_names = itertools.count()
+
+# Photometric interpretations stored as-is by the native pixel path. Others (YBR_*) are left to pydicom's handlers.
+NATIVE_PHOTOMETRIC_INTERPRETATIONS = ('MONOCHROME1', 'MONOCHROME2', 'RGB', 'PALETTE COLOR')
+
+
+def parse_codec(codec):
+    """
+    Returns the h5py create_dataset keyword arguments of a codec specification. Raises ValueError for unknown or
+    unavailable codecs, so that the specification can be validated once at startup.
+    """
+    name, _, options = codec.lower().partition(':')
+    if name == 'none':
+        return {}
+    elif name == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    elif name == 'gzip':
+        level = int(options) if options else DEFAULT_GZIP_LEVEL
+        if not 0 <= level <= 9:
+            raise ValueError('gzip level must be between 0 and 9, got {}'.format(level))
+        return {'compression': 'gzip', 'compression_opts': level, 'shuffle': True}
+    elif name in ('blosc', 'lz4'):
+        if hdf5plugin is None:
+            raise ValueError('codec {} requires the hdf5plugin package (pip install hdf5plugin)'.format(codec))
+        if name == 'lz4':
+            return dict(hdf5plugin.LZ4())
+        compressor, _, level = options.partition(':')
+        return dict(hdf5plugin.Blosc(cname=compressor or 'lz4', clevel=int(level) if level else 5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError('unknown codec {}'.format(codec))
+
+
+def parse_chunks(chunks):
+    if chunks in ('auto', 'frame'):
+        return chunks
+    try:
+        return tuple(int(dim) for dim in chunks.split(','))
+    except ValueError:
+        raise ValueError('chunks must be auto, frame, or comma-separated integers, got {}'.format(chunks))
+
+
+def make_export_options(codec=DEFAULT_CODEC, chunks=DEFAULT_CHUNKS, output_mode='files', shard_by='group', shard_size=0,
+                        tag_plan=None, writer_threads=outputWriter.WRITER_THREADS, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Output settings shared by write_dicom and the shard writer. With output_mode 'shard', instances are appended to
+    hdf5 shards (see shardWriter.py) keyed by the output grouping (shard_by 'group') or by series (shard_by 'series'),
+    and shards are rolled over once they exceed shard_size bytes (0 for no limit). With output_mode 'tar', the files of
+    each instance are packed into tar shards instead, keyed and rolled over the same way.
+    tag_plan is the compiled anonymization profile of the headers (see anonProfile.py), None for the default profile.
+    With output_mode 'files', writer_threads is the number of threads writing the files of each worker (see outputWriter.py).
+    memory_budget is the size in bytes above which pixel arrays are exported a batch of frames at a time (0 for no limit).
+    """
+    if writer_threads < 0:
+        raise ValueError('writer_threads must be 0 or more, got {}'.format(writer_threads))
+    if memory_budget < 0:
+        raise ValueError('memory_budget must be 0 or more, got {}'.format(memory_budget))
+    return {'codec': parse_codec(codec), 'chunks': parse_chunks(chunks),
+            'output_mode': output_mode, 'shard_by': shard_by, 'shard_size': shard_size, 'tag_plan': tag_plan,
+            'writer_threads': writer_threads, 'memory_budget': memory_budget}
+
+
+def native_layout(ods):
+    """
+    Layout of the pixel data of an uncompressed dicom, for the native pixel path: its stored dtype, number of frames,
+    frame shape and bit depth. Returns None when the dicom is not eligible.
+    """
+    transfer_syntax = ods.file_meta.TransferSyntaxUID if "TransferSyntaxUID" in ods.file_meta else None
+    if transfer_syntax not in NATIVE_TRANSFER_SYNTAXES:
+        return None
+    if ods.get('BitsAllocated') not in (8, 16, 32, 64) or ods.get('PhotometricInterpretation') not in NATIVE_PHOTOMETRIC_INTERPRETATIONS:
+        return None
+
+    bits_allocated = ods.BitsAllocated
+    is_signed = ods.get('PixelRepresentation') == 1
+    return {'dtype': np.dtype('{}{}{}'.format(NATIVE_TRANSFER_SYNTAXES[transfer_syntax], 'i' if is_signed else 'u', bits_allocated // 8)),
+            'frames': int(ods.get('NumberOfFrames') or 1), 'rows': ods.Rows, 'columns': ods.Columns,
+            'samples': ods.get('SamplesPerPixel') or 1, 'planar': ods.get('PlanarConfiguration') == 1,
+            'bits_allocated': bits_allocated, 'bits_stored': ods.get('BitsStored') or bits_allocated, 'is_signed': is_signed}
+
+
+def frame_size(layout):
+    return layout['rows']*layout['columns']*layout['samples']*layout['dtype'].itemsize
+
+
+def native_frames(buffer, layout, frames):
+    """
+    Builds the pixel array of <frames> consecutive frames from their bytes <buffer>, with a leading frame axis.
+    The array is a read-only view of the buffer unless unused high bits have to be masked or sign-extended.
+    """
+    dtype = layout['dtype']
+    rows, columns, samples = layout['rows'], layout['columns'], layout['samples']
+    pixel_array = np.frombuffer(buffer, dtype=dtype, count=frames*rows*columns*samples)
+
+    bits_stored, bits_allocated = layout['bits_stored'], layout['bits_allocated']
+    if bits_stored < bits_allocated:
+        # Match pydicom: discard unused high bits, and sign-extend signed values.
+        shift = bits_allocated - bits_stored
+        if layout['is_signed']:
+            pixel_array = (pixel_array << shift) >> shift
+        else:
+            pixel_array = pixel_array & np.array((1 << bits_stored) - 1, dtype=dtype)
+
+    if not dtype.isnative:
+        pixel_array = pixel_array.astype(dtype.newbyteorder('='))
+
+    if samples > 1:
+        if layout['planar']:
+            return np.moveaxis(pixel_array.reshape(frames, samples, rows, columns), 1, -1)
+        return pixel_array.reshape(frames, rows, columns, samples)
+    return pixel_array.reshape(frames, rows, columns)
+
+
+def native_pixel_array(ods):
+    """
+    Builds the pixel array of an uncompressed dicom directly from its PixelData buffer, bypassing pydicom's pixel data
+    handlers. The array is a read-only view of the buffer unless unused high bits have to be masked or sign-extended.
+    Returns None when the dicom is not eligible, in which case ods.pixel_array should be used.
+    """
+    layout = native_layout(ods)
+    if layout is None:
+        return None
+    pixel_array = native_frames(ods.PixelData, layout, layout['frames'])
+    if layout['frames'] == 1:
+        pixel_array = pixel_array[0]
+    return pixel_array
+
+
+def get_pixel_array(ods, run_metrics=None):
+    """
+    Decodes the pixel array of dicom <ods>, through the native pixel path or the decoder of its transfer syntax
+    (see codecRegistry.py). The decode time is recorded in <run_metrics>, if given.
+    """
+    start = time.perf_counter()
+    pixel_array = native_pixel_array(ods)
+    decoder = codecRegistry.NATIVE_DECODER
+    if pixel_array is None:
+        pixel_array, decoder = codecRegistry.decode(ods)
+    codecRegistry.record(run_metrics, ods, decoder, start)
+    return pixel_array
+
+
+def source_buffer(ods):
+    """
+    The BytesIO dicom <ods> was read from, None if it was read from a file or built in memory. pydicom 3 keeps it as
+    the dataset's buffer, older versions as its filename.
+    """
+    buffer = getattr(ods, 'buffer', None)
+    if buffer is None and hasattr(getattr(ods, 'filename', None), 'seek'):
+        buffer = ods.filename
+    return buffer
+
+
+class PixelFrames(object):
+    """
+    Pixel data of a multi-frame dicom <ods>, read and decoded <batch_frames> frames at a time. Iterating yields the
+    pixel arrays of consecutive batches of frames, with a leading frame axis. <layout> is the native layout of
+    uncompressed dicoms, None for compressed dicoms (decoded with iter_pixels).
+    """
+    def __init__(self, ods, batch_frames, layout=None):
+        self.ods = ods
+        self.batch_frames = batch_frames
+        self.layout = layout
+
+    def open(self):
+        # The dicom's file, or the BytesIO it was read from, which is left open.
+        if isinstance(self.ods.filename, str):
+            return open(self.ods.filename, 'rb')
+        buffer = source_buffer(self.ods)
+        buffer.seek(0)
+        return contextlib.nullcontext(buffer)
+
+    def __iter__(self):
+        if self.layout is not None:
+            return self.native_batches()
+        return self.decoded_batches()
+
+    def native_batches(self):
+        layout = self.layout
+        size = frame_size(layout)
+        element = self.ods.get_item('PixelData', keep_deferred=True)
+        if element.value is not None:
+            # PixelData small enough to have been read with the header.
+            for start in range(0, layout['frames'], self.batch_frames):
+                frames = min(self.batch_frames, layout['frames'] - start)
+                yield native_frames(memoryview(element.value)[start*size:(start + frames)*size], layout, frames)
+            return
+        with self.open() as f:
+            f.seek(element.value_tell)
+            for start in range(0, layout['frames'], self.batch_frames):
+                frames = min(self.batch_frames, layout['frames'] - start)
+                buffer = f.read(frames*size)
+                if len(buffer) < frames*size:
+                    raise EOFError('PixelData ends within frame {} of {}'.format(start + len(buffer)//size, layout['frames']))
+                yield native_frames(buffer, layout, frames)
+
+    def decoded_batches(self):
+        with self.open() as f:
+            batch = []
+            for frame in iter_pixels(f, **codecRegistry.iter_options(self.ods)):
+                batch.append(frame)
+                if len(batch) == self.batch_frames:
+                    yield np.stack(batch)
+                    batch = []
+            if batch:
+                yield np.stack(batch)
+
+
+def frame_stream(ods, export_options=None):
+    """
+    Returns the PixelFrames of dicom <ods> if its pixel array does not fit in the memory budget of <export_options>,
+    and None if it should be decoded whole.
+    """
+    memory_budget = export_options['memory_budget'] if export_options is not None else DEFAULT_MEMORY_BUDGET
+    frames = int(ods.get('NumberOfFrames') or 1)
+    if not memory_budget or frames < 2 or 'PixelData' not in ods:
+        return None
+    if ods.file_meta.get('TransferSyntaxUID') == DEFLATED_TRANSFER_SYNTAX:
+        return None
+    layout = native_layout(ods)
+    if layout is not None:
+        size = frame_size(layout)
+    elif iter_pixels is not None and (isinstance(getattr(ods, 'filename', None), str) or source_buffer(ods) is not None):
+        # Compressed frames are decoded from the dicom's file or buffer, so that a dicom built in memory is decoded whole.
+        size = ods.Rows*ods.Columns*(ods.get('SamplesPerPixel') or 1)*max(1, (ods.get('BitsAllocated') or 8)//8)
+    else:
+        return None
+    if frames*size*BATCH_COPIES <= memory_budget:
+        return None
+    return PixelFrames(ods, max(1, memory_budget//(BATCH_COPIES*size)), layout)
+
+
+def create_frame_dataset(group, name, pixel_frames, export_options):
+    """
+    Creates dataset <name> of <group> from the batches of <pixel_frames>, appending each batch as it is decoded.
+    """
+    codec = export_options['codec']
+    chunks = export_options['chunks']
+    dataset = None
+    for batch in pixel_frames:
+        if dataset is None:
+            # A resizable dataset has to be chunked, by frame unless chunks are given.
+            frame_shape = batch.shape[1:]
+            dataset = group.create_dataset(name, (0,) + frame_shape, maxshape=(None,) + frame_shape, dtype=str(batch.dtype),
+                                           chunks=(1,) + frame_shape if chunks in ('auto', 'frame') else chunks, **codec)
+        start = dataset.shape[0]
+        dataset.resize(start + len(batch), axis=0)
+        dataset[start:] = batch
+    return dataset
+
+
+def create_pixel_dataset(group, name, pixel_array, export_options=None, frames=1):
+    """
+    Creates dataset <name> of <group> holding <pixel_array>, a numpy array or PixelFrames.
+    """
+    if export_options is None:
+        export_options = make_export_options()
+    if isinstance(pixel_array, PixelFrames):
+        return create_frame_dataset(group, name, pixel_array, export_options)
+    codec = export_options['codec']
+
+    chunks = export_options['chunks']
+    if chunks == 'frame':
+        chunks = (1,) + pixel_array.shape[1:] if frames > 1 else pixel_array.shape
+    elif chunks == 'auto':
+        chunks = True if codec else None
+
+    return group.create_dataset(name, pixel_array.shape, data=pixel_array, dtype=str(pixel_array.dtype), chunks=chunks, **codec)
+
+
+def write_pixel_array(pixel_array, file_name, export_options=None, frames=1):
+    """
+    Writes the hdf5 pixel file of <pixel_array> (a numpy array or PixelFrames) to <file_name>, a path or file object.
+    """
+    with h5py.File(file_name, 'w') as f:
+        create_pixel_dataset(f, "pixel_array", pixel_array, export_options, frames)
+
+
+def pixel_file_image(pixel_array, export_options=None, frames=1):
+    """
+    Builds the hdf5 pixel file of write_pixel_array in memory, and returns its bytes.
+    """
+    with h5py.File('pixel_array_{}'.format(next(memory_file_names)), 'w', driver='core', backing_store=False) as f:
+        create_pixel_dataset(f, "pixel_array", pixel_array, export_options, frames)
+        f.flush()
+        return f.id.get_file_image()
@@ -0,0 +1,118 @@
+"""
+Read-ahead of the files to be anonymized, so that disk and network file system reads overlap with parsing, pixel
+decoding and compression of the current file.
+
+A small pool of threads reads whole files into memory ahead of the anonymization loop, keeping at most the read-ahead
+window (in bytes) of files read but not yet consumed. Each file is handed over as a BytesIO, which pydicom reads like
+the file itself. Files larger than the window are not prefetched, and are handed over as paths to be read as usual.
+Archive members (see archiveReader.py) have no path of their own, and are always handed over as a BytesIO.
+
+When files may be skipped from their first bytes alone (fingerprint skipping, see fingerprint.py), only the head of
+each file is read ahead, so that files skipped as duplicates are never read in full. The rest of a file which is not
+skipped is read by the anonymization loop, through Prefetcher.whole.
+A file which cannot be read ahead, for whatever reason, is handed over as its path, for the anonymization loop to read
+and report as it would without read-ahead.
+"""
+
+import os
+import time
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import archiveReader
+
+# Default read-ahead window, in bytes, and number of reading threads.
+PREFETCH_BYTES = 64*10**6
+PREFETCH_THREADS = 4
+
+
+def read_file(f, head_bytes=None):
+    # Archive members are read whole, as reading their head costs about as much as reading all of it.
+    if archiveReader.is_member(f):
+        return BytesIO(archiveReader.read_member(f))
+    with open(f, 'rb') as infile:
+        return BytesIO(infile.read(head_bytes if head_bytes is not None else -1))
+
+
+class Prefetcher(object):
+    """
+    Iterating over a Prefetcher yields (file path, BytesIO or file path) for each of <files>, in order.
+    <sizes> are the file sizes, if already known. A window of 0 disables read-ahead.
+    Time spent waiting for a file still being read is recorded as the read stage of <run_metrics>, if given.
+    With <head_bytes>, only the first <head_bytes> of each file are read ahead, and whole() must be called for the
+    files which are read further.
+    """
+    def __init__(self, files, sizes=None, window=PREFETCH_BYTES, n_threads=PREFETCH_THREADS, run_metrics=None, head_bytes=None):
+        self.files = files
+        self.sizes = sizes if sizes is not None else [os.path.getsize(f) for f in files]
+        self.window = window
+        self.n_threads = n_threads
+        self.run_metrics = run_metrics
+        self.head_bytes = head_bytes
+
+    def open(self, f):
+        # Source of a file read by the anonymization loop itself.
+        if not archiveReader.is_member(f):
+            return f
+        start = time.perf_counter()
+        try:
+            return read_file(f)
+        except Exception:
+            return f
+        finally:
+            if self.run_metrics is not None:
+                self.run_metrics.record('read', time.perf_counter() - start)
+
+    def whole(self, f, source):
+        """
+        The source of the whole file <f>, from the <source> it was handed over as.
+        """
+        if not isinstance(source, BytesIO) or self.head_bytes is None or archiveReader.is_member(f):
+            return source
+        # A head which filled the bytes read ahead may be followed by the rest of the file, whatever its size was
+        # when it was scanned.
+        if len(source.getbuffer()) >= self.head_bytes:
+            return self.open(f)
+        return source
+
+    def __iter__(self):
+        if not self.window:
+            for f in self.files:
+                yield f, self.open(f)
+            return
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            pending = deque()
+            window_bytes = 0
+            i_next = 0
+            while i_next < len(self.files) or pending:
+                # Read ahead while the window has room, and always keep at least the next file in flight.
+                # Files larger than the window are read by the anonymization loop itself, and take no room.
+                while i_next < len(self.files):
+                    f, size = self.files[i_next], self.sizes[i_next]
+                    if self.head_bytes is not None and not archiveReader.is_member(f):
+                        size = min(size, self.head_bytes)
+                    if size > self.window:
+                        pending.append((f, None, 0))
+                    elif not pending or window_bytes + size <= self.window:
+                        pending.append((f, executor.submit(read_file, f, self.head_bytes), size))
+                        window_bytes += size
+                    else:
+                        break
+                    i_next += 1
+
+                f, future, size = pending.popleft()
+                window_bytes -= size
+                if future is None:
+                    yield f, self.open(f)
+                    continue
+                start = time.perf_counter()
+                try:
+                    source = future.result()
+                except Exception:
+                    # Let the anonymization loop report the file as it would without read-ahead.
+                    source = f
+                if self.run_metrics is not None:
+                    self.run_metrics.record('read', time.perf_counter() - start)
+                yield f, source
@@ -0,0 +1,233 @@
+"""
+Run metrics: wall time spent per stage of the anonymization, and counters of files and bytes processed.
+
+Stages: scan (walking and classifying the input directory), read (waiting for file reads not hidden by read-ahead),
+fingerprint (fingerprinting a file and looking up its fingerprint), parse (parsing the dicom header), id_mapping
+(allocating anonymized identifiers), build_header (building the anonymized dicom), pixel_decode (getting the pixel
+array), pixel_export (compressing the hdf5 pixel file, or appending to a shard), header_write (encoding the anonymized
+dicom), and write (writing the output files, in the writer threads of outputWriter.py). Each stage has a latency
+histogram, with LATENCY_BUCKETS upper bounds. Decode times are also broken down by transfer syntax and decoder
+(see codecRegistry.py), under decoders.
+Counters include the duplicates skipped by their fingerprint before parsing, the bytes of output written, and the
+dicoms which could not be written for lack of space.
+Gauges hold the current state of the run: bytes and files remaining, and chunks in flight or waiting to be dispatched.
+
+In the multiprocessing version, each task records its own metrics, which are merged into the run's metrics as tasks
+complete, so stage times are summed over workers.
+
+With --metrics_file, a MetricsExporter rewrites the metrics every --metrics_interval seconds while the run progresses:
+as json to the metrics file, and in the Prometheus text format to the same file name with a .prom extension
+(e.g. for the node exporter's textfile collector).
+"""
+
+import os
+import sys
+import time
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import utils
+
+STAGES = ('scan', 'read', 'fingerprint', 'parse', 'id_mapping', 'build_header', 'pixel_decode', 'pixel_export', 'header_write', 'write')
+COUNTERS = ('files', 'bytes', 'anonymized', 'duplicates', 'fingerprint_skips', 'invalid', 'errors', 'out_of_space', 'bytes_written')
+GAUGES = ('bytes_remaining', 'files_remaining', 'chunks_in_flight', 'chunks_queued')
+
+# Upper bounds of the latency histogram buckets, in seconds. The last bucket counts all slower calls.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Default number of seconds between rewrites of the metrics file.
+METRICS_INTERVAL = 30
+PROMETHEUS_PREFIX = 'dcm_anonymizer'
+
+
+class RunMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stage_seconds = {stage: 0.0 for stage in STAGES}
+        self.stage_counts = {stage: 0 for stage in STAGES}
+        self.stage_buckets = {stage: [0]*(len(LATENCY_BUCKETS) + 1) for stage in STAGES}
+        self.counters = {counter: 0 for counter in COUNTERS}
+        self.gauges = {gauge: 0 for gauge in GAUGES}
+        # {transfer syntax: {decoder: {'seconds', 'count'}}}
+        self.decoders = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, elapsed):
+        with self.lock:
+            self.stage_seconds[name] += elapsed
+            self.stage_counts[name] += 1
+            self.stage_buckets[name][bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def record_decode(self, transfer_syntax, decoder, elapsed):
+        with self.lock:
+            values = self.decoders.setdefault(str(transfer_syntax), {}).setdefault(decoder, {'seconds': 0.0, 'count': 0})
+            values['seconds'] += elapsed
+            values['count'] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] += value
+
+    def add_remaining(self, chunks):
+        """
+        Adds chunks of dicoms to the bytes and files remaining.
+        """
+        with self.lock:
+            for chunk in chunks:
+                self.gauges['bytes_remaining'] += chunk['size']
+                self.gauges['files_remaining'] += len(chunk['files'])
+
+    def remove_remaining(self, chunks):
+        with self.lock:
+            for chunk in chunks:
+                self.gauges['bytes_remaining'] -= chunk['size']
+                self.gauges['files_remaining'] -= len(chunk['files'])
+
+    def as_dict(self):
+        with self.lock:
+            return {'stages': {stage: {'seconds': self.stage_seconds[stage], 'count': self.stage_counts[stage],
+                                       'buckets': list(self.stage_buckets[stage])}
+                               for stage in STAGES},
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'decoders': {transfer_syntax: {decoder: dict(values) for decoder, values in decoders.items()}
+                                 for transfer_syntax, decoders in self.decoders.items()}}
+
+    def merge(self, metrics):
+        """
+        Adds the stages and counters of another RunMetrics, as returned by its as_dict(), e.g. those of a completed
+        worker task. Gauges describe the run as a whole, and are left unchanged.
+        """
+        with self.lock:
+            for stage, values in metrics['stages'].items():
+                self.stage_seconds[stage] += values['seconds']
+                self.stage_counts[stage] += values['count']
+                self.stage_buckets[stage] = [a + b for a, b in zip(self.stage_buckets[stage], values['buckets'])]
+            for counter, value in metrics['counters'].items():
+                self.counters[counter] += value
+            for transfer_syntax, decoders in metrics['decoders'].items():
+                for decoder, values in decoders.items():
+                    merged = self.decoders.setdefault(transfer_syntax, {}).setdefault(decoder, {'seconds': 0.0, 'count': 0})
+                    merged['seconds'] += values['seconds']
+                    merged['count'] += values['count']
+
+    def summary(self, wall_seconds=None):
+        """
+        The metrics, with the throughput since the start of the run and the estimated time to process the remaining bytes.
+        """
+        if wall_seconds is None:
+            wall_seconds = time.time() - self.start_time
+        summary = self.as_dict()
+        summary['wall_seconds'] = wall_seconds
+        summary['files_per_second'] = summary['counters']['files']/wall_seconds if wall_seconds else 0.0
+        summary['mb_per_second'] = summary['counters']['bytes']/10**6/wall_seconds if wall_seconds else 0.0
+        bytes_per_second = summary['counters']['bytes']/wall_seconds if wall_seconds else 0.0
+        summary['eta_seconds'] = summary['gauges']['bytes_remaining']/bytes_per_second if bytes_per_second else None
+        return summary
+
+    def save(self, file_name, wall_seconds=None):
+        summary = self.summary(wall_seconds)
+        utils.save_json(summary, file_name)
+        save_prometheus(summary, '{}.prom'.format(os.path.splitext(file_name)[0]))
+        return summary
+
+
+def save_prometheus(summary, file_name):
+    """
+    Writes a summary in the Prometheus text exposition format, atomically.
+    """
+    lines = ['# TYPE {}_stage_seconds histogram'.format(PROMETHEUS_PREFIX)]
+    for stage, values in summary['stages'].items():
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values['buckets']):
+            cumulative += count
+            lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, bound, cumulative))
+        lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, values['seconds']))
+        lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, values['count']))
+    lines.append('# TYPE {}_decode_seconds summary'.format(PROMETHEUS_PREFIX))
+    for transfer_syntax, decoders in summary['decoders'].items():
+        for decoder, values in decoders.items():
+            labels = 'transfer_syntax="{}",decoder="{}"'.format(transfer_syntax, decoder)
+            lines.append('{}_decode_seconds_sum{{{}}} {}'.format(PROMETHEUS_PREFIX, labels, values['seconds']))
+            lines.append('{}_decode_seconds_count{{{}}} {}'.format(PROMETHEUS_PREFIX, labels, values['count']))
+    for counter, value in summary['counters'].items():
+        lines.append('# TYPE {}_{}_total counter'.format(PROMETHEUS_PREFIX, counter))
+        lines.append('{}_{}_total {}'.format(PROMETHEUS_PREFIX, counter, value))
+    gauges = dict(summary['gauges'])
+    gauges.update({'files_per_second': summary['files_per_second'], 'mb_per_second': summary['mb_per_second'],
+                   'eta_seconds': summary['eta_seconds'] if summary['eta_seconds'] is not None else 'NaN',
+                   'wall_seconds': summary['wall_seconds']})
+    for gauge, value in gauges.items():
+        lines.append('# TYPE {}_{} gauge'.format(PROMETHEUS_PREFIX, gauge))
+        lines.append('{}_{} {}'.format(PROMETHEUS_PREFIX, gauge, value))
+
+    temp_file_name = '{}.tmp'.format(file_name)
+    with open(temp_file_name, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+    os.replace(temp_file_name, file_name)
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Rewrites the metrics of a run to <file_name> every <interval> seconds, and prints a progress line, until stopped.
+    """
+    def __init__(self, run_metrics, file_name, interval=METRICS_INTERVAL):
+        super(MetricsExporter, self).__init__(daemon=True)
+        self.run_metrics = run_metrics
+        self.file_name = file_name
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            summary = self.run_metrics.save(self.file_name)
+            eta = summary['eta_seconds']
+            print('Progress: {} files, {} MB/s, {} MB remaining, ETA {}.'.format(
+                summary['counters']['files'], round(summary['mb_per_second'], 2),
+                round(summary['gauges']['bytes_remaining']/10**6, 1), '{} s'.format(round(eta)) if eta is not None else 'unknown'))
+            sys.stdout.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Profiler of the current process, when profiling is enabled.
+process_profile = None
+
+
+def run_task(profile_dir, function, *args):
+    """
+    Runs function(*args). If <profile_dir> is set, the call runs under cProfile: the profile of all calls made in this
+    process is accumulated, and dumped to <profile_dir>/worker_<process id>.prof after each call
+    (e.g. for python3 -m pstats, or snakeviz).
+    """
+    global process_profile
+    if not profile_dir:
+        return function(*args)
+    if process_profile is None:
+        process_profile = cProfile.Profile()
+    process_profile.enable()
+    try:
+        return function(*args)
+    finally:
+        process_profile.disable()
+        process_profile.dump_stats(os.path.join(profile_dir, 'worker_{}.prof'.format(os.getpid())))
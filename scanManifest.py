@@ -0,0 +1,168 @@
+"""
+Scan manifest, for incremental re-scans of a growing input directory.
+
+The manifest records, for every directory walked, its modification time, its subdirectories, and the (size, mtime, inode)
+of each of its files. On the next scan:
+1. A directory whose modification time is unchanged has had no entry added, removed or renamed, so it is not listed,
+and none of its files are opened. Only its files modified shortly before the previous scan (possibly still being
+written at the time) are stat'ed again.
+2. A changed directory is listed again, and only its new or modified files are reported.
+Subdirectories are always visited, at the cost of one stat each, since a change deep in a subtree does not change the
+modification time of its ancestors.
+
+The manifest is a sqlite database (manifest.sqlite in the linking log directory) holding a record per directory, which is
+looked up as the directory is visited. A scan only rewrites the records of the directories which changed, and the
+records of the files of a directory are only decoded if some of them were modified shortly before the previous scan,
+so that the time and memory a scan takes beyond visiting the directories grow with the new data, not with the whole
+input directory. The changes of a scan are only committed by save(). A manifest.json left by earlier versions is
+imported the first time the manifest is opened.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+
+import utils
+
+# Files modified less than this many seconds before the previous scan are checked again, even in unchanged directories.
+SETTLE_TIME = 300
+FILE_NAME = 'manifest.sqlite'
+JSON_FILE_NAME = 'manifest.json'
+
+logger = logging.getLogger(__name__)
+
+
+def newest_mtime(files):
+    return max((record[1] for record in files.values()), default=0)
+
+
+class Manifest(object):
+    def __init__(self, link_log_dir):
+        file_name = os.path.join(link_log_dir, FILE_NAME)
+        is_new = not os.path.isfile(file_name)
+        # The manifest is walked by the walker thread of streaming runs, and saved by the main thread once it is done.
+        self.connection = sqlite3.connect(file_name, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, '
+                                'dirs TEXT NOT NULL, files TEXT NOT NULL, newest INTEGER NOT NULL) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scans (key TEXT PRIMARY KEY, value REAL NOT NULL)')
+        if is_new:
+            self.import_json(os.path.join(link_log_dir, JSON_FILE_NAME))
+        row = self.connection.execute("SELECT value FROM scans WHERE key = 'scan_time'").fetchone()
+        self.previous_scan_time = row[0] if row else 0
+        self.scan_time = None
+
+    def import_json(self, file_name):
+        manifest = utils.load_json(file_name)
+        if not manifest:
+            return
+        print('Importing {}.'.format(file_name))
+        self.connection.execute('BEGIN')
+        for root, record in manifest.get('directories', {}).items():
+            self.set(root, record['mtime'], record['dirs'], record['files'])
+        self.connection.execute("INSERT OR REPLACE INTO scans (key, value) VALUES ('scan_time', ?)", (manifest.get('scan_time', 0),))
+        self.connection.execute('COMMIT')
+
+    def get(self, root):
+        return self.connection.execute('SELECT mtime, dirs, files, newest FROM directories WHERE path = ?', (root,)).fetchone()
+
+    def set(self, root, mtime, dirs, files):
+        self.connection.execute('INSERT OR REPLACE INTO directories (path, mtime, dirs, files, newest) VALUES (?, ?, ?, ?, ?)',
+                                (root, mtime, json.dumps(dirs), json.dumps(files), newest_mtime(files)))
+
+    def remove(self, root, subtree=False):
+        self.connection.execute('DELETE FROM directories WHERE path = ?', (root,))
+        if subtree:
+            # Paths within root sort between root + separator and the next character.
+            self.connection.execute('DELETE FROM directories WHERE path >= ? AND path < ?',
+                                    (root + os.sep, root + chr(ord(os.sep) + 1)))
+
+    def walk(self, dcm_directory):
+        """
+        Walks <dcm_directory> top-down like os.walk, yielding (root, names of files new or changed since the previous scan)
+        for each directory with such files, and records the current state of the directory for the next scan.
+        """
+        self.scan_time = time.time()
+        unsettled = int((self.previous_scan_time - SETTLE_TIME)*10**9)
+        if self.connection.in_transaction:
+            self.connection.execute('ROLLBACK')
+        self.connection.execute('BEGIN')
+
+        stack = [dcm_directory]
+        while stack:
+            root = stack.pop()
+            try:
+                mtime = os.stat(root).st_mtime_ns
+            except OSError:
+                self.remove(root, subtree=True)
+                continue
+
+            previous = self.get(root)
+            changed = []
+            if previous is not None and previous[0] == mtime:
+                dirs = json.loads(previous[1])
+                if previous[3] >= unsettled:
+                    files = json.loads(previous[2])
+                    is_modified = False
+                    for name, record in list(files.items()):
+                        if record[1] < unsettled:
+                            continue
+                        try:
+                            st = os.stat(os.path.join(root, name))
+                        except OSError:
+                            del files[name]
+                            is_modified = True
+                            continue
+                        current = [st.st_size, st.st_mtime_ns, st.st_ino]
+                        if current != record:
+                            files[name] = current
+                            changed.append(name)
+                            is_modified = True
+                    if is_modified:
+                        self.set(root, mtime, dirs, files)
+            else:
+                previous_dirs = json.loads(previous[1]) if previous is not None else []
+                previous_files = json.loads(previous[2]) if previous is not None else {}
+                dirs = []
+                files = {}
+                try:
+                    with os.scandir(root) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                dirs.append(entry.name)
+                            elif entry.is_file():
+                                st = entry.stat()
+                                files[entry.name] = [st.st_size, st.st_mtime_ns, st.st_ino]
+                                if previous_files.get(entry.name) != files[entry.name]:
+                                    changed.append(entry.name)
+                except OSError as error:
+                    # Skipped like os.walk skips the directories it cannot list, and left out of the manifest,
+                    # so that it is listed again by the next scan.
+                    print('Could not list directory {}: {}'.format(root, error))
+                    logger.warning('Could not list directory {} | message: {} {}'.format(root, str(error), str(type(error))))
+                    self.remove(root)
+                    continue
+                dirs.sort()
+                self.set(root, mtime, dirs, files)
+                # The records of subdirectories which no longer exist, and of their own subdirectories.
+                for name in set(previous_dirs) - set(dirs):
+                    self.remove(os.path.join(root, name), subtree=True)
+
+            if changed:
+                yield root, changed
+            stack.extend(os.path.join(root, d) for d in reversed(dirs))
+
+    def save(self):
+        """
+        Commits the records of the last scan.
+        """
+        if not self.connection.in_transaction:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO scans (key, value) VALUES ('scan_time', ?)", (self.scan_time,))
+        self.connection.execute('COMMIT')
+
+    def close(self):
+        self.connection.close()
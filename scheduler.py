@@ -0,0 +1,263 @@
+"""
+Work scheduling for the anonymizers.
+
+The partition is split into size-balanced chunks of files, using the file sizes recorded by get_dicoms, so that a
+single large directory is spread over all workers instead of keeping one of them busy. Chunks are dispatched largest
+first through the pool's shared task queue: whichever worker becomes idle takes the next chunk, so no worker sits idle
+while another still has a backlog.
+
+The number of chunks in flight is either fixed, or tuned from measured throughput (see ThroughputTuner).
+
+In streaming mode, a DirectoryWalker discovers and classifies files in the background while they are anonymized,
+handing chunks over through a bounded queue, so that the walk never runs ahead of anonymization by more than the
+queue's capacity.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+import archiveReader
+import runMetrics
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Target size of a chunk of work, in bytes and in number of files.
+CHUNK_BYTES = 256*10**6
+CHUNK_FILES = 256
+
+# Maximum number of chunks discovered ahead of anonymization in streaming mode.
+STREAM_QUEUE_SIZE = 16
+
+# Throughput is measured over windows of this many seconds when tuning the number of workers.
+TUNING_WINDOW = 30.0
+# Relative throughput gain required to keep adding workers.
+TUNING_TOLERANCE = 0.05
+
+
+def make_chunks(partition, chunk_bytes=CHUNK_BYTES, chunk_files=CHUNK_FILES):
+    """
+    Splits the files of <partition> into chunks of at most <chunk_bytes> bytes (or a single larger file) and at most
+    <chunk_files> files. Chunks do not span directories. Returns the chunks, largest first.
+    """
+    chunks = []
+    for directory, content in partition.items():
+        files = content['queue']
+        if not files:
+            continue
+        sizes = content.get('sizes') or [content['size']/len(files)]*len(files)
+        raw_files = set(content.get('raw', []))
+
+        chunk = None
+        for f, size in zip(files, sizes):
+            if chunk is None or (chunk['files'] and (chunk['size'] + size > chunk_bytes or len(chunk['files']) >= chunk_files)):
+                chunk = {'directory': directory, 'files': [], 'sizes': [], 'raw': [], 'size': 0.0}
+                chunks.append(chunk)
+            chunk['files'].append(f)
+            chunk['sizes'].append(size)
+            chunk['size'] += size
+            if f in raw_files:
+                chunk['raw'].append(f)
+
+    chunks.sort(key=lambda c: c['size'], reverse=True)
+    return chunks
+
+
+def add_chunk(partition, chunk):
+    """
+    Adds the files of a chunk to <partition>, e.g. so that a chunk discovered in streaming mode is recorded as
+    remaining work until it has been anonymized.
+    """
+    content = partition.setdefault(chunk['directory'], {'queue': [], 'size': 0.0, 'sizes': [], 'raw': []})
+    content['queue'].extend(chunk['files'])
+    content['sizes'].extend(chunk['sizes'])
+    content['raw'].extend(chunk['raw'])
+    content['size'] += chunk['size']
+
+
+def remove_chunk(partition, chunk):
+    """
+    Removes the files of a completed chunk from <partition>, and the chunk's directory once it has no files left.
+    """
+    content = partition.get(chunk['directory'])
+    if content is None:
+        return
+    done = set(chunk['files'])
+    sizes = content.get('sizes') or [content['size']/len(content['queue'])]*len(content['queue'])
+    remaining = [(f, size) for f, size in zip(content['queue'], sizes) if f not in done]
+    if remaining:
+        content['queue'] = [f for f, _ in remaining]
+        content['sizes'] = [size for _, size in remaining]
+        content['size'] = float(sum(content['sizes']))
+        content['raw'] = [f for f in content.get('raw', []) if f not in done]
+    else:
+        del partition[chunk['directory']]
+
+
+class DirectoryWalker(threading.Thread):
+    """
+    Walks <dcm_directory> in the background, and feeds the chunks of dicoms found in each directory into a queue of at
+    most <maxsize> chunks. Iterating over the walker yields the chunks as they are discovered. If the walk fails, the
+    iteration ends early and its exception is left in <error>: the chunks yielded are then not the whole directory.
+    With a scan manifest, only files new or changed since the previous scan are considered.
+    With a multiNode.NodeShard, only the files of that node are considered.
+    """
+    def __init__(self, dcm_directory, maxsize=STREAM_QUEUE_SIZE, manifest=None, run_metrics=None, node=None):
+        super(DirectoryWalker, self).__init__(daemon=True)
+        self.dcm_directory = dcm_directory
+        self.queue = queue.Queue(maxsize)
+        self.manifest = manifest
+        self.node = node
+        self.run_metrics = run_metrics if run_metrics is not None else runMetrics.RunMetrics()
+        self.error = None
+
+    def run(self):
+        try:
+            walk = archiveReader.walk(self.dcm_directory, self.manifest)
+            if self.node is not None:
+                walk = self.node.select(self.dcm_directory, walk)
+            for root, files in walk:
+                with self.run_metrics.stage('scan'):
+                    chunks = make_chunks({root: utils.scan_directory(root, files)})
+                for chunk in chunks:
+                    self.queue.put(chunk)
+        except Exception as error:
+            print('Walking {} failed: {}'.format(self.dcm_directory, error))
+            logger.error('Walking {} failed | message: {} {}'.format(self.dcm_directory, str(error), str(type(error))))
+            self.error = error
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+
+class ThroughputTuner(object):
+    """
+    Hill-climbs the number of concurrently running chunks: starting from <start>, one more worker is allowed after each
+    measurement window for as long as throughput (bytes per second) improves, up to <maximum>.
+    Once adding a worker no longer helps, the best measured concurrency is kept.
+    """
+    def __init__(self, start, maximum, window=TUNING_WINDOW):
+        self.concurrency = start
+        self.maximum = maximum
+        self.window = window
+        self.is_tuning = start < maximum
+
+        self.best_rate = 0.0
+        self.best_concurrency = start
+        self.window_start = time.time()
+        self.window_bytes = 0.0
+
+    def record(self, n_bytes):
+        self.window_bytes += n_bytes
+        elapsed = time.time() - self.window_start
+        if not self.is_tuning or elapsed < self.window:
+            return
+
+        rate = self.window_bytes/elapsed
+        if rate > self.best_rate*(1 + TUNING_TOLERANCE):
+            self.best_rate = rate
+            self.best_concurrency = self.concurrency
+            if self.concurrency < self.maximum:
+                self.concurrency += 1
+            else:
+                self.is_tuning = False
+        else:
+            self.concurrency = self.best_concurrency
+            self.is_tuning = False
+        print('Measured {} MB/s, using {} workers.'.format(round(rate/10**6, 2), self.concurrency))
+
+        self.window_start = time.time()
+        self.window_bytes = 0.0
+
+
+class Scheduler(object):
+    """
+    Dispatches tasks to a pool of <n_workers> processes, keeping at most as many tasks in flight as the tuner allows.
+    """
+    def __init__(self, pool, n_workers, tuner=None):
+        self.pool = pool
+        self.n_workers = n_workers
+        self.tuner = tuner
+        self.active = 0
+        self.stopped = False
+        # Exception raised by a callback, which stops dispatching (see check).
+        self.error = None
+        self.condition = threading.Condition()
+
+    def concurrency(self):
+        return self.tuner.concurrency if self.tuner is not None else self.n_workers
+
+    def execute(self, function, args, size, callback, error_callback=None):
+        """
+        Blocks until a worker is available, then runs function(*args) in the pool. <callback> receives the function's
+        result and returns whether dispatching should stop. <error_callback>, if any, receives the exception of a task
+        which failed instead. A callback which raises stops dispatching. Returns False if dispatching has been stopped.
+        """
+        with self.condition:
+            while not self.stopped and self.active >= self.concurrency():
+                self.condition.wait()
+            if self.stopped:
+                return False
+            self.active += 1
+
+        # The callbacks run on the pool's result handler thread, which must outlive them: the task is completed
+        # whatever they raise, so that wait() returns.
+        def done(result):
+            stop = True
+            try:
+                stop = callback(result)
+            except Exception as error:
+                self.callback_failed(error)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    if self.tuner is not None:
+                        self.tuner.record(size)
+                    if stop:
+                        self.stopped = True
+                    self.condition.notify_all()
+
+        def failed(error):
+            print('Task failed: {}'.format(error))
+            logger.warning('Task failed: {} {}'.format(str(error), str(type(error))))
+            try:
+                if error_callback is not None:
+                    error_callback(error)
+            except Exception as callback_error:
+                self.callback_failed(callback_error)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    self.condition.notify_all()
+
+        self.pool.apply_async(function, args=args, callback=done, error_callback=failed)
+        return True
+
+    def wait(self):
+        with self.condition:
+            while self.active:
+                self.condition.wait()
+
+    def callback_failed(self, error):
+        print('Callback failed: {}'.format(error))
+        logger.error('Callback failed: {} {}'.format(str(error), str(type(error))))
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.stopped = True
+            self.condition.notify_all()
+
+    def check(self):
+        """
+        Raises the exception of the first callback which raised, if any. Called once wait() has returned.
+        """
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,291 @@
+"""
+Sharded hdf5 output: many anonymized instances per hdf5 file, instead of one .dcm and one .hdf5 file per instance.
+
+Each shard holds:
+/headers: one row per instance, the anonymized dicom file (with empty PixelData) as bytes.
+/pixels/<sopID>: the instance's pixel array, compressed according to the export options.
+/index: one row per instance, mapping the anonymized mrn, accession, studyID, seriesID and sopID to the instance's
+row in /headers, along with its output group (the directory it would have had in the default output mode, by -g, empty
+for n) and the file name it would have had.
+
+Each process writes a single stream of shards per output directory, named shard_<process id>_<part>.hdf5, so that
+concurrent processes never write to the same file, and rolls it over to its next part once it exceeds the shard size,
+if any. Instances are grouped through the index rather than by file. With --shard_by series, each anonymized series
+gets a stream of its own instead, shard_se<seriesID>_<process id>_<part>.hdf5.
+A process only appends to the shards it created itself: a shard of the same name left by an earlier run (whose process
+had the same id) is skipped over to a new part, and new shards are created exclusively.
+Worker processes of the multiprocessing program keep their shards open for their whole life (see init_worker), rather
+than opening new ones for each chunk.
+
+Tar shards (output mode 'tar') instead hold the .hdf5 and .dcm files of each instance as tar members, under the paths
+they would have in the default output mode (e.g. <accession>/<file name> with -g a), so that extracting a shard gives
+the usual output tree. Each shard_<process id>_<part>.tar comes with an index, shard_<...>.index.jsonl, of one
+json line per instance: its anonymized mrn, accession, studyID, seriesID and sopID, its file name, and the offset and
+size within the tar of its header (the .dcm member) and pixels (the .hdf5 member, null without pixel data), so that
+loaders can read an instance without listing the tar. A line is only written once the instance's members are, so the
+index never lists an instance whose members were cut short. Tar shards are never appended to once closed: a shard
+left by an earlier run is skipped over to a new part.
+"""
+
+import os
+import json
+import time
+import shutil
+import tarfile
+import multiprocessing.util
+from io import BytesIO
+from collections import OrderedDict
+
+import numpy as np
+import h5py
+
+import pixelExport
+
+# Number of shards kept open at once per process, least recently used shards are closed first.
+MAX_OPEN_SHARDS = 16
+
+# Output group directory of the tar members, as in the default output mode, by output grouping.
+GROUP_FIELDS = {'a': 'accession', 's': 'studyID', 'm': 'mrn'}
+
+INDEX_DTYPE = np.dtype([('mrn', 'i8'), ('accession', 'i8'), ('studyID', 'i8'), ('seriesID', 'i8'), ('sopID', 'i8'),
+                        ('header', 'i8'), ('group', h5py.string_dtype()), ('name', h5py.string_dtype())])
+
+# Shard writers of this worker process by output directory, and their settings, set by init_worker.
+worker_shards = {}
+worker_settings = None
+
+
+class ShardWriter(object):
+    def __init__(self, out_dir, grouping, export_options):
+        self.out_dir = out_dir
+        self.grouping = grouping
+        self.export_options = export_options
+        self.shard_size = export_options['shard_size']
+        self.worker = os.getpid()
+        self.files = OrderedDict()
+        self.parts = {}
+        # Shards created by this writer, which it reopens to append to once closed to make room for other shards.
+        self.created = set()
+
+    def shard_key(self, anon_values):
+        # A stream of its own per series, or a single stream for the process.
+        if self.export_options['shard_by'] == 'series':
+            return 'se{}_'.format(anon_values['seriesID'])
+        return ''
+
+    def shard_path(self, key, part):
+        return os.path.join(self.out_dir, 'shard_{}{}_{}.hdf5'.format(key, self.worker, part))
+
+    def group(self, anon_values):
+        # Output group directory of the instance, as in the default output mode.
+        if self.grouping in GROUP_FIELDS:
+            return str(anon_values[GROUP_FIELDS[self.grouping]])
+        return ''
+
+    def open_shard(self, key):
+        if key in self.files:
+            self.files.move_to_end(key)
+            return self.files[key]
+
+        if len(self.files) >= MAX_OPEN_SHARDS:
+            _, f = self.files.popitem(last=False)
+            f.close()
+
+        part = self.parts[key] = self.find_part(key)
+        f = self.files[key] = self.create_shard(self.shard_path(key, part))
+        return f
+
+    def find_part(self, key):
+        # Continue the latest part of the shard, skipping parts that are already full or were left by an earlier run.
+        part = self.parts.get(key, 0)
+        while os.path.exists(self.shard_path(key, part)) and (self.shard_path(key, part) not in self.created or
+                                                              self.shard_size and os.path.getsize(self.shard_path(key, part)) >= self.shard_size):
+            part += 1
+        return part
+
+    def create_shard(self, file_name):
+        f = h5py.File(file_name, 'a' if file_name in self.created else 'x')
+        self.created.add(file_name)
+        if 'index' not in f:
+            f.create_dataset('index', (0,), dtype=INDEX_DTYPE, maxshape=(None,), chunks=True)
+            f.create_dataset('headers', (0,), dtype=h5py.vlen_dtype(np.uint8), maxshape=(None,), chunks=True)
+            f.create_group('pixels')
+        return f
+
+    def append(self, ds, pixel_array, anon_values, name, frames=1):
+        """
+        Appends an instance to its shard. Returns the number of bytes the shard grew by.
+        """
+        key = self.shard_key(anon_values)
+        f = self.open_shard(key)
+        if self.shard_size and f.id.get_filesize() >= self.shard_size:
+            self.files.pop(key).close()
+            self.parts[key] += 1
+            f = self.open_shard(key)
+        file_size = f.id.get_filesize()
+
+        buffer = BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+
+        row = f['index'].shape[0]
+        f['headers'].resize((row + 1,))
+        f['headers'][row] = np.frombuffer(buffer.getvalue(), dtype=np.uint8)
+        if pixel_array is not None:
+            # Discard pixels left behind by an append interrupted before its index row was written.
+            if str(anon_values['sopID']) in f['pixels']:
+                del f['pixels'][str(anon_values['sopID'])]
+            pixelExport.create_pixel_dataset(f['pixels'], str(anon_values['sopID']), pixel_array, self.export_options, frames)
+        f['index'].resize((row + 1,))
+        f['index'][row] = (anon_values['mrn'], anon_values['accession'], anon_values['studyID'],
+                           anon_values['seriesID'], anon_values['sopID'], row, self.group(anon_values), name)
+        f.flush()
+        return f.id.get_filesize() - file_size
+
+    def close(self):
+        while self.files:
+            _, f = self.files.popitem(last=False)
+            file_name = f.filename
+            try:
+                f.close()
+            except (OSError, RuntimeError) as error:
+                # Every instance was flushed as it was appended, e.g. before its output directory ran out of space.
+                print('Could not close shard {}: {}'.format(file_name, error))
+
+
+class TarShard(object):
+    """
+    A tar shard being written, and its index. Members are written as a tar header block followed by their data,
+    padded to whole blocks, straight to the file, and the archive is ended as tarfile ends it when closed.
+    """
+    def __init__(self, file_name):
+        self.filename = file_name
+        self.file = open(file_name, 'wb')
+        self.index = open('{}.index.jsonl'.format(file_name[:-len('.tar')]), 'w')
+
+    def size(self):
+        return self.file.tell() + self.index.tell()
+
+    def add(self, name, data, size=None):
+        """
+        Appends member <name> holding <data>, bytes or a file object of <size> bytes. Returns its data's offset and size
+        within the tar.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data) if size is None else size
+        info.mtime = int(time.time())
+        self.file.write(info.tobuf(tarfile.DEFAULT_FORMAT, 'utf-8', 'surrogateescape'))
+        offset = self.file.tell()
+        if size is None:
+            self.file.write(data)
+        else:
+            shutil.copyfileobj(data, self.file)
+        self.file.write(tarfile.NUL*(-info.size % tarfile.BLOCKSIZE))
+        return [offset, info.size]
+
+    def add_index(self, entry):
+        self.file.flush()
+        self.index.write(json.dumps(entry) + '\n')
+        self.index.flush()
+
+    def close(self):
+        try:
+            # End of archive: two empty blocks, padded to a whole record.
+            self.file.write(tarfile.NUL*(2*tarfile.BLOCKSIZE))
+            self.file.write(tarfile.NUL*(-self.file.tell() % tarfile.RECORDSIZE))
+            self.file.close()
+        finally:
+            self.index.close()
+
+
+class TarShardWriter(ShardWriter):
+    def shard_path(self, key, part):
+        return os.path.join(self.out_dir, 'shard_{}{}_{}.tar'.format(key, self.worker, part))
+
+    def find_part(self, key):
+        # Start a new part rather than append to a tar whose end may have been cut short.
+        part = self.parts.get(key, -1) + 1
+        while os.path.exists(self.shard_path(key, part)):
+            part += 1
+        return part
+
+    def create_shard(self, file_name):
+        return TarShard(file_name)
+
+    def member_dir(self, anon_values):
+        group = self.group(anon_values)
+        return '{}/'.format(group) if group else ''
+
+    def append(self, ds, pixel_array, anon_values, name, frames=1):
+        """
+        Appends an instance to its tar shard. Returns the number of bytes the shard and its index grew by.
+        """
+        key = self.shard_key(anon_values)
+        f = self.open_shard(key)
+        if self.shard_size and f.size() >= self.shard_size:
+            self.files.pop(key).close()
+            f = self.open_shard(key)
+        file_size = f.size()
+
+        buffer = BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+
+        # The pixel file is added first, as in the default output mode.
+        path = self.member_dir(anon_values) + name
+        pixels = None
+        if isinstance(pixel_array, pixelExport.PixelFrames):
+            # Pixel files exceeding the memory budget are built in a temporary file next to the shard.
+            temp_file_name = '{}.hdf5.tmp'.format(f.filename[:-len('.tar')])
+            try:
+                with open(temp_file_name, 'w+b') as pixel_file:
+                    pixelExport.write_pixel_array(pixel_array, pixel_file, self.export_options, frames)
+                    size = pixel_file.seek(0, os.SEEK_END)
+                    pixel_file.seek(0)
+                    pixels = f.add('{}.hdf5'.format(path[0:-4]), pixel_file, size)
+            finally:
+                os.remove(temp_file_name)
+        elif pixel_array is not None:
+            pixels = f.add('{}.hdf5'.format(path[0:-4]), pixelExport.pixel_file_image(pixel_array, self.export_options, frames))
+        header = f.add(path, buffer.getvalue())
+        f.add_index({'mrn': anon_values['mrn'], 'accession': anon_values['accession'], 'studyID': anon_values['studyID'],
+                     'seriesID': anon_values['seriesID'], 'sopID': anon_values['sopID'], 'name': path,
+                     'header': header, 'pixels': pixels})
+        return f.size() - file_size
+
+
+def open_shards(out_dir, grouping, export_options):
+    """
+    Returns a ShardWriter (TarShardWriter) when the export options select hdf5 (tar) shards, and None for one file per
+    instance.
+    """
+    if export_options is not None and export_options['output_mode'] == 'shard':
+        return ShardWriter(out_dir, grouping, export_options)
+    if export_options is not None and export_options['output_mode'] == 'tar':
+        return TarShardWriter(out_dir, grouping, export_options)
+    return None
+
+
+def init_worker(grouping, export_options):
+    """
+    Pool initializer of the worker processes: their shards are opened on first use, kept open across chunks, and
+    closed as the process exits.
+    """
+    global worker_settings
+    worker_settings = (grouping, export_options)
+    worker_shards.clear()
+    multiprocessing.util.Finalize(None, close_worker_shards, exitpriority=10)
+
+
+def open_worker_shards(out_dir):
+    """
+    Returns the shard writer of this worker process for <out_dir>, as open_shards does.
+    """
+    if out_dir not in worker_shards:
+        worker_shards[out_dir] = open_shards(out_dir, *worker_settings)
+    return worker_shards[out_dir]
+
+
+def close_worker_shards():
+    while worker_shards:
+        _, shards = worker_shards.popitem()
+        if shards is not None:
+            shards.close()
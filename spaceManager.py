@@ -0,0 +1,105 @@
+"""
+Output space accounting across one or more output directories (-o), typically on different volumes.
+
+Before a chunk of dicoms is dispatched, the SpaceManager reserves its estimated output size on the first output directory
+with room for it, and the chunk is written there. Free space is the file system's free space, less the reservations of
+chunks still being written to the same file system, less RESERVE_OUTPUT_SPACE, so that concurrent workers never count the
+same free bytes twice. Output directories are filled in the order given, spilling over to the next once one is full.
+
+The output size of a chunk is estimated from the ratio of bytes written to input bytes observed on completed chunks
+(with a margin), and from the input size itself until MIN_OBSERVED_BYTES have been observed.
+If a chunk runs out of space anyway, its output directory is marked full and the chunk is written again to the next one.
+"""
+
+import os
+import errno
+import threading
+
+import psutil
+
+# Bytes of free space left untouched on each output file system.
+RESERVE_OUTPUT_SPACE = 50*10**6
+# Input bytes of completed chunks to observe before estimating output sizes from the observed ratio.
+MIN_OBSERVED_BYTES = 50*10**6
+# Margin applied to the observed ratio of output to input bytes.
+ESTIMATE_MARGIN = 1.25
+
+
+def is_out_of_space(error):
+    """
+    Whether a write failed for lack of space. hdf5 reports some failed writes as RuntimeErrors, with the errno in the message.
+    """
+    if isinstance(error, OSError) and error.errno == errno.ENOSPC:
+        return True
+    return isinstance(error, RuntimeError) and 'errno = {},'.format(errno.ENOSPC) in str(error)
+
+
+class SpaceManager(object):
+    def __init__(self, out_dirs, reserve=RESERVE_OUTPUT_SPACE):
+        self.out_dirs = list(out_dirs)
+        self.reserve_bytes = reserve
+        self.condition = threading.Condition(threading.RLock())
+        # Output directories on the same file system share their free space, and their reservations.
+        self.devices = {out_dir: os.stat(out_dir).st_dev for out_dir in self.out_dirs}
+        self.reserved = {device: 0.0 for device in self.devices.values()}
+        self.n_reservations = 0
+        self.full = set()
+        self.input_bytes = 0.0
+        self.output_bytes = 0.0
+
+    def estimate(self, size):
+        """
+        Estimated output size of <size> input bytes.
+        """
+        with self.condition:
+            if self.input_bytes < MIN_OBSERVED_BYTES:
+                return size
+            return size*self.output_bytes/self.input_bytes*ESTIMATE_MARGIN
+
+    def available(self, out_dir):
+        return psutil.disk_usage(out_dir).free - self.reserved[self.devices[out_dir]] - self.reserve_bytes
+
+    def reserve(self, size):
+        """
+        Reserves the estimated output size of <size> input bytes on the first output directory with room for it.
+        Returns the output directory and the reservation, to be released once written, or (None, 0) if no output
+        directory has room.
+        """
+        with self.condition:
+            estimate = self.estimate(size)
+            for out_dir in self.out_dirs:
+                if out_dir not in self.full and self.available(out_dir) >= estimate:
+                    self.reserved[self.devices[out_dir]] += estimate
+                    self.n_reservations += 1
+                    return out_dir, estimate
+            return None, 0
+
+    def wait_reserve(self, size):
+        """
+        Like reserve(), but while other reservations are held, waits for them to be released before giving up:
+        completed chunks free their unused reservations, and refine the estimates.
+        """
+        with self.condition:
+            while True:
+                out_dir, reservation = self.reserve(size)
+                if out_dir is not None or not self.n_reservations:
+                    return out_dir, reservation
+                self.condition.wait()
+
+    def release(self, out_dir, reservation, input_bytes, output_bytes):
+        """
+        Releases a reservation once its chunk is written, recording the chunk's input and output bytes.
+        """
+        with self.condition:
+            self.reserved[self.devices[out_dir]] -= reservation
+            self.n_reservations -= 1
+            self.input_bytes += input_bytes
+            self.output_bytes += output_bytes
+            self.condition.notify_all()
+
+    def mark_full(self, out_dir):
+        with self.condition:
+            if out_dir not in self.full:
+                self.full.add(out_dir)
+                print('Output directory {} is full.'.format(out_dir))
+            self.condition.notify_all()
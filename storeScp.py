@@ -0,0 +1,416 @@
+"""
+DICOM Storage SCP front end: anonymizes dicoms as they are pushed over the network (C-STORE), e.g. by modalities or a
+PACS, instead of landing them on disk for the programs to pick up later. Requires pynetdicom.
+
+Each association is served on a thread of its own. Received datasets are handed, encoded, to a pool of worker processes
+through a bounded queue: once --queue_size datasets are waiting or being anonymized, further C-STORE requests wait for
+room, which holds back the senders rather than buffering without limit. Workers map identifiers through a single
+allocator process, as the multiprocessing program does, and write the anonymized files with constructDicom.write_dicom.
+A C-STORE request is only acknowledged once its files are written (or the dicom found to be already anonymized), so a
+sender never considers a dicom stored which is not. Output directories (-o) are filled in order, as by the programs.
+
+Usage:
+python3 storeScp.py serve -o <output directory> -l <linking log directory> -g <a/s/m/n> --port 11112
+(stops on SIGINT or SIGTERM, saving the link logs)
+python3 storeScp.py send -d <directory> --port 11112 --associations 4
+(sends every dicom of a directory, e.g. to test the SCP over the loopback interface)
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+import threading
+from io import BytesIO
+
+import multiprocessing as mp
+
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom import AE, evt, AllStoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+from pynetdicom.sop_class import Verification
+
+import anonProfile
+import checkpoint
+import config
+import constructDicom
+import keyedIds
+import outputWriter
+import pixelExport
+import runMetrics
+import spaceManager
+import utils
+from anonymizer import ENCODING_TRANSFER_SYNTAXES
+from idAllocator import AllocatorManager, DICOM_FIELDS
+
+# C-STORE response statuses (DICOM PS3.4 Annex B.2.3).
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+DEFAULT_PORT = 11112
+DEFAULT_AE_TITLE = 'ANONYMIZER'
+# Presentation contexts an association can request.
+MAX_CONTEXTS = 128
+# Seconds close() waits for the workers to finish the received dicoms.
+CLOSE_TIMEOUT = 60
+
+logger = logging.getLogger(__name__)
+
+# Allocator proxy of each worker process, set by init_worker.
+worker_allocator = None
+
+
+def ignore_interrupts():
+    # Interrupts from the terminal, and the SIGTERM of timeout or a service manager, may reach the whole process group:
+    # only the main process handles them, and stops cleanly. A worker killed instead would be replaced by one forked
+    # from the multithreaded main process, and the allocator process would die without saving the link logs.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def init_worker(allocator):
+    global worker_allocator
+    ignore_interrupts()
+    worker_allocator = allocator
+
+
+def store_dicom(data, out_dir, grouping, export_options):
+    """
+    Anonymizes the encoded dicom <data> (with its file meta information) to <out_dir>, in a worker process.
+    Returns the C-STORE status, whether the output directory ran out of space, and the metrics of the dicom.
+    """
+    run_metrics = runMetrics.RunMetrics()
+    run_metrics.count('files')
+    run_metrics.count('bytes', len(data))
+    with run_metrics.stage('parse'):
+        ods = constructDicom.read_dicom(BytesIO(data), force=True)
+
+    missing_fields = [dicom_field for dicom_field in DICOM_FIELDS if dicom_field not in ods]
+    if missing_fields:
+        logger.warning('WARNING - received dicom | {} not in DICOM tags'.format(', '.join(missing_fields)))
+        run_metrics.count('invalid')
+        return STATUS_CANNOT_UNDERSTAND, False, run_metrics.as_dict()
+
+    values = tuple(str(ods.get(dicom_field)).upper() for dicom_field in DICOM_FIELDS)
+    with run_metrics.stage('id_mapping'):
+        anon_values, is_duplicate = worker_allocator.assign(values)
+    if is_duplicate:
+        run_metrics.count('duplicates')
+        return STATUS_SUCCESS, False, run_metrics.as_dict()
+
+    try:
+        constructDicom.write_dicom(ods, anon_values, out_dir, grouping, export_options, run_metrics=run_metrics)
+    except Exception as error:
+        worker_allocator.complete(anon_values, success=False)
+        run_metrics.count('errors')
+        out_of_space = spaceManager.is_out_of_space(error)
+        if out_of_space:
+            run_metrics.count('out_of_space')
+        logger.warning('WARNING - received dicom | message: {} {} . This warning is for case {} with anon_values {} .'
+                       .format(str(error), str(type(error)), str(values), str(anon_values)))
+        return STATUS_OUT_OF_RESOURCES if out_of_space else STATUS_CANNOT_UNDERSTAND, out_of_space, run_metrics.as_dict()
+    with run_metrics.stage('id_mapping'):
+        worker_allocator.complete(anon_values)
+    run_metrics.count('anonymized')
+    return STATUS_SUCCESS, False, run_metrics.as_dict()
+
+
+class StoreScp(object):
+    """
+    Storage SCP anonymizing received dicoms with <workers> processes, at most <queue_size> at a time.
+    """
+    def __init__(self, out_dirs, link_log_dir, grouping, link_log_backend='json', export_options=None, workers=None,
+                 queue_size=None, checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL, run_metrics=None, secret=None):
+        self.grouping = grouping
+        self.export_options = export_options
+        self.run_metrics = run_metrics if run_metrics is not None else runMetrics.RunMetrics()
+        n_workers = int(workers) if workers else max(1, mp.cpu_count()//2)
+        self.slots = threading.BoundedSemaphore(queue_size or 2*n_workers)
+        self.space = spaceManager.SpaceManager(out_dirs)
+        self.lock = threading.Lock()
+
+        # Single owner of the link logs, shared by the workers.
+        self.allocator_manager = AllocatorManager()
+        self.allocator_manager.start(ignore_interrupts)
+        self.allocator = self.allocator_manager.IdAllocator(link_log_dir, link_log_backend, secret=secret)
+        self.checkpointer = checkpoint.Checkpointer(self.allocator, link_log_dir, checkpoint_interval)
+        self.pool = mp.Pool(n_workers, initializer=init_worker, initargs=(self.allocator,))
+
+        self.ae = AE()
+        self.ae.add_supported_context(Verification)
+        for context in AllStoragePresentationContexts:
+            self.ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        self.server = None
+        self.port = None
+
+    def handle_store(self, event):
+        data = event.encoded_dataset(include_meta=True)
+        # Wait for room in the worker queue before reserving space, so that associations waiting for a worker hold
+        # no reservation.
+        with self.slots:
+            out_dir, reservation = self.space.reserve(len(data))
+            if out_dir is None:
+                logger.warning('Ran out of space to write files.')
+                return STATUS_OUT_OF_RESOURCES
+            bytes_written = 0
+            try:
+                status, out_of_space, metrics = self.pool.apply(store_dicom, (data, out_dir, self.grouping, self.export_options))
+                self.run_metrics.merge(metrics)
+                bytes_written = metrics['counters']['bytes_written']
+                if out_of_space:
+                    self.space.mark_full(out_dir)
+            except Exception as error:
+                logger.warning('WARNING - received dicom | message: {} {}'.format(str(error), str(type(error))))
+                status = STATUS_CANNOT_UNDERSTAND
+            finally:
+                self.space.release(out_dir, reservation, len(data), bytes_written)
+        with self.lock:
+            if self.checkpointer.is_due():
+                self.checkpointer.save()
+        return status
+
+    def start(self, port=DEFAULT_PORT, ae_title=DEFAULT_AE_TITLE, host=''):
+        self.ae.ae_title = ae_title
+        self.server = self.ae.start_server((host, port), block=False, evt_handlers=[(evt.EVT_C_STORE, self.handle_store)])
+        # The port the system picked, for port 0.
+        self.port = self.server.server_address[1]
+        message = 'Listening as {} on port {}.'.format(ae_title, self.port)
+        print(message)
+        logger.info(message)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Stops accepting associations, waits for the received dicoms to be anonymized, and saves the link logs.
+        Workers still busy after <timeout> seconds are terminated, so that the link logs are saved regardless.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+        self.pool.close()
+        joiner = threading.Thread(target=self.pool.join, daemon=True)
+        joiner.start()
+        joiner.join(timeout)
+        if joiner.is_alive():
+            print('Workers did not stop within {} seconds, terminating them.'.format(timeout))
+            logger.warning('Workers did not stop within {} seconds, terminating them.'.format(timeout))
+            self.pool.terminate()
+        self.allocator.close()
+        self.allocator_manager.shutdown()
+
+
+def read_for_sending(file_name, stop_before_pixels=False):
+    """
+    Reads dicom <file_name> to be sent, with the transfer syntax it is encoded in recorded in its file meta information.
+    """
+    ds = pydicom.dcmread(file_name, force=True, stop_before_pixels=stop_before_pixels)
+    if 'TransferSyntaxUID' not in ds.file_meta:
+        ds.file_meta.TransferSyntaxUID = ENCODING_TRANSFER_SYNTAXES.get(tuple(ds.original_encoding), ExplicitVRLittleEndian)
+    return ds
+
+
+def send_directory(dcm_directory, host='localhost', port=DEFAULT_PORT, ae_title=DEFAULT_AE_TITLE, associations=1):
+    """
+    Sends the dicoms of <dcm_directory> to a Storage SCP over <associations> concurrent associations, each requesting a
+    presentation context for every SOP class and transfer syntax of its dicoms (at most MAX_CONTEXTS).
+    Returns the number of dicoms sent and of dicoms acknowledged as stored. Dicoms which could not be read or sent
+    are counted as sent but not stored.
+    """
+    files = []
+    for root, dirs, names in os.walk(dcm_directory):
+        files.extend(os.path.join(root, name) for name in sorted(names) if utils.sniff_dicom(os.path.join(root, name)))
+    counts = {'sent': 0, 'stored': 0}
+    lock = threading.Lock()
+
+    def send(files):
+        ae = AE()
+        contexts = set()
+        for f in files:
+            try:
+                ds = read_for_sending(f, stop_before_pixels=True)
+                context = (ds.SOPClassUID, ds.file_meta.TransferSyntaxUID)
+            except Exception:
+                continue
+            if context not in contexts and len(contexts) < MAX_CONTEXTS:
+                contexts.add(context)
+                ae.add_requested_context(*context)
+        if not contexts:
+            with lock:
+                counts['sent'] += len(files)
+            return
+        assoc = ae.associate(host, port, ae_title=ae_title)
+        if not assoc.is_established:
+            print('Association with {}:{} was not established.'.format(host, port))
+            with lock:
+                counts['sent'] += len(files)
+            return
+        try:
+            for f in files:
+                try:
+                    status = assoc.send_c_store(read_for_sending(f))
+                    is_stored = bool(status) and status.Status == STATUS_SUCCESS
+                except Exception as error:
+                    print('Could not send {}: {}'.format(f, error))
+                    is_stored = False
+                with lock:
+                    counts['sent'] += 1
+                    if is_stored:
+                        counts['stored'] += 1
+                if not assoc.is_established:
+                    break
+        finally:
+            assoc.release()
+
+    threads = [threading.Thread(target=send, args=(files[i::associations],)) for i in range(associations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts['sent'], counts['stored']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Anonymizes dicoms received over the network, as a DICOM Storage SCP")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="Runs the Storage SCP")
+    serve_parser.add_argument("-o",
+                              "--output_dir",
+                              type=str,
+                              nargs='+',
+                              default=['./anondata'],
+                              help="Output DICOM directory path. Several directories are filled in order")
+    serve_parser.add_argument("-l",
+                              "--link_log_dir",
+                              type=str,
+                              default='./linklog',
+                              help="Linking log directory")
+    serve_parser.add_argument("-g",
+                              "--group_by",
+                              type=str,
+                              default='a',
+                              help="Group output dicoms into subfolders by anonymized accession number (a), "
+                                   "Study Instance UID (s), MRN (m), or do not group into subfolders at all (n)")
+    serve_parser.add_argument("-b",
+                              "--link_log_backend",
+                              type=str,
+                              default='json',
+                              choices=['json', 'sqlite', 'none'],
+                              help="Link log storage (none only with --id_mode hmac)")
+    serve_parser.add_argument("--id_mode",
+                              type=str,
+                              default='sequential',
+                              choices=['sequential', 'hmac'],
+                              help="Anonymized identifiers (see the programs' --id_mode)")
+    serve_parser.add_argument("--secret_file",
+                              type=str,
+                              default=None,
+                              help="File holding the site secret of --id_mode hmac")
+    serve_parser.add_argument("-c",
+                              "--codec",
+                              type=str,
+                              default='gzip',
+                              help="Compression of the exported pixel arrays (see the programs' --codec)")
+    serve_parser.add_argument("--anon_profile",
+                              type=str,
+                              default=None,
+                              help="Json file of the anonymization profile (see anonProfile.py)")
+    serve_parser.add_argument("--port",
+                              type=int,
+                              default=DEFAULT_PORT,
+                              help="Port to listen on")
+    serve_parser.add_argument("--ae_title",
+                              type=str,
+                              default=DEFAULT_AE_TITLE,
+                              help="AE title of the SCP")
+    serve_parser.add_argument("-w",
+                              "--workers",
+                              type=config.positive_int,
+                              default=None,
+                              help="Number of worker processes anonymizing received dicoms")
+    serve_parser.add_argument("--queue_size",
+                              type=int,
+                              default=None,
+                              help="Received dicoms waiting for or being anonymized, beyond which C-STORE requests "
+                                   "wait (defaults to twice the number of workers)")
+    serve_parser.add_argument("--checkpoint_interval",
+                              type=int,
+                              default=60,
+                              help="Seconds between commits of the link logs (0 to only save them on exit)")
+    serve_parser.add_argument("--metrics_file",
+                              type=str,
+                              default=None,
+                              help="Write throughput, time spent per stage and counts to this json file")
+    serve_parser.add_argument("--metrics_interval",
+                              type=int,
+                              default=30,
+                              help="Seconds between rewrites of the metrics file")
+    send_parser = subparsers.add_parser('send', help="Sends the dicoms of a directory to a Storage SCP")
+    send_parser.add_argument("-d",
+                             "--input_dir",
+                             type=str,
+                             required=True,
+                             help="Input DICOM directory path")
+    send_parser.add_argument("--host",
+                             type=str,
+                             default='localhost',
+                             help="Host of the SCP")
+    send_parser.add_argument("--port",
+                             type=int,
+                             default=DEFAULT_PORT,
+                             help="Port of the SCP")
+    send_parser.add_argument("--ae_title",
+                             type=str,
+                             default=DEFAULT_AE_TITLE,
+                             help="AE title of the SCP")
+    send_parser.add_argument("--associations",
+                             type=int,
+                             default=1,
+                             help="Number of concurrent associations")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.id_mode == 'hmac' and args.secret_file is None:
+            serve_parser.error('--id_mode hmac requires --secret_file')
+        start_time_run = time.time()
+        for out_dir in args.output_dir:
+            outputWriter.begin_run(out_dir)
+        utils.make_dirs(args.link_log_dir)
+        logger.setLevel(logging.WARNING)
+        handler = logging.FileHandler(os.path.join(args.link_log_dir, 'dcm_store_scp_{}.log'.format(int(start_time_run))))
+        handler.setFormatter(logging.Formatter(fmt='%(asctime)s:%(levelname)s:%(lineno)d:%(message)s',
+                                               datefmt='%m/%d/%Y %I:%M:%S %p'))
+        logger.addHandler(handler)
+
+        export_options = pixelExport.make_export_options(args.codec, tag_plan=anonProfile.load_plan(args.anon_profile,
+                                                                                                    keyedIds.uid_root(args.id_mode)))
+        secret = keyedIds.load_secret(args.secret_file) if args.id_mode == 'hmac' else None
+        run_metrics = runMetrics.RunMetrics()
+        if args.metrics_file:
+            exporter = runMetrics.MetricsExporter(run_metrics, args.metrics_file, args.metrics_interval)
+            exporter.start()
+
+        scp = StoreScp(args.output_dir, args.link_log_dir, args.group_by, args.link_log_backend, export_options, args.workers,
+                       args.queue_size, args.checkpoint_interval, run_metrics, secret)
+        stop = threading.Event()
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        scp.start(args.port, args.ae_title)
+        stop.wait()
+        print('Stopping.')
+        scp.close()
+        for out_dir in args.output_dir:
+            outputWriter.end_run(out_dir)
+
+        if args.metrics_file:
+            exporter.stop()
+            run_metrics.save(args.metrics_file, time.time() - start_time_run)
+        print('Stored {} dicoms.'.format(run_metrics.counters['anonymized']))
+    elif args.command == 'send':
+        sent, stored = send_directory(args.input_dir, args.host, args.port, args.ae_title, args.associations)
+        print('Sent {} dicoms, {} stored.'.format(sent, stored))
+        if sent != stored:
+            sys.exit(1)
+    else:
+        parser.print_help()
+        sys.exit(1)
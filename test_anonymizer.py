@@ -0,0 +1,58 @@
+from io import BytesIO
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+import anonProfile
+import anonymizer
+
+
+def make_dataset():
+    ds = Dataset()
+    ds.PatientID = 'MRN1'
+    ds.AccessionNumber = 'ACC1'
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    ds.Rows = ds.Columns = 4
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = np.arange(16, dtype='<u2').tobytes()
+    return ds
+
+
+def test_dataset_with_file_meta(tmp_path):
+    # A plain Dataset (not a FileDataset) that holds its own transfer syntax.
+    ds = make_dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    with anonymizer.Anonymizer(str(tmp_path)) as anon:
+        result = anon.anonymize(ds, buffers=False)
+    assert result.status == anonymizer.ANONYMIZED, result.error
+    assert np.array_equal(result.pixel_array, np.arange(16).reshape(4, 4))
+
+
+def test_header_values(tmp_path):
+    ds = make_dataset()
+    ds.StudyDate = '20200101'
+    ds.PatientBirthDate = '19700101'
+    with anonymizer.Anonymizer(str(tmp_path)) as anon:
+        result = anon.anonymize(ds)
+    assert result.status == anonymizer.ANONYMIZED, result.error
+    header = pydicom.dcmread(BytesIO(result.header))
+    assert header.preamble is not None and header.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+    assert header.SOPClassUID == header.file_meta.MediaStorageSOPClassUID == SecondaryCaptureImageStorage
+    assert header.StudyDate == '' and header.PatientBirthDate == '' and header.PatientAge == '050Y'
+    assert header.Rows == 4 and header.BitsAllocated == 16
+
+
+def test_profile_values():
+    plan = anonProfile.compile_profile([['Rows', 'replace', '512'], ['LUTDescriptor', 'replace', '4096\\0\\12'],
+                                        ['BitsStored', 'blank'], ['StudyDate', 'blank']])
+    assert [value for _, _, value in plan.constants] == [512, [4096, 0, 12], None, '']
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import compactIndex
+
+KEYS = ['1.2.840.113619.2.55.3', '1.2.3', '12345', '(1, 2, 3, 4, 5)', '(-1, 20, 3)', 'ab' * 16, 'MRN-é', '', '.']
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_pack_round_trip(key):
+    packed = compactIndex.pack_key(key)
+    assert compactIndex.unpack_key(packed) == key
+
+
+def test_packing():
+    # Digits and dots, tuples and hex digests take about half a byte per character.
+    assert len(compactIndex.pack_key('1.2.840.113619.2.55.3')) == 1 + 11
+    assert compactIndex.pack_key('(1, 2, 3, 4, 5)')[0] == compactIndex.TUPLE_KEY
+    assert compactIndex.pack_key('ab' * 16) == bytes((compactIndex.HEX_KEY,)) + bytes.fromhex('ab' * 16)
+    assert compactIndex.pack_key('MRN1') == b'MRN1'
+
+
+def test_map_probing_and_rehash():
+    compact_map = compactIndex.CompactMap()
+    expected = {}
+    # Enough entries to rehash several times, and to probe past colliding slots.
+    for i in range(5000):
+        key = '1.2.{}'.format(i) if i % 2 else 'MRN{}'.format(i)
+        compact_map[key] = i
+        expected[key] = i
+    compact_map['MRN0'] = -1
+    expected['MRN0'] = -1
+    assert len(compact_map) == len(expected)
+    assert len(compact_map.table) > compactIndex.INITIAL_SLOTS
+    assert len(compact_map) <= len(compact_map.table)*compactIndex.MAX_LOAD
+    assert dict(compact_map.items()) == expected
+    assert all(compact_map[key] == value for key, value in expected.items())
+    assert 'MRN1' not in compact_map and compact_map.get('MRN1', 0) == 0
+    with pytest.raises(KeyError):
+        compact_map['1.2.5000']
+
+
+def test_tuple_values():
+    compact_map = compactIndex.CompactMap(compactIndex.TUPLE_WIDTH)
+    compact_map['ab' * 16] = '(1, 2, 3, 4, 5)'
+    assert compact_map['ab' * 16] == '(1, 2, 3, 4, 5)'
+    with pytest.raises(ValueError):
+        compact_map['cd' * 16] = '(1, 2)'
+
+
+@pytest.mark.parametrize('value_width', [None, compactIndex.TUPLE_WIDTH])
+def test_load_save_round_trip(tmp_path, value_width):
+    file_name = str(tmp_path / 'link_log.json')
+    compact_map = compactIndex.CompactMap(value_width)
+    for i, key in enumerate(KEYS + ['quoted "key"', 'back\\slash']):
+        compact_map[key] = i if value_width is None else str((i,)*value_width)
+    compactIndex.save(compact_map, file_name)
+    with open(file_name) as infile:
+        assert json.load(infile) == dict(compact_map.items())
+    assert dict(compactIndex.load(file_name, value_width).items()) == dict(compact_map.items())
+
+    # Empty maps, and files not written line by line.
+    compactIndex.save(compactIndex.CompactMap(value_width), file_name)
+    assert len(compactIndex.load(file_name, value_width)) == 0
+    with open(file_name, 'w') as outfile:
+        json.dump({'1.2.3': 4}, outfile)
+    assert dict(compactIndex.load(file_name).items()) == {'1.2.3': 4}
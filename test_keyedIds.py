@@ -0,0 +1,61 @@
+import pytest
+
+import idAllocator
+import keyedIds
+
+SECRET = b'0123456789abcdef'
+
+
+def values(name):
+    return (name, name, '1.2.{}'.format(len(name)), '1.3.{}'.format(name), '1.4.{}'.format(name))
+
+
+def test_derive():
+    keyed_ids = keyedIds.KeyedIds(SECRET)
+    assert keyed_ids.derive('link_mrn_log', 'MRN1') == keyedIds.KeyedIds(SECRET).derive('link_mrn_log', 'MRN1')
+    assert keyed_ids.derive('link_mrn_log', 'MRN1') != keyedIds.KeyedIds(b'fedcba9876543210').derive('link_mrn_log', 'MRN1')
+    assert keyed_ids.derive('link_mrn_log', 'MRN1') != keyed_ids.derive('link_mrn_log', 'MRN1', 1)
+    assert keyed_ids.derive('link_mrn_log', 'MRN1') != keyed_ids.derive('link_sop_log', 'MRN1')
+    for field, max_id in keyedIds.MAX_IDS.items():
+        assert all(1 <= keyed_ids.derive(field, str(i)) <= max_id for i in range(100))
+
+
+def test_load_secret(tmp_path):
+    file_name = str(tmp_path / 'secret')
+    with open(file_name, 'wb') as outfile:
+        outfile.write(SECRET + b'\n')
+    assert keyedIds.load_secret(file_name) == SECRET
+    with open(file_name, 'wb') as outfile:
+        outfile.write(b'short')
+    with pytest.raises(ValueError):
+        keyedIds.load_secret(file_name)
+    with pytest.raises(ValueError):
+        keyedIds.load_secret(str(tmp_path / 'missing'))
+
+
+class CollidingIds(keyedIds.KeyedIds):
+    # Derives the same identifiers for every value, so that each new value collides with the previous ones.
+    def derive(self, field, value, attempt=0):
+        return attempt + 1
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'none'])
+def test_collisions(tmp_path, backend):
+    link_log_dir = str(tmp_path)
+
+    def assign(names):
+        allocator = idAllocator.open_allocator(link_log_dir, backend, secret=SECRET)
+        allocator.keyed_ids = CollidingIds(SECRET)
+        mrns = []
+        for name in names:
+            anon_values, is_duplicate = allocator.assign(values(name))
+            if not is_duplicate:
+                allocator.complete(anon_values)
+            mrns.append(anon_values['mrn'])
+        allocator.close()
+        return mrns
+
+    # Each value is derived again until its identifier is free, and keeps the identifier it was first given.
+    assert assign(['A', 'B', 'A', 'C']) == [1, 2, 1, 3]
+    # Identifiers recorded by a previous run are taken as well, unless the link logs are not recorded.
+    assert assign(['D', 'B']) == ([4, 2] if backend != 'none' else [1, 2])
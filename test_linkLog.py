@@ -0,0 +1,60 @@
+import os
+
+import linkLog
+import utils
+
+
+def test_json_delta_replay(tmp_path):
+    link_log_dir = str(tmp_path)
+    store = linkLog.JsonLinkLog(link_log_dir)
+    store.set('link_mrn_log', 'MRN1', 1)
+    store.commit()
+    store.set('link_mrn_log', 'MRN2', 2)
+    store.set('link_master_log', '(2, 1, 1, 1, 1)', 1)
+    store.commit()
+    # Killed before close(): only the deltas are on disk.
+    assert sorted(name for name in os.listdir(link_log_dir)) == ['link_log_delta_0.json', 'link_log_delta_1.json']
+
+    store = linkLog.JsonLinkLog(link_log_dir)
+    assert store.get('link_mrn_log', 'MRN1') == 1
+    assert store.get('link_mrn_log', 'MRN2') == 2
+    assert store.get('link_master_log', '(2, 1, 1, 1, 1)') == 1
+    assert store.max('link_mrn_log') == 2
+    # Replayed mappings are not committed again as a new delta.
+    store.commit()
+    assert len(store.delta_files) == 2
+
+    store.close()
+    assert not any(linkLog.DELTA_FILE_NAME.match(name) for name in os.listdir(link_log_dir))
+    assert utils.load_json(os.path.join(link_log_dir, 'link_mrn_log.json')) == {'MRN1': 1, 'MRN2': 2}
+    store = linkLog.JsonLinkLog(link_log_dir)
+    assert store.get('link_mrn_log', 'MRN2') == 2
+
+
+def test_sqlite_imports_json(tmp_path):
+    link_log_dir = str(tmp_path)
+    store = linkLog.JsonLinkLog(link_log_dir)
+    store.set('link_mrn_log', 'MRN1', 3)
+    store.set('link_sop_log', '1.2.3', 7)
+    store.set(linkLog.FINGERPRINT_LOG_FIELD, 'ab' * 16, '(3, 1, 1, 1, 7)')
+    store.close()
+    # A mapping only found in an uncompacted delta is imported too.
+    store = linkLog.JsonLinkLog(link_log_dir)
+    store.set('link_mrn_log', 'MRN2', 5)
+    store.commit()
+
+    store = linkLog.SqliteLinkLog(link_log_dir)
+    assert store.get('link_mrn_log', 'MRN1') == 3
+    assert store.get('link_mrn_log', 'MRN2') == 5
+    assert store.get('link_sop_log', '1.2.3') == 7
+    assert store.get(linkLog.FINGERPRINT_LOG_FIELD, 'ab' * 16) == '(3, 1, 1, 1, 7)'
+    assert store.max('link_mrn_log') == 5
+    assert store.has_value('link_sop_log', 7) and not store.has_value('link_sop_log', 8)
+    store.set('link_mrn_log', 'MRN3', 6)
+    store.close()
+
+    # The json link logs are only imported once, and the running maximum persists.
+    store = linkLog.SqliteLinkLog(link_log_dir)
+    assert store.get('link_mrn_log', 'MRN3') == 6
+    assert store.max('link_mrn_log') == 6
+    store.close()
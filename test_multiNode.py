@@ -0,0 +1,65 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import benchmark
+import multiNode
+import utils
+
+PROGRAM_DIR = os.path.dirname(os.path.abspath(__file__))
+NODE_COUNT = 3
+ID_FIELDS = ('link_mrn_log', 'link_accession_log', 'link_study_log', 'link_series_log', 'link_sop_log')
+
+
+def run(tmp_path, script, *args):
+    return subprocess.Popen([sys.executable, os.path.join(PROGRAM_DIR, script)] + [str(arg) for arg in args],
+                            cwd=str(tmp_path))
+
+
+def test_nodes_and_merge(tmp_path):
+    in_dir = tmp_path / 'in'
+    benchmark.generate_corpus(str(in_dir), n_files=48, n_dirs=6, skew=0.0, rows=8, columns=8, frames=1,
+                              transfer_syntaxes=['explicit'], duplicate_rate=0.0, noise_rate=0.0, seed=1)
+    # A dicom also found under a top-level directory of another node, which both nodes then anonymize.
+    directories = sorted(os.listdir(str(in_dir)))
+    source_dir = next(d for d in directories if os.listdir(str(in_dir / d)))
+    other_dir = next(d for d in directories if multiNode.node_of(d, NODE_COUNT) != multiNode.node_of(source_dir, NODE_COUNT))
+    shared_name = sorted(os.listdir(str(in_dir / source_dir)))[0]
+    shutil.copyfile(str(in_dir / source_dir / shared_name), str(in_dir / other_dir / 'copy.dcm'))
+
+    coordinator = tmp_path / 'coordinator.json'
+    node_dirs = [tmp_path / 'linklog_{}'.format(i) for i in range(NODE_COUNT)]
+    nodes = [run(tmp_path, 'dcmAnonymizerV02.py', '-d', in_dir, '-o', tmp_path / 'out_{}'.format(i), '-l', node_dirs[i],
+                 '--node_index', i, '--node_count', NODE_COUNT, '--coordinator', coordinator) for i in range(NODE_COUNT)]
+    assert [node.wait(timeout=300) for node in nodes] == [0]*NODE_COUNT
+
+    logs = [{field: utils.load_json(str(node_dir / '{}.json'.format(field))) or {} for field in ID_FIELDS}
+            for node_dir in node_dirs]
+
+    # Every dicom is anonymized by exactly one node, except the one found under two nodes' directories.
+    sop_keys = [set(log['link_sop_log']) for log in logs]
+    shared = {key for i, keys in enumerate(sop_keys) for key in keys if any(key in other for other in sop_keys[i + 1:])}
+    assert len(shared) == 1
+    assert sum(len(keys) for keys in sop_keys) == 48 + 1
+
+    # No identifier is handed out twice, and every identifier is within a range leased to its node.
+    leases = utils.load_json(str(coordinator))['leases']
+    for field in ID_FIELDS:
+        values = [value for log in logs for value in log[field].values()]
+        assert len(values) == len(set(values))
+        ranges = sorted((lease['start'], lease['end']) for lease in leases if lease['field'] == field)
+        assert all(end <= start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+        for i, log in enumerate(logs):
+            node_ranges = [(lease['start'], lease['end']) for lease in leases
+                           if lease['field'] == field and lease['node'].startswith('{}@'.format(i))]
+            assert all(any(start <= value < end for start, end in node_ranges) for value in log[field].values())
+
+    merged_dir = tmp_path / 'linklog'
+    assert run(tmp_path, 'multiNode.py', 'merge', '-l', merged_dir, *node_dirs).wait(timeout=120) == 0
+    for field in ID_FIELDS:
+        merged = utils.load_json(str(merged_dir / '{}.json'.format(field)))
+        assert set(merged) == set().union(*[log[field] for log in logs])
+    conflicts = utils.load_json(str(merged_dir / multiNode.CONFLICTS_FILE_NAME))
+    assert set(conflicts['link_sop_log']) == shared
+    assert all(len(identifiers) == 2 for identifiers in conflicts['link_sop_log'].values())
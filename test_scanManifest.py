@@ -0,0 +1,102 @@
+import os
+import json
+
+import scanManifest
+
+
+def write(path, content=b'data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as outfile:
+        outfile.write(content)
+
+
+def scan(link_log_dir, in_dir):
+    manifest = scanManifest.Manifest(link_log_dir)
+    changes = {os.path.relpath(root, in_dir): sorted(files) for root, files in manifest.walk(in_dir)}
+    manifest.save()
+    manifest.close()
+    return changes
+
+
+def set_mtime(path, seconds):
+    os.utime(path, ns=(seconds*10**9, seconds*10**9))
+
+
+def test_walk(tmp_path, monkeypatch):
+    in_dir = str(tmp_path / 'in')
+    link_log_dir = str(tmp_path / 'linklog')
+    os.makedirs(link_log_dir)
+    write(os.path.join(in_dir, 'a', '1.dcm'))
+    write(os.path.join(in_dir, 'a', '2.dcm'))
+    write(os.path.join(in_dir, 'b', 'c', '3.dcm'))
+    assert scan(link_log_dir, in_dir) == {'a': ['1.dcm', '2.dcm'], os.path.join('b', 'c'): ['3.dcm']}
+    # Files are recent, and checked again, but unchanged.
+    assert scan(link_log_dir, in_dir) == {}
+
+    # A new directory, a new file in a listed directory, and a file rewritten in place.
+    write(os.path.join(in_dir, 'd', '4.dcm'))
+    write(os.path.join(in_dir, 'a', '5.dcm'))
+    write(os.path.join(in_dir, 'b', 'c', '3.dcm'), b'longer data')
+    assert scan(link_log_dir, in_dir) == {'a': ['5.dcm'], os.path.join('b', 'c'): ['3.dcm'], 'd': ['4.dcm']}
+
+    # Deleted directories are dropped from the manifest, along with their subdirectories.
+    os.remove(os.path.join(in_dir, 'b', 'c', '3.dcm'))
+    os.rmdir(os.path.join(in_dir, 'b', 'c'))
+    os.rmdir(os.path.join(in_dir, 'b'))
+    assert scan(link_log_dir, in_dir) == {}
+    manifest = scanManifest.Manifest(link_log_dir)
+    assert manifest.get(os.path.join(in_dir, 'b')) is None
+    assert manifest.get(os.path.join(in_dir, 'b', 'c')) is None
+    manifest.close()
+    # A directory of the same name created again is scanned again.
+    write(os.path.join(in_dir, 'b', 'c', '3.dcm'))
+    assert scan(link_log_dir, in_dir) == {os.path.join('b', 'c'): ['3.dcm']}
+
+    # A directory which cannot be listed is skipped, left out of the manifest, and listed by the next scan.
+    write(os.path.join(in_dir, 'e', '6.dcm'))
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.basename(path) == 'e':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    assert scan(link_log_dir, in_dir) == {}
+    monkeypatch.setattr(os, 'scandir', scandir)
+    assert scan(link_log_dir, in_dir) == {'e': ['6.dcm']}
+
+
+def test_settled_files(tmp_path):
+    in_dir = str(tmp_path / 'in')
+    link_log_dir = str(tmp_path / 'linklog')
+    os.makedirs(link_log_dir)
+    old_file = os.path.join(in_dir, 'a', 'old.dcm')
+    write(old_file)
+    set_mtime(old_file, 1000)
+    write(os.path.join(in_dir, 'a', 'new.dcm'))
+    assert scan(link_log_dir, in_dir) == {'a': ['new.dcm', 'old.dcm']}
+
+    # In a directory left unchanged, only files modified shortly before the previous scan are checked again:
+    # an old file rewritten in place, keeping its mtime, goes unnoticed, a recent one does not.
+    directory_mtime = os.stat(os.path.join(in_dir, 'a')).st_mtime_ns
+    write(old_file, b'other')
+    set_mtime(old_file, 1000)
+    write(os.path.join(in_dir, 'a', 'new.dcm'), b'more data')
+    os.utime(os.path.join(in_dir, 'a'), ns=(directory_mtime, directory_mtime))
+    assert scan(link_log_dir, in_dir) == {'a': ['new.dcm']}
+
+
+def test_import_json(tmp_path):
+    in_dir = str(tmp_path / 'in')
+    link_log_dir = str(tmp_path / 'linklog')
+    os.makedirs(link_log_dir)
+    write(os.path.join(in_dir, 'a', '1.dcm'))
+    write(os.path.join(in_dir, 'a', '2.dcm'))
+    st = os.stat(os.path.join(in_dir, 'a', '1.dcm'))
+    directories = {in_dir: {'mtime': os.stat(in_dir).st_mtime_ns, 'dirs': ['a'], 'files': {}},
+                   os.path.join(in_dir, 'a'): {'mtime': 0, 'dirs': [],
+                                                'files': {'1.dcm': [st.st_size, st.st_mtime_ns, st.st_ino]}}}
+    with open(os.path.join(link_log_dir, scanManifest.JSON_FILE_NAME), 'w') as outfile:
+        json.dump({'scan_time': 0, 'directories': directories}, outfile)
+    # Only the file not recorded by the json manifest is new.
+    assert scan(link_log_dir, in_dir) == {'a': ['2.dcm']}
@@ -0,0 +1,48 @@
+import scheduler
+
+
+def make_partition():
+    return {'a': {'queue': ['a/1', 'a/2', 'a/3', 'a/4', 'a/5'], 'size': 150.0, 'sizes': [10, 20, 30, 40, 50], 'raw': ['a/2']},
+            'b': {'queue': ['b/1'], 'size': 500.0, 'sizes': [500], 'raw': []},
+            'c': {'queue': [], 'size': 0.0, 'sizes': [], 'raw': []}}
+
+
+def test_make_chunks():
+    chunks = scheduler.make_chunks(make_partition(), chunk_bytes=60, chunk_files=2)
+    # Largest first, a file larger than chunk_bytes in a chunk of its own, and no chunk spanning directories.
+    assert [c['files'] for c in chunks] == [['b/1'], ['a/5'], ['a/4'], ['a/1', 'a/2'], ['a/3']]
+    assert [c['size'] for c in chunks] == [500, 50, 40, 30, 30]
+    assert all(len(c['files']) <= 2 and (c['size'] <= 60 or len(c['files']) == 1) for c in chunks)
+    assert all(len(set(f.split('/')[0] for f in c['files'])) == 1 for c in chunks)
+    assert next(c for c in chunks if 'a/2' in c['files'])['raw'] == ['a/2']
+    assert sorted(f for c in chunks for f in c['files']) == ['a/1', 'a/2', 'a/3', 'a/4', 'a/5', 'b/1']
+
+
+def test_make_chunks_without_sizes():
+    # Partitions of earlier versions only record the total size of each directory.
+    chunks = scheduler.make_chunks({'a': {'queue': ['a/1', 'a/2'], 'size': 100.0}}, chunk_bytes=50)
+    assert [c['sizes'] for c in chunks] == [[50.0], [50.0]]
+
+
+def test_remove_and_add_chunks():
+    partition = make_partition()
+    chunks = scheduler.make_chunks(partition, chunk_bytes=60, chunk_files=2)
+    for chunk in chunks:
+        scheduler.remove_chunk(partition, chunk)
+        # Removing a chunk twice, or from a directory already removed, changes nothing.
+        scheduler.remove_chunk(partition, chunk)
+        if chunk['directory'] == 'a' and 'a' in partition:
+            content = partition['a']
+            assert not set(chunk['files']) & set(content['queue'])
+            assert content['size'] == sum(content['sizes'])
+            assert set(content['raw']) <= set(content['queue'])
+    assert partition == {'c': {'queue': [], 'size': 0.0, 'sizes': [], 'raw': []}}
+
+    # Chunks discovered while streaming are added back as remaining work, and chunked again by the next run.
+    partition = {}
+    for chunk in chunks:
+        scheduler.add_chunk(partition, chunk)
+    assert sorted(partition) == ['a', 'b']
+    assert sorted(partition['a']['queue']) == ['a/1', 'a/2', 'a/3', 'a/4', 'a/5']
+    assert partition['a']['size'] == 150.0 and partition['a']['raw'] == ['a/2']
+    assert sorted(f for c in scheduler.make_chunks(partition) for f in c['files']) == ['a/1', 'a/2', 'a/3', 'a/4', 'a/5', 'b/1']
@@ -0,0 +1,52 @@
+import os
+import random
+import shutil
+
+import numpy as np
+import pytest
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless
+
+pytest.importorskip('pynetdicom')
+
+import benchmark
+import storeScp
+import utils
+
+
+def make_dicoms(directory):
+    rng = random.Random(0)
+    utils.make_dirs(directory)
+    ids = {'patient': 'PID1', 'accession': 'ACC1', 'study': benchmark.make_uid(rng), 'series': benchmark.make_uid(rng),
+           'series_number': 1}
+    pixel_array = np.arange(2*16*16, dtype=np.uint16).reshape(2, 16, 16) % 4096
+    for i, transfer_syntax in enumerate((ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless)):
+        ids['sop'] = benchmark.make_uid(rng)
+        ids['instance_number'] = i + 1
+        benchmark.make_dicom(os.path.join(directory, 'i{}.dcm'.format(i)), ids, transfer_syntax, pixel_array, rng)
+    shutil.copyfile(os.path.join(directory, 'i0.dcm'), os.path.join(directory, 'dup.dcm'))
+    with open(os.path.join(directory, 'noise.txt'), 'wb') as f:
+        f.write(bytes(range(256))*16)
+
+
+def test_store_over_loopback(tmp_path):
+    in_dir, out_dir, link_log_dir = (str(tmp_path / name) for name in ('in', 'out', 'linklog'))
+    make_dicoms(in_dir)
+    utils.make_dirs(out_dir)
+    utils.make_dirs(link_log_dir)
+
+    scp = storeScp.StoreScp([out_dir], link_log_dir, 'a', workers=2)
+    try:
+        scp.start(0, host='127.0.0.1')
+        sent, stored = storeScp.send_directory(in_dir, '127.0.0.1', scp.port, associations=2)
+    finally:
+        scp.close()
+
+    # The non-dicom is not sent, and the duplicate is acknowledged without being written again.
+    assert (sent, stored) == (4, 4)
+    counters = scp.run_metrics.counters
+    assert (counters['anonymized'], counters['duplicates'], counters['errors']) == (3, 1, 0)
+    out_files = sorted(os.path.splitext(name)[1] for _, _, names in os.walk(out_dir) for name in names)
+    assert out_files == ['.dcm']*3 + ['.hdf5']*3
+    assert len(utils.load_json(os.path.join(link_log_dir, 'link_sop_log.json'))) == 3
+    assert len(utils.load_json(os.path.join(link_log_dir, 'link_study_log.json'))) == 1
+    assert sorted(utils.load_json(os.path.join(link_log_dir, 'link_master_log.json')).values()) == [1, 1, 2]
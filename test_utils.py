@@ -0,0 +1,53 @@
+import os
+import random
+
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.uid import generate_uid
+
+import benchmark
+import utils
+
+
+def write_data_set(file_name, is_implicit_vr):
+    # A data set without preamble, 'DICM' prefix or file meta, as written by some older devices.
+    ds = Dataset()
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    ds.SOPInstanceUID = generate_uid()
+    ds.PatientID = 'MRN1'
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = is_implicit_vr
+    write_dataset(fp, ds)
+    with open(file_name, 'wb') as outfile:
+        outfile.write(fp.getvalue())
+
+
+def test_sniff_preamble(tmp_path):
+    benchmark.generate_corpus(str(tmp_path), n_files=2, n_dirs=1, skew=0.0, rows=4, columns=4, frames=1,
+                              transfer_syntaxes=['explicit', 'implicit'], duplicate_rate=0.0, noise_rate=0.0, seed=1)
+    file_names = [os.path.join(root, name) for root, _, files in os.walk(str(tmp_path)) for name in files]
+    assert file_names
+    assert all(utils.sniff_dicom(file_name) == utils.DICOM_PREAMBLE for file_name in file_names)
+
+
+@pytest.mark.parametrize('is_implicit_vr', [False, True])
+def test_sniff_no_preamble(tmp_path, is_implicit_vr):
+    file_name = str(tmp_path / 'raw')
+    write_data_set(file_name, is_implicit_vr)
+    assert utils.sniff_dicom(file_name) == utils.DICOM_RAW
+
+
+@pytest.mark.parametrize('content', [b'', b'DICM', b'hello world, not a dicom\n' * 20, bytes(256),
+                                     random.Random(1).randbytes(4096), b'\x00' * 128 + b'DICX'])
+def test_sniff_noise(tmp_path, content):
+    file_name = str(tmp_path / 'noise')
+    with open(file_name, 'wb') as outfile:
+        outfile.write(content)
+    assert utils.sniff_dicom(file_name) is None
+
+
+def test_sniff_missing_file(tmp_path):
+    assert utils.sniff_dicom(os.path.join(str(tmp_path), 'missing')) is None
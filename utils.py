@@ -1,9 +1,22 @@
 import os
 import shutil
 import datetime
+import struct
 
 import json
 
+import archiveReader
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b'DICM'
+DICOM_PREAMBLE = 'preamble'
+DICOM_RAW = 'raw'
+# Value representations, used to recognize explicit VR data sets written without the preamble and 'DICM' prefix.
+DICOM_VRS = {b'AE', b'AS', b'AT', b'CS', b'DA', b'DS', b'DT', b'FD', b'FL', b'IS', b'LO', b'LT', b'OB', b'OD', b'OF',
+             b'OL', b'OV', b'OW', b'PN', b'SH', b'SL', b'SQ', b'SS', b'ST', b'SV', b'TM', b'UC', b'UI', b'UL', b'UN',
+             b'UR', b'US', b'UT', b'UV'}
+DICOM_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT', b'SV', b'UV'}
+
 
 def make_dirs(path, replace=False):
     if not os.path.isdir(path):
@@ -24,18 +37,102 @@ def load_json(file_name):
 
 
 def save_json(data, file_name):
-    with open(file_name, 'w') as outfile:
+    # Write to a temporary file and rename it over <file_name>, so that a crash never leaves a truncated file behind.
+    temp_file_name = '{}.tmp'.format(file_name)
+    with open(temp_file_name, 'w') as outfile:
         json.dump(obj=data, fp=outfile, sort_keys=True, indent=4, separators=(',', ': '))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_file_name, file_name)
 
 
-def load_link_log(logger, link_log_path, file_name, message):
-    if (link_log_path is not None) and os.path.exists(os.path.join(link_log_path, file_name)):
-        link_dict = load_json(os.path.join(link_log_path, file_name))
-        print(message)
-        logger.info(message)
-    else:
-        link_dict = {}
-    return link_dict
+def sniff_dicom(file_name):
+    """
+    Classifies a file as dicom from its first bytes only, without parsing it. Returns DICOM_PREAMBLE for files starting
+    with the 128 byte preamble and 'DICM' prefix, DICOM_RAW for data sets written without them (which pydicom reads
+    with force=True), and None otherwise. At most DICOM_PREAMBLE_LENGTH + 4 bytes are read.
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            header = f.read(DICOM_PREAMBLE_LENGTH + len(DICOM_PREFIX))
+    except OSError:
+        return None
+    return sniff_header(header)
+
+
+def sniff_header(header):
+    """
+    Classifies a file as dicom from its first DICOM_PREAMBLE_LENGTH + 4 bytes <header> (fewer for shorter files),
+    see sniff_dicom.
+    """
+    if header[DICOM_PREAMBLE_LENGTH:] == DICOM_PREFIX:
+        return DICOM_PREAMBLE
+
+    # Preamble-less data sets start with file meta (group 0002) or identifying (group 0008) little endian elements.
+    # Walk the elements within the bytes already read, and require ascending tags with plausible lengths.
+    offset = 0
+    previous_tag = -1
+    n_elements = 0
+    while offset + 8 <= len(header):
+        group, element = struct.unpack('<HH', header[offset:offset + 4])
+        tag = (group << 16) | element
+        if tag <= previous_tag or (n_elements == 0 and group not in (0x0002, 0x0008)):
+            return None
+        vr = header[offset + 4:offset + 6]
+        if vr in DICOM_LONG_VRS:
+            if offset + 12 > len(header):
+                break
+            length = struct.unpack('<I', header[offset + 8:offset + 12])[0]
+            offset += 12
+        elif vr in DICOM_VRS:
+            length = struct.unpack('<H', header[offset + 6:offset + 8])[0]
+            offset += 8
+        else:
+            length = struct.unpack('<I', header[offset + 4:offset + 8])[0]
+            offset += 8
+        if length == 0xFFFFFFFF:
+            # Undefined length (sequence) - nothing further can be validated cheaply.
+            return DICOM_RAW
+        if length > 0xFFFF and group != 0x7FE0:
+            return None
+        offset += length
+        previous_tag = tag
+        n_elements += 1
+    return DICOM_RAW if n_elements else None
+
+
+def scan_directory(root, files):
+    """
+    Returns the partition entry of directory <root>: its dicom file paths, their sizes and total size,
+    and the paths of dicoms lacking the preamble (to be read with force=True).
+    The dicoms of archives (see archiveReader.py) are listed as files of the archive's directory.
+    """
+    content = {'queue': [], 'size': 0.0, 'sizes': [], 'raw': []}
+    for name in files:
+        if archiveReader.is_archive(name):
+            for f, size, header in archiveReader.list_members(os.path.join(root, name)):
+                kind = DICOM_PREAMBLE if f.endswith((".dcm", ".dicom")) else sniff_header(header)
+                if kind:
+                    content['queue'].append(f)
+                    content['sizes'].append(size)
+                    content['size'] += size
+                    if kind == DICOM_RAW:
+                        content['raw'].append(f)
+            continue
+        # Classify from the file's first bytes only, and record files lacking the preamble,
+        # so that they are read with force=True without being sniffed again.
+        if name.endswith((".dcm", ".dicom")):
+            kind = DICOM_PREAMBLE
+        else:
+            kind = sniff_dicom(os.path.join(root, name))
+        if kind:
+            size = os.stat(os.path.join(root, name)).st_size
+            content['queue'].append(os.path.join(root, name))
+            content['sizes'].append(size)
+            content['size'] += size
+            if kind == DICOM_RAW:
+                content['raw'].append(os.path.join(root, name))
+    return content
 
 
 def calculate_age(study_date, dob):